@@ -7,6 +7,7 @@ import os
 import yaml
 from hipe4ml.tree_handler import TreeHandler
 from signal_extraction import SignalExtraction
+from histo_booking import HistoBooker
 
 
 import sys
@@ -51,6 +52,15 @@ skip_out_tree = config['skip_out_tree']
 calibrate_he_momentum = config['calibrate_he_momentum']
 do_signal_extraction = config['do_signal_extraction']
 
+streaming = config.get('streaming', False)
+step_size = config.get('step_size', '100 MB')
+n_workers = config.get('n_workers', 1)
+column_projection = config.get('column_projection', False)
+compact = config.get('compact', False)
+mc_weights = config.get('mc_weights', False)
+mc_weight_col = utils.PT_WEIGHT_COLUMN if mc and mc_weights else None
+fit_backend = config.get('fit_backend')
+
 
 matter_options = ['matter', 'antimatter', 'both']
 if is_matter not in matter_options:
@@ -65,60 +75,81 @@ print('**********************************')
 mass_low_limit = 3.87 if is_h4l else 2.96
 mass_high_limit = 3.98 if is_h4l else 3.04
 
-############# Create histograms #############
-hCosPA = ROOT.TH1F('hCosPA', r';cos(#theta_{PA})', 500, 0.95, 1)
-hNTPCclus = ROOT.TH1F('hNTPCclus', r';n TPC clusters', 80, 79.5, 159.5)
-h2NTPCclusPt = ROOT.TH2F('h2NTPCclusPt', r';#it{p}_{T} (GeV/#it{c}); n TPC clusters', 50, 0, 10, 80, 79.5, 159.5)
-
-hMass3LH = ROOT.TH1F('h_3lh_mass', r'; m({}^{3}_{#Lambda}H) (GeV/#it{c})', 40, 2.96, 3.04)
-hMass4LH = ROOT.TH1F('h_4lh_mass', r';  m({}^{4}_{#Lambda}H) (GeV/#it{c^{2}})', 32, 3.87, 3.98)
-h2Mass3LHVvsMass4LH = ROOT.TH2F('h2Mass3LHVvsMass4LH', r'; m({}^{3}_{#Lambda}H) (GeV/#it{c}); m({}^{4}_{#Lambda}H) (GeV/#it{c})', 40, 2.96, 3.04, 32, 3.87, 3.98)
-hPtRec = ROOT.TH1F('hPtRec', r';#it{p}_{T} (GeV/#it{c})', 100, 0, 10)
-hCtRec = ROOT.TH1F('hCtRec', r';#it{c#tau} (cm)', 50, 0, 40)
-hRadius = ROOT.TH1F('hRadius', r';Radius (cm)', 100, 0, 40)
-hDecLen = ROOT.TH1F('hDecLen', r';Decay length (cm)', 100, 0, 40)
-hNSigHe = ROOT.TH1F('hNSigmaHe', r';n_{#sigma}^{TPC}({}^{3}He)', 50, -3, 3)
-h2NSigHe3VsMom = ROOT.TH2F('h2NSigHe3VsMom', r';{}^{3}He #it{p}_{T} (GeV/#it{c});n_{#sigma}^{TPC}({}^{3}He)', 50, -10, 10, 50, -3, 3)
-h2NSigHe4VsMom = ROOT.TH2F('h2NSigHe4VsMom', r';{}^{4}He #it{p}_{T} (GeV/#it{c});n_{#sigma}^{TPC}({}^{4}He)', 50, -10, 10, 50, -3, 3)
-h2Mass3HLvsPt = ROOT.TH2F('h2Mass3HLvsPt', r';#it{p}_{T} (GeV/#it{c}); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 100, 0, 10, 50, 2.96, 3.04)
-h2Mass4LHvsPt = ROOT.TH2F('h2Mass4LHvsPt', r';#it{p}_{T} (GeV/#it{c}); m({}^{4}_{#Lambda}H) (GeV/#it{c})', 100, 0, 10, 50, 3.87, 3.98)
-h2TPCSigHe3VsMom = ROOT.TH2F('h2TPCSigHe3VsMom', r';{}^{3}He #it{p}_{T} (GeV/#it{c});TPC signal', 50, 0, 7, 100, 0.5, 1000)
-hClusterSizeHe = ROOT.TH1F('hClusterSizeHe', r';#LT Cluster size #GT', 15, 0.5, 15.5)
-hTrackedClSize = ROOT.TH1F('hTrackedClSize', r';#LT Cluster size #GT', 15, 0.5, 15.5)
-hClusterSizeHeCosLam = ROOT.TH1F('hClusterSizeHeCosLam', r';#LT Cluster size #GT x cos(#lambda)', 15, 0.5, 15.5)
-h2ClusSizeVsCosLam = ROOT.TH2F('h2ClusSizeVsCosLam', r'; Cos(#lambda); #LT Cluster size #GT', 100, 0.95, 1, 15, 0.5, 15.5)
-h2NSigClusSizeHe = ROOT.TH2F('h2NSigClusSizeHe', r';n_{#sigma}^{TPC}({}^{3}He);<Cluster size>', 50, -3, 3, 15, 0.5, 15.5)
-h2TPCSigClusSize = ROOT.TH2F('h2TPCSigClusSize', r';<Cluster size>; TPC signal', 50, 0.5, 15.5, 100, 0.5, 1000)
-hClusterSizePi = ROOT.TH1F('hClusterSizePi', r';#LT Cluster size #GT', 15, 0.5, 15.5)
-h2NSigClusSizePi = ROOT.TH2F('h2NSigClusSizePi', r';n_{#sigma}^{TPC}(#pi); #LT Cluster size #GT', 50, -3, 3, 15, 0.5, 15.5)
-hHeMomTPCMinusMomGlo = ROOT.TH2F('hHeMomTPCMinusMomGlo', r';#it{p}^{glo}/z (GeV/#it{c});(#it{p}^{TPC} - #it{p}^{Glo}) / z (GeV/#it{c})', 50, -5, 5, 50, -2, 2)
-hHeMomTPCMinusMomGloTritHyp = ROOT.TH2F('hHeMomTPCMinusMomGloTritHyp', r';#it{p}^{glo}/z (GeV/#it{c});(#it{p}^{TPC} - #it{p}^{Glo}) / z (GeV/#it{c})', 50, -5, 5, 50, -2, 2)
-hHeMomTPCMinusMomGloHeHyp = ROOT.TH2F('hHeMomTPCMinusMomGloHeHyp', r';#it{p}^{glo}/z (GeV/#it{c});(#it{p}^{TPC} - #it{p}^{Glo}) / z (GeV/#it{c})', 50, -5, 5, 50, -2, 2)
-
-h2MassV2 = ROOT.TH2F('h2MassV2', r';m({}^{3}_{#Lambda}H) (GeV/#it{c}); v2', 30, mass_low_limit, mass_high_limit, 500, -1, 1)
-hMeanV2VsMass = ROOT.TH1F('hMeanV2VsMass', r';m({}^{3}_{#Lambda}H) (GeV/#it{c}); #LT v2 #GT', 30, mass_low_limit, mass_high_limit)
-h2MassCosPA = ROOT.TH2F('h2MassCosPA', r';cos(#theta_{PA}); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 100, 0.99, 1, 50, mass_low_limit, mass_high_limit)
-h2MassDecLen = ROOT.TH2F('h2MassDecLen', r';Decay length (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 100, 0, 40, 50, mass_low_limit, mass_high_limit)
-h2MassDCADaughters = ROOT.TH2F('h2MassDCADaughters', r';DCA daughters (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 200, 0, 0.3, 50, mass_low_limit, mass_high_limit)
-h2MassDCAHePv = ROOT.TH2F('h2MassDCAHe', r';DCA He3 PVs (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 400, -2,2, 50, mass_low_limit, mass_high_limit)
-h2MassDCAPiPv = ROOT.TH2F('h2MassDCAPi', r';DCA #pi PVs (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 400, -20,20, 50, mass_low_limit, mass_high_limit)
-h2MassPt = ROOT.TH2F('h2MassPt', r';#it{p}_{T} (GeV/#it{c}); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 50, 0, 7, 50, mass_low_limit, mass_high_limit)
-h2MassPIDHypo = ROOT.TH2F('h2MassPIDHypo', r';Hypothesis; m({}^{3}_{#Lambda}H) (GeV/#it{c})', 16, 0.5, 16.5, 50, mass_low_limit, mass_high_limit)
-h2Mass4LHnSigmaHe = ROOT.TH2F('h2Mass4LHnSigmaHe', r';n_{#sigma}^{TPC}({}^{3}He); m({}^{4}_{#Lambda}H) (GeV/#it{c})', 50, -4, 4, 30, 3.89, 3.97)
+############# Book histograms #############
+mass_string = 'fMassH3L' if not is_h4l else 'fMassH4L'
+mass_bins = [50, mass_low_limit, mass_high_limit]
+cl_size_bins = [15, 0.5, 15.5]
+mom_diff_bins = [50, -2, 2]
+
+histo_specs = [
+    {'name': 'hPtRec', 'title': r';#it{p}_{T} (GeV/#it{c})', 'bins': [100, 0, 10], 'x': 'fPt'},
+    {'name': 'hCtRec', 'title': r';#it{c#tau} (cm)', 'bins': [50, 0, 40], 'x': 'fCt'},
+    {'name': 'hCosPA', 'title': r';cos(#theta_{PA})', 'bins': [500, 0.95, 1], 'x': 'fCosPA'},
+    {'name': 'hRadius', 'title': r';Radius (cm)', 'bins': [100, 0, 40], 'x': 'fDecRad'},
+    {'name': 'hDecLen', 'title': r';Decay length (cm)', 'bins': [100, 0, 40], 'x': 'fDecLen'},
+    {'name': 'hNTPCclus', 'title': r';n TPC clusters', 'bins': [80, 79.5, 159.5], 'x': 'fNTPCclusHe'},
+    {'name': 'h2NTPCclusPt', 'title': r';#it{p}_{T} (GeV/#it{c}); n TPC clusters', 'bins': [50, 0, 10], 'y_bins': [80, 79.5, 159.5], 'x': 'fPt', 'y': 'fNTPCclusHe'},
+    {'name': 'hNSigmaHe', 'title': r';n_{#sigma}^{TPC}({}^{3}He)', 'bins': [50, -3, 3], 'x': 'fNSigmaHe'},
+    {'name': 'h_3lh_mass', 'title': r'; m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [40, 2.96, 3.04], 'x': 'fMassH3L'},
+    {'name': 'h_4lh_mass', 'title': r';  m({}^{4}_{#Lambda}H) (GeV/#it{c^{2}})', 'bins': [32, 3.87, 3.98], 'x': 'fMassH4L'},
+    {'name': 'h2MassV2', 'title': r';m({}^{3}_{#Lambda}H) (GeV/#it{c}); v2', 'bins': [30, mass_low_limit, mass_high_limit], 'y_bins': [500, -1, 1], 'x': mass_string, 'y': 'fV2', 'requires': ['fV2']},
+    {'name': 'h2MassCosPA', 'title': r';cos(#theta_{PA}); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [100, 0.99, 1], 'y_bins': mass_bins, 'x': 'fCosPA', 'y': mass_string},
+    {'name': 'h2MassDecLen', 'title': r';Decay length (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [100, 0, 40], 'y_bins': mass_bins, 'x': 'fDecLen', 'y': mass_string},
+    {'name': 'h2MassDCADaughters', 'title': r';DCA daughters (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [200, 0, 0.3], 'y_bins': mass_bins, 'x': 'fDcaV0Daug', 'y': mass_string},
+    {'name': 'h2MassDCAHe', 'title': r';DCA He3 PVs (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [400, -2, 2], 'y_bins': mass_bins, 'x': 'fDcaHe', 'y': mass_string},
+    {'name': 'h2MassDCAPi', 'title': r';DCA #pi PVs (cm); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [400, -20, 20], 'y_bins': mass_bins, 'x': 'fDcaPi', 'y': mass_string},
+    {'name': 'h2Mass4LHnSigmaHe', 'title': r';n_{#sigma}^{TPC}({}^{3}He); m({}^{4}_{#Lambda}H) (GeV/#it{c})', 'bins': [50, -4, 4], 'y_bins': [30, 3.89, 3.97], 'x': 'fNSigmaHe', 'y': mass_string},
+    {'name': 'h2MassPt', 'title': r';#it{p}_{T} (GeV/#it{c}); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [50, 0, 7], 'y_bins': mass_bins, 'x': 'fPt', 'y': mass_string},
+    {'name': 'h2NSigClusSizePi', 'title': r';n_{#sigma}^{TPC}(#pi); #LT Cluster size #GT', 'bins': [50, -3, 3], 'y_bins': cl_size_bins},
+    {'name': 'h2TPCSigClusSize', 'title': r';<Cluster size>; TPC signal', 'bins': [50, 0.5, 15.5], 'y_bins': [100, 0.5, 1000], 'x': 'fAvgClusterSizeHe', 'y': 'fTPCsignalHe', 'requires': ['fAvgClusterSizeHe']},
+    {'name': 'h2TPCSigClusSize', 'x': 'fAvgClusterSizePi', 'y': 'fTPCsignalPi', 'requires': ['fAvgClusterSizePi']},
+    {'name': 'h2NSigHe3VsMom', 'title': r';{}^{3}He #it{p}_{T} (GeV/#it{c});n_{#sigma}^{TPC}({}^{3}He)', 'bins': [50, -10, 10], 'y_bins': [50, -3, 3], 'x': 'fTPCSignMomHe3', 'y': 'fNSigmaHe'},
+    {'name': 'h2TPCSigHe3VsMom', 'title': r';{}^{3}He #it{p}_{T} (GeV/#it{c});TPC signal', 'bins': [50, 0, 7], 'y_bins': [100, 0.5, 1000], 'x': 'fTPCmomHe', 'y': 'fTPCsignalHe'},
+    {'name': 'h2NSigHe4VsMom', 'title': r';{}^{4}He #it{p}_{T} (GeV/#it{c});n_{#sigma}^{TPC}({}^{4}He)', 'bins': [50, -10, 10], 'y_bins': [50, -3, 3], 'x': 'fTPCSignMomHe3', 'y': 'fNSigmaHe4'},
+    {'name': 'hHeMomTPCMinusMomGlo', 'title': r';#it{p}^{glo}/z (GeV/#it{c});(#it{p}^{TPC} - #it{p}^{Glo}) / z (GeV/#it{c})', 'bins': [50, -5, 5], 'y_bins': mom_diff_bins, 'x': 'fGloSignMomHe3', 'y': 'MomDiffHe3'},
+    {'name': 'h2Mass3LHVvsMass4LH', 'title': r'; m({}^{3}_{#Lambda}H) (GeV/#it{c}); m({}^{4}_{#Lambda}H) (GeV/#it{c})', 'bins': [40, 2.96, 3.04], 'y_bins': [32, 3.87, 3.98], 'x': 'fMassH3L', 'y': 'fMassH4L'},
+    {'name': 'h2Mass3HLvsPt', 'title': r';#it{p}_{T} (GeV/#it{c}); m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [100, 0, 10], 'y_bins': [50, 2.96, 3.04], 'x': 'fPt', 'y': 'fMassH3L'},
+    {'name': 'h2Mass4LHvsPt', 'title': r';#it{p}_{T} (GeV/#it{c}); m({}^{4}_{#Lambda}H) (GeV/#it{c})', 'bins': [100, 0, 10], 'y_bins': [50, 3.87, 3.98], 'x': 'fPt', 'y': 'fMassH4L'},
+    # PID hypotheses, only available with fFlags (see PID_HISTOS)
+    {'name': 'hHeliumPIDHypo', 'title': r';Hypothesis', 'bins': [16, 0.5, 16.5], 'x': 'fHePIDHypo', 'requires': ['fHePIDHypo']},
+    {'name': 'hPiPIDHypo', 'title': r';Hypothesis', 'bins': [16, 0.5, 16.5], 'x': 'fPiPIDHypo', 'requires': ['fPiPIDHypo']},
+    {'name': 'hHeMomTPCMinusMomGloTritHyp', 'title': r';#it{p}^{glo}/z (GeV/#it{c});(#it{p}^{TPC} - #it{p}^{Glo}) / z (GeV/#it{c})', 'bins': [50, -5, 5], 'y_bins': mom_diff_bins, 'x': 'fGloSignMomHe3', 'y': 'MomDiffHe3', 'sel': 'fHePIDHypo==6', 'requires': ['fHePIDHypo']},
+    {'name': 'hHeMomTPCMinusMomGloHeHyp', 'title': r';#it{p}^{glo}/z (GeV/#it{c});(#it{p}^{TPC} - #it{p}^{Glo}) / z (GeV/#it{c})', 'bins': [50, -5, 5], 'y_bins': mom_diff_bins, 'x': 'fGloSignMomHe3', 'y': 'MomDiffHe3', 'sel': 'fHePIDHypo==7', 'requires': ['fHePIDHypo']},
+    {'name': 'h2MassPIDHypo', 'title': r';Hypothesis; m({}^{3}_{#Lambda}H) (GeV/#it{c})', 'bins': [16, 0.5, 16.5], 'y_bins': mass_bins, 'x': 'fHePIDHypo', 'y': mass_string, 'requires': ['fHePIDHypo']},
+    # ITS cluster sizes
+    {'name': 'hClusterSizeHe', 'title': r';#LT Cluster size #GT', 'bins': cl_size_bins, 'x': 'fAvgClusterSizeHe', 'requires': ['fAvgClusterSizeHe']},
+    {'name': 'hTrackedClSize', 'title': r';#LT Cluster size #GT', 'bins': cl_size_bins, 'x': 'fTrackedClSize', 'requires': ['fTrackedClSize']},
+    {'name': 'hClusterSizeHeCosLam', 'title': r';#LT Cluster size #GT x cos(#lambda)', 'bins': cl_size_bins, 'x': 'fAvgClSizeCosLambda', 'requires': ['fAvgClSizeCosLambda']},
+    {'name': 'hClusterSizePi', 'title': r';#LT Cluster size #GT', 'bins': cl_size_bins, 'x': 'fAvgClusterSizePi', 'requires': ['fAvgClusterSizePi']},
+    {'name': 'h2NSigClusSizeHe', 'title': r';n_{#sigma}^{TPC}({}^{3}He);<Cluster size>', 'bins': [50, -3, 3], 'y_bins': cl_size_bins, 'x': 'fNSigmaHe', 'y': 'fAvgClusterSizeHe', 'requires': ['fAvgClusterSizeHe']},
+    {'name': 'h2ClusSizeVsCosLam', 'title': r'; Cos(#lambda); #LT Cluster size #GT', 'bins': [100, 0.95, 1], 'y_bins': cl_size_bins, 'x': 'fCosLambdaHe', 'y': 'fAvgClusterSizeHe', 'requires': ['fAvgClusterSizeHe']},
+]
+
 # for MC only
-hPtGen = ROOT.TH1F('hPtGen', r';#it{p}_{T}^{gen} (GeV/#it{c})', 100, 0, 10)
-hCtGen = ROOT.TH1F('hCtGen', r';#it{c}#tau (cm)', 50, 0, 40)
-hResolutionPt = ROOT.TH1F('hResolutionPt', r';(#it{p}_{T}^{rec} - #it{p}_{T}^{gen}) / #it{p}_{T}^{gen}', 50, -0.2, 0.2)
-hResolutionPtvsPt = ROOT.TH2F('hResolutionPtvsPt', r';#it{p}_{T}^{gen} (GeV/#it{c});(#it{p}_{T}^{rec} - #it{p}_{T}^{gen}) / #it{p}_{T}^{gen}', 50, 0, 5, 50, -0.2, 0.2)
-hResolutionHe3PtvsPt = ROOT.TH2F('hResolutionHe3PtvsPt', r';#it{p}_{T}^{gen} (GeV/#it{c});(#it{p}_{T}^{rec} - #it{p}_{T}^{gen}) / #it{p}_{T}^{gen}', 50, 0, 5, 50, -0.2, 0.2)
-hResolutionPiPtvsPt = ROOT.TH2F('hResolutionPiPtvsPt', r';#it{p}_{T}^{gen} (GeV/#it{c});(#it{p}_{T}^{rec} - #it{p}_{T}^{gen}) / #it{p}_{T}^{gen}', 50, 0, 1, 50, -0.2, 0.2)
-hResolutionP = ROOT.TH1F('hResolutionP', r';(#it{p}^{rec} - #it{p}^{gen}) / #it{p}^{gen}', 50, -0.2, 0.2)
-hResolutionPvsP = ROOT.TH2F('hResolutionPvsP', r';#it{p}^{gen} (GeV/#it{c});(#it{p}^{rec} - #it{p}^{gen}) / #it{p}^{gen}', 50, 0, 5, 50, -0.2, 0.2)
-hResolutionDecVtxX = ROOT.TH1F('hResolutionDecVtxX', r'; Resolution Dec X', 50, -0.2, 0.2)
-hResolutionDecVtxY = ROOT.TH1F('hResolutionDecVtxY', r'; Resolution Dec Y', 50, -0.2, 0.2)
-hResolutionDecVtxZ = ROOT.TH1F('hResolutionDecVtxZ', r'; Resolution Dec Z', 50, -0.2, 0.2)
-hHeliumPIDHypo = ROOT.TH1F('hHeliumPIDHypo', r';Hypothesis', 16, 0.5, 16.5)
-hPiPIDHypo = ROOT.TH1F('hPiPIDHypo', r';Hypothesis', 16, 0.5, 16.5)
+if mc:
+    histo_specs += [
+        {'name': 'hResolutionPt', 'title': r';(#it{p}_{T}^{rec} - #it{p}_{T}^{gen}) / #it{p}_{T}^{gen}', 'bins': [50, -0.2, 0.2], 'x': 'resPt', 'dir': 'MC'},
+        {'name': 'hResolutionPtvsPt', 'title': r';#it{p}_{T}^{gen} (GeV/#it{c});(#it{p}_{T}^{rec} - #it{p}_{T}^{gen}) / #it{p}_{T}^{gen}', 'bins': [50, 0, 5], 'y_bins': [50, -0.2, 0.2], 'x': 'fAbsGenPt', 'y': 'resPt', 'dir': 'MC'},
+        {'name': 'hResolutionDecVtxX', 'title': r'; Resolution Dec X', 'bins': [50, -0.2, 0.2], 'x': 'ResDecX', 'dir': 'MC'},
+        {'name': 'hResolutionDecVtxY', 'title': r'; Resolution Dec Y', 'bins': [50, -0.2, 0.2], 'x': 'ResDecY', 'dir': 'MC'},
+        {'name': 'hResolutionDecVtxZ', 'title': r'; Resolution Dec Z', 'bins': [50, -0.2, 0.2], 'x': 'ResDecZ', 'dir': 'MC'},
+    ]
+
+# additional histograms from the config file
+if 'histograms' in config:
+    histo_specs += config['histograms']
+
+histo_booker = HistoBooker(histo_specs, default_weight=mc_weight_col)
+## written only if the tree has fFlags
+PID_HISTOS = ['hHeliumPIDHypo', 'hPiPIDHypo', 'hHeMomTPCMinusMomGloTritHyp', 'hHeMomTPCMinusMomGloHeHyp', 'h2MassPIDHypo']
+has_flags = False
+
+# generated histograms are filled before the reconstruction selections
+gen_histo_booker = HistoBooker([
+    {'name': 'hPtGen', 'title': r';#it{p}_{T}^{gen} (GeV/#it{c})', 'bins': [100, 0, 10], 'x': 'fAbsGenPt', 'dir': 'MC'},
+    {'name': 'hCtGen', 'title': r';#it{c}#tau (cm)', 'bins': [50, 0, 40], 'x': 'fGenCt', 'dir': 'MC'},
+], default_weight=mc_weight_col)
+hMeanV2VsMass = ROOT.TH1F('hMeanV2VsMass', r';m({}^{3}_{#Lambda}H) (GeV/#it{c}); #LT v2 #GT', 30, mass_low_limit, mass_high_limit)
 
 
 ############# Read trees #############
@@ -130,102 +161,90 @@ for tree in tree_names:
             tree_name = tree
             break
 print(f'Tree name: {tree_name}')
-tree_hdl = TreeHandler(input_files_name, tree_name, folder_name='DF*')
-# tree_hdl = TreeHandler(input_files_name, tree_name)
-
-df = tree_hdl.get_data_frame()
-df = utils.correct_and_convert_df(df, calibrate_he_momentum, mc, is_h4l)
-
 
-############# Apply pre-selections to MC #############
 if mc:
-    mc_pre_sels = ''
     spectra_file = ROOT.TFile.Open('utils/heliumSpectraMB.root')
     he3_spectrum = spectra_file.Get('fCombineHeliumSpecLevyFit_0-100')
     spectra_file.Close()
-    utils.reweight_pt_spectrum(df, 'fAbsGenPt', he3_spectrum)
-    mc_pre_sels += 'rej==True'
-    if is_matter == 'matter':
-        mc_pre_sels += 'and fGenPt>0'
-    elif is_matter == 'antimatter':
-        mc_pre_sels += 'and fGenPt<0'
-    ## fill histograms to be put at denominator of efficiency
-    utils.fill_th1_hist(hPtGen, df, 'fAbsGenPt')
-    utils.fill_th1_hist(hCtGen, df, 'fGenCt')
-    ## now we select only the reconstructed particles
-    df.query('fIsReco==True', inplace=True)
-
-############# Apply pre-selections to data #############
-else:
-    data_pre_sels = ''
-    if is_matter == 'matter':
-        data_pre_sels += 'fIsMatter == True'
-    elif is_matter == 'antimatter':
-        data_pre_sels += 'fIsMatter == False'
-    if data_pre_sels != '':
-        df.query(data_pre_sels, inplace=True)
-
 
-############# Common filtering #############
-if selections_string != '':
-    df.query(selections_string, inplace=True)
 
+def convert(df):
+    utils.correct_and_convert_df(df, calibrate_he_momentum, mc, is_h4l, compact=compact)
+    return df
+
+
+def select_and_fill(df):
+    ## selections and histogram filling, applied to the full dataframe or to each chunk
+    global has_flags
+    has_flags = has_flags or 'fFlags' in df.columns
+
+    ############# Apply pre-selections to MC #############
+    if mc:
+        mc_pre_sels = ''
+        utils.reweight_pt_spectrum(df, 'fAbsGenPt', he3_spectrum, weight_col=mc_weight_col)
+        mc_pre_sels += 'rej==True'
+        if is_matter == 'matter':
+            mc_pre_sels += 'and fGenPt>0'
+        elif is_matter == 'antimatter':
+            mc_pre_sels += 'and fGenPt<0'
+        ## fill histograms to be put at denominator of efficiency
+        gen_histo_booker.fill(df)
+        ## now we select only the reconstructed particles
+        df.query('fIsReco==True', inplace=True)
+
+    ############# Apply pre-selections to data #############
+    else:
+        data_pre_sels = ''
+        if is_matter == 'matter':
+            data_pre_sels += 'fIsMatter == True'
+        elif is_matter == 'antimatter':
+            data_pre_sels += 'fIsMatter == False'
+        if data_pre_sels != '':
+            df.query(data_pre_sels, inplace=True)
+
+    ############# Common filtering #############
+    if selections_string != '':
+        df.query(selections_string, inplace=True)
+
+    # df.query('fAvgClusterSizeHe>4', inplace=True)
+
+    ############# Fill output histograms #############
+    df.eval('MomDiffHe3 = fTPCmomHe - fPHe3/2', inplace=True)
+    # for MC only
+    if mc:
+        df.eval('resPt = (fPt - fAbsGenPt)/fAbsGenPt', inplace=True)
+        df.eval('ResDecX = (fXDecVtx - fGenXDecVtx)/fGenXDecVtx', inplace=True)
+        df.eval('ResDecY = (fYDecVtx - fGenYDecVtx)/fGenYDecVtx', inplace=True)
+        df.eval('ResDecZ = (fZDecVtx - fGenZDecVtx)/fGenZDecVtx', inplace=True)
+
+    ## all the histograms are filled in a single pass over the candidates
+    histo_booker.fill(df)
+    return df
+
+
+columns = None
+if column_projection and skip_out_tree:
+    used_expressions = [selections_string, histo_booker.get_expressions(), gen_histo_booker.get_expressions(),
+                        ['fIsReco', 'fMassH3L', 'fMassH4L']]
+    columns = utils.get_needed_columns(input_files_name, tree_name, used_expressions, calibrate_he3_pt=calibrate_he_momentum, isMC=mc)
+
+if n_workers > 1:
+    ## the conversion runs in the worker processes, the histograms are filled here
+    df = utils.parallel_read_and_convert(input_files_name, tree_name, calibrate_he3_pt=calibrate_he_momentum, isMC=mc, isH4L=is_h4l,
+                                         columns=columns, n_workers=n_workers, compact=compact)
+    df = select_and_fill(df)
+elif streaming:
+    ## the selected candidates are kept only if they are needed after the histogram filling
+    keep_candidates = not skip_out_tree or do_signal_extraction
+    df = utils.stream_tree(input_files_name, tree_name, step_size=step_size, columns=columns,
+                           process_chunk=lambda chunk: select_and_fill(convert(chunk)), keep_chunks=keep_candidates)
+else:
+    tree_hdl = TreeHandler(input_files_name, tree_name, columns_names=columns, folder_name='DF*')
+    # tree_hdl = TreeHandler(input_files_name, tree_name)
+    df = select_and_fill(convert(tree_hdl.get_data_frame()))
 
-
-# df.query('fAvgClusterSizeHe>4', inplace=True)
-mass_string = 'fMassH3L' if not is_h4l else 'fMassH4L'
-
-############# Fill output histograms #############
-utils.fill_th1_hist(hPtRec, df, 'fPt')
-utils.fill_th1_hist(hCtRec, df, 'fCt')
-utils.fill_th1_hist(hCosPA, df, 'fCosPA')
-utils.fill_th1_hist(hRadius, df, 'fDecRad')
-utils.fill_th1_hist(hDecLen, df, 'fDecLen')
-utils.fill_th1_hist(hNTPCclus, df, 'fNTPCclusHe')
-utils.fill_th2_hist(h2NTPCclusPt, df, 'fPt', 'fNTPCclusHe')
-utils.fill_th1_hist(hNSigHe, df, 'fNSigmaHe')
-utils.fill_th1_hist(hMass3LH, df, 'fMassH3L')
-utils.fill_th1_hist(hMass4LH, df, 'fMassH4L')
-utils.fill_th2_hist(h2Mass3LHVvsMass4LH, df, 'fMassH3L', 'fMassH4L')
-utils.fill_th2_hist(h2MassCosPA, df, 'fCosPA', mass_string)
-utils.fill_th2_hist(h2MassDecLen, df, 'fDecLen', mass_string)
-utils.fill_th2_hist(h2MassDCADaughters, df, 'fDcaV0Daug', mass_string)
-utils.fill_th2_hist(h2MassDCAHePv, df, 'fDcaHe', mass_string)
-utils.fill_th2_hist(h2MassDCAPiPv, df, 'fDcaPi', mass_string)
-utils.fill_th2_hist(h2MassPt, df, 'fPt', mass_string)
-utils.fill_th2_hist(h2Mass4LHnSigmaHe, df, 'fNSigmaHe', mass_string)
-utils.fill_th2_hist(h2NSigHe3VsMom, df, 'fTPCSignMomHe3', 'fNSigmaHe')
-utils.fill_th2_hist(h2NSigHe4VsMom, df, 'fTPCSignMomHe3', 'fNSigmaHe4')
-utils.fill_th2_hist(h2TPCSigHe3VsMom, df, 'fTPCmomHe', 'fTPCsignalHe')
-utils.fill_th2_hist(h2Mass3HLvsPt, df, 'fPt', 'fMassH3L')
-utils.fill_th2_hist(h2Mass4LHvsPt, df, 'fPt', 'fMassH4L')
-
-df.eval('MomDiffHe3 = fTPCmomHe - fPHe3/2', inplace=True)
-utils.fill_th2_hist(hHeMomTPCMinusMomGlo, df, 'fGloSignMomHe3', 'MomDiffHe3')
-
-if 'fITSclusterSizesHe' in df.columns:
-    utils.fill_th1_hist(hClusterSizeHe, df, 'fAvgClusterSizeHe')
-    utils.fill_th1_hist(hClusterSizeHeCosLam, df, 'fAvgClSizeCosLambda')
-    utils.fill_th1_hist(hClusterSizePi, df, 'fAvgClusterSizePi')
-    utils.fill_th2_hist(h2NSigClusSizeHe, df, 'fNSigmaHe', 'fAvgClusterSizeHe')
-    utils.fill_th2_hist(h2TPCSigClusSize, df, 'fAvgClusterSizeHe', 'fTPCsignalHe')
-    utils.fill_th2_hist(h2TPCSigClusSize, df, 'fAvgClusterSizePi', 'fTPCsignalPi')
-    utils.fill_th2_hist(h2ClusSizeVsCosLam, df, 'fCosLambdaHe', 'fAvgClusterSizeHe')
-
-if 'fTrackedClSize' in df.columns:
-    utils.fill_th1_hist(hTrackedClSize, df, 'fTrackedClSize')
-
-if 'fFlags' in df.columns:
-    utils.fill_th1_hist(hHeliumPIDHypo, df, 'fHePIDHypo')
-    utils.fill_th1_hist(hPiPIDHypo, df, 'fPiPIDHypo')
-    df_He_PID = df.query('fHePIDHypo==7')
-    df_Trit_PID = df.query('fHePIDHypo==6')
-    utils.fill_th2_hist(hHeMomTPCMinusMomGloTritHyp, df_Trit_PID, 'fGloSignMomHe3', 'MomDiffHe3')
-    utils.fill_th2_hist(hHeMomTPCMinusMomGloHeHyp, df_He_PID, 'fGloSignMomHe3', 'MomDiffHe3')
-    utils.fill_th2_hist(h2MassPIDHypo, df, 'fHePIDHypo', mass_string)
-
-if 'fV2' in df.columns:
-    utils.fill_th2_hist(h2MassV2, df, mass_string, 'fV2')
+if histo_booker.is_active('h2MassV2'):
+    h2MassV2 = histo_booker['h2MassV2']
     ## fill the mean v2 vs mass starting from the 2D hist
     for i in range(1, h2MassV2.GetNbinsX()+1):
         bin_entries = []
@@ -244,86 +263,27 @@ if 'fV2' in df.columns:
             hMeanV2VsMass.SetBinContent(i, 0)
             hMeanV2VsMass.SetBinError(i, 0)
 
-# for MC only
-if mc:
-    df.eval('resPt = (fPt - fAbsGenPt)/fAbsGenPt', inplace=True)
-    df.eval('ResDecX = (fXDecVtx - fGenXDecVtx)/fGenXDecVtx', inplace=True)
-    df.eval('ResDecY = (fYDecVtx - fGenYDecVtx)/fGenYDecVtx', inplace=True)
-    df.eval('ResDecZ = (fZDecVtx - fGenZDecVtx)/fGenZDecVtx', inplace=True)
-    utils.fill_th1_hist(hResolutionPt, df, 'resPt')
-    utils.fill_th1_hist(hResolutionDecVtxX, df, 'ResDecX')
-    utils.fill_th1_hist(hResolutionDecVtxY, df, 'ResDecY')
-    utils.fill_th1_hist(hResolutionDecVtxZ, df, 'ResDecZ')
-    utils.fill_th2_hist_abs(hResolutionPtvsPt, df, 'fAbsGenPt', 'resPt')
-
 
 # save to file root
 f = ROOT.TFile(f'{output_dir_name}/{output_file_name}.root', 'RECREATE')
 
-
-hPtRec.Write()
-hCtRec.Write()
-hCosPA.Write()
-hRadius.Write()
-hDecLen.Write()
-hNTPCclus.Write()
-h2NTPCclusPt.Write()
-hNSigHe.Write()
-hMass3LH.Write()
-hMass4LH.Write()
-h2MassV2.Write()
+histo_booker.write(f, skip=[] if has_flags else PID_HISTOS)
 hMeanV2VsMass.Write()
-h2MassCosPA.Write()
-h2MassDecLen.Write()
-h2MassDCADaughters.Write()
-h2MassDCAHePv.Write()
-h2MassDCAPiPv.Write()
-h2Mass4LHnSigmaHe.Write()
-h2MassPt.Write()
-h2NSigClusSizePi.Write()
-h2TPCSigClusSize.Write()
-h2NSigHe3VsMom.Write()
-h2TPCSigHe3VsMom.Write()
-h2NSigHe4VsMom.Write()
-hHeMomTPCMinusMomGlo.Write()
-h2Mass3LHVvsMass4LH.Write()
-h2Mass3HLvsPt.Write()
-h2Mass4LHvsPt.Write()
-
-if 'fFlags' in df.columns:
-    hHeliumPIDHypo.Write()
-    hPiPIDHypo.Write()
-    hHeMomTPCMinusMomGloTritHyp.Write()
-    hHeMomTPCMinusMomGloHeHyp.Write()
-    h2MassPIDHypo.Write()
-
-hClusterSizeHe.Write()
-hTrackedClSize.Write()
-hClusterSizeHeCosLam.Write()
-hClusterSizePi.Write()
-h2NSigClusSizeHe.Write()
-h2ClusSizeVsCosLam.Write()
 
 if mc:
-    f.mkdir('MC')
+    gen_histo_booker.write(f)
     f.cd('MC')
-    hResolutionPt.Write()
-    hResolutionPtvsPt.Write()
-    hResolutionDecVtxX.Write()
-    hResolutionDecVtxY.Write()
-    hResolutionDecVtxZ.Write()
-    hPtGen.Write()
-    hCtGen.Write()
-
-    h_eff = hPtRec.Clone('hEfficiencyPt')
+
+    h_eff = histo_booker['hPtRec'].Clone('hEfficiencyPt')
     h_eff.SetTitle(';#it{p}_{T} (GeV/#it{c}); Efficiency')
-    h_eff.Divide(hPtGen)
+    h_eff.Divide(gen_histo_booker['hPtGen'])
     h_eff.Write()
 
-    h_eff_ct = hCtRec.Clone('hEfficiencyCt')
+    h_eff_ct = histo_booker['hCtRec'].Clone('hEfficiencyCt')
     h_eff_ct.SetTitle(';#it{c#tau} (cm); Efficiency')
-    h_eff_ct.Divide(hCtGen)
+    h_eff_ct.Divide(gen_histo_booker['hCtGen'])
     h_eff_ct.Write()
+    f.cd()
 
 
     ### check if the gCt values are repeated
@@ -331,6 +291,9 @@ if mc:
 
 
 if not skip_out_tree:
+    if compact:
+        ## the columns added after the conversion are downcast as well
+        utils.downcast_candidates(df)
     df.to_parquet(f'{output_dir_name}/{output_file_name}.parquet')
 
 
@@ -346,6 +309,7 @@ if do_signal_extraction:
     signal_extraction.performance = False
     signal_extraction.is_3lh = not is_h4l
     signal_extraction.out_file =  sign_extr_dir
+    signal_extraction.fit_backend = fit_backend
     signal_extraction.process_fit()
 f.Close()
 
@@ -0,0 +1,51 @@
+from hipe4ml.tree_handler import TreeHandler
+
+import argparse
+
+import sys
+sys.path.append('..')
+sys.path.append('../utils')
+from signal_extraction import SignalExtraction
+
+## check that the binned invariant-mass fit (binned_fit: True, n_bins_binned_fit bins) gives the signal yield of the unbinned fit
+## of the same candidates: |N_binned - N_unbinned| must stay within tolerance times the statistical uncertainty of the unbinned fit
+
+parser = argparse.ArgumentParser(description='Check the binned invariant-mass fit against the unbinned one.')
+parser.add_argument('--input-parquet-data', dest='input_parquet_data', help='converted data candidates (parquet).', default='../data/data.parquet')
+parser.add_argument('--input-parquet-mc', dest='input_parquet_mc', help='converted MC candidates (parquet), for the signal shape.', default='')
+parser.add_argument('--selection', dest='selection', help='selection (query syntax) of the bin.', default='')
+parser.add_argument('--is-h4l', dest='is_h4l', action='store_true', help='if True fit the H4L mass.')
+parser.add_argument('--signal-fit-func', dest='signal_fit_func', help='signal function.', default='dscb')
+parser.add_argument('--bkg-fit-func', dest='bkg_fit_func', help='background function.', default='pol1')
+parser.add_argument('--n-bins', dest='n_bins', type=int, help='bins of the binned fit.', default=480)
+parser.add_argument('--tolerance', dest='tolerance', type=float, help='maximum difference, in units of the statistical uncertainty.', default=0.15)
+args = parser.parse_args()
+
+data_hdl = TreeHandler(args.input_parquet_data)
+mc_hdl = TreeHandler(args.input_parquet_mc) if args.input_parquet_mc != '' else None
+if args.selection != '':
+    data_hdl.apply_preselections(args.selection)
+    if mc_hdl != None:
+        mc_hdl.apply_preselections(args.selection)
+
+fit_stats = {}
+for binned_fit in [False, True]:
+    signal_extraction = SignalExtraction(data_hdl, mc_hdl)
+    signal_extraction.is_3lh = not args.is_h4l
+    signal_extraction.signal_fit_func = args.signal_fit_func
+    signal_extraction.bkg_fit_func = args.bkg_fit_func
+    signal_extraction.binned_fit = binned_fit
+    signal_extraction.n_bins_binned_fit = args.n_bins
+    signal_extraction.headless = True
+    fit_stats[binned_fit] = signal_extraction.process_fit()
+
+signal, signal_err = fit_stats[False]['signal']
+signal_binned, signal_binned_err = fit_stats[True]['signal']
+diff = abs(signal_binned - signal)
+print(f'Signal (unbinned): {signal:.2f} +/- {signal_err:.2f}, fit time: {fit_stats[False]["fit_time"]:.3f} s')
+print(f'Signal (binned, {args.n_bins} bins): {signal_binned:.2f} +/- {signal_binned_err:.2f}, fit time: {fit_stats[True]["fit_time"]:.3f} s')
+print(f'|dN| / sigma_stat: {diff / signal_err:.4f}, tolerance: {args.tolerance}')
+
+if diff > args.tolerance * signal_err:
+    print('** Binned and unbinned yields differ beyond the tolerance **')
+    sys.exit(1)
@@ -0,0 +1,87 @@
+import numpy as np
+import yaml
+from hipe4ml.tree_handler import TreeHandler
+
+import argparse
+
+import sys
+sys.path.append('..')
+sys.path.append('../utils')
+import utils as utils
+
+## check that the compact schema (utils.CANDIDATE_SCHEMA) does not change the analysis: the selections evaluated on the float32
+## columns can flip the candidates sitting at the cut values, which changes the selected candidates, their mass and ct histograms
+## and the fitted yield; the differences must stay within tolerance times the statistical uncertainty
+
+parser = argparse.ArgumentParser(description='Check the float32 compact candidate table against the double precision one.')
+parser.add_argument('--input-files', dest='input_files', nargs='+', help='path to the input files.', default=['../data/AO2D_merged.root'])
+parser.add_argument('--tree-name', dest='tree_name', help='name of the candidate tree.', default='O2hypcands')
+parser.add_argument('--folder-name', dest='folder_name', help='name of the DF directories.', default='DF*')
+parser.add_argument('--config-file', dest='config_file', help='analyse_tree.py config, its selection is used.', default='')
+parser.add_argument('--selection', dest='selection', help='selection (query syntax), if no config file is given.',
+                    default='fCosPA > 0.998 & fNTPCclusHe > 110 & abs(fDcaHe) > 0.1')
+parser.add_argument('--mc', dest='mc', action='store_true', help='if True the input is MC.')
+parser.add_argument('--is-h4l', dest='is_h4l', action='store_true', help='if True use the H4L mass for ct.')
+parser.add_argument('--tolerance', dest='tolerance', type=float, help='maximum difference, in units of the statistical uncertainty.', default=0.1)
+parser.add_argument('--fit', dest='fit', action='store_true', help='if True compare the fitted signal yields too.')
+args = parser.parse_args()
+
+selection = args.selection
+if args.config_file != '':
+    with open(args.config_file) as config_file:
+        selection = utils.convert_sel_to_string(yaml.full_load(config_file)['selection'])
+print(f'Selection: {selection}')
+
+df = TreeHandler(args.input_files, args.tree_name, folder_name=args.folder_name).get_data_frame()
+df_compact = df.copy()
+utils.correct_and_convert_df(df, isMC=args.mc, isH4L=args.is_h4l)
+utils.correct_and_convert_df(df_compact, isMC=args.mc, isH4L=args.is_h4l, compact=True)
+
+memory = df.memory_usage(deep=True).sum() / 1024**2
+memory_compact = df_compact.memory_usage(deep=True).sum() / 1024**2
+print(f'Candidates: {len(df)}, memory: {memory:.1f} MB (full), {memory_compact:.1f} MB (compact)')
+
+failed = False
+
+
+def check(name, value, value_compact, stat_err):
+    global failed
+    diff = abs(value_compact - value)
+    ok = diff <= args.tolerance * stat_err
+    failed = failed or not ok
+    print(f'{name}: {value:.6g} (full), {value_compact:.6g} (compact), difference {diff:.3g}, '
+          f'tolerance {args.tolerance * stat_err:.3g} -> {"OK" if ok else "FAILED"}')
+
+
+## selected candidates, the rows are the same in the two tables
+selected = np.asarray(df.eval(selection), dtype=bool)
+selected_compact = np.asarray(df_compact.eval(selection), dtype=bool)
+n_flipped = np.count_nonzero(selected != selected_compact)
+print(f'Candidates flipped by the selection: {n_flipped} ({np.count_nonzero(selected & ~selected_compact)} lost, '
+      f'{np.count_nonzero(~selected & selected_compact)} gained)')
+check('Selected candidates', np.count_nonzero(selected), np.count_nonzero(selected_compact), np.sqrt(max(np.count_nonzero(selected), 1)))
+
+## mass and ct histograms after the selection, as in analyse_tree.py
+mass_col = 'fMassH4L' if args.is_h4l else 'fMassH3L'
+histo_specs = {mass_col: [40, 2.96, 3.04] if not args.is_h4l else [32, 3.87, 3.98], 'fCt': [50, 0, 40]}
+for col, (n_bins, low, high) in histo_specs.items():
+    counts, _ = np.histogram(df[col].to_numpy(dtype=np.float64)[selected], bins=n_bins, range=(low, high))
+    counts_compact, _ = np.histogram(df_compact[col].to_numpy(dtype=np.float64)[selected_compact], bins=n_bins, range=(low, high))
+    i_bin = np.argmax(np.abs(counts_compact - counts) / np.sqrt(np.maximum(counts, 1)))
+    check(f'{col} histogram, bin {i_bin}', counts[i_bin], counts_compact[i_bin], np.sqrt(max(counts[i_bin], 1)))
+
+## fitted yield of the selected candidates
+if args.fit:
+    from signal_extraction import SignalExtraction
+    fit_stats = []
+    for df_selected in [df[selected], df_compact[selected_compact]]:
+        signal_extraction = SignalExtraction(df_selected)
+        signal_extraction.is_3lh = not args.is_h4l
+        signal_extraction.signal_fit_func = 'gaus'
+        signal_extraction.bkg_fit_func = 'pol1'
+        signal_extraction.headless = True
+        fit_stats.append(signal_extraction.process_fit())
+    check('Signal yield', fit_stats[0]['signal'][0], fit_stats[1]['signal'][0], fit_stats[0]['signal'][1])
+
+if failed:
+    sys.exit(1)
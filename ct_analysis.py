@@ -10,8 +10,6 @@ import numpy as np
 import uproot
 import argparse
 import yaml
-from itertools import product
-from hipe4ml.tree_handler import TreeHandler
 import copy
 
 
@@ -19,6 +17,8 @@ import sys
 sys.path.append('utils')
 import utils as utils
 from spectra import SpectraMaker
+from cut_masks import get_threshold_grid
+from fit_store import FitResultStore
 
 
 if __name__ == '__main__':
@@ -49,6 +49,29 @@ if __name__ == '__main__':
     n_bins_mass_data = config['n_bins_mass_data']
     n_bins_mass_mc = config['n_bins_mass_mc']
 
+    streaming = config.get('streaming', False)
+    step_size = config.get('step_size', '100 MB')
+    n_workers = config.get('n_workers', 1)
+    cache_dir = config.get('cache_dir')
+    cache_max_size_gb = config.get('cache_max_size_gb', 50)
+    column_projection = config.get('column_projection', False)
+    compact = config.get('compact', False)
+    binned_fit = config.get('binned_fit', 'auto')
+    binned_fit_threshold = config.get('binned_fit_threshold', 20000)
+    n_bins_binned_fit = config.get('n_bins_binned_fit', 480)
+    mc_fit_cache_dir = config.get('mc_fit_cache_dir')
+    fit_store_path = config.get('fit_store')
+    fit_store_frames = config.get('fit_store_frames', False)
+    n_workers_syst = config.get('n_workers_syst', 1)
+    syst_seed = config.get('syst_seed', 42)
+    mc_weights = config.get('mc_weights', False)
+    mc_weight_col = utils.PT_WEIGHT_COLUMN if mc_weights else None
+    simultaneous_fit = config.get('simultaneous_fit', False)
+    shared_signal_pars = config.get('shared_signal_pars', [])
+    n_cpu_simultaneous_fit = config.get('n_cpu_simultaneous_fit', 1)
+    headless_trials = config.get('headless_trials', False)
+    fit_backend = config.get('fit_backend')
+
     matter_options = ['matter', 'antimatter', 'both']
     if is_matter not in matter_options:
         raise ValueError(f'Invalid is-matter option. Expected one of: {matter_options}')
@@ -67,20 +90,8 @@ if __name__ == '__main__':
                 tree_name = tree
                 break
     print(f"Data tree found: {tree_name}")
-    data_hdl = TreeHandler(input_file_name_data, tree_name, folder_name='DF')
-    mc_hdl = TreeHandler(input_file_name_mc, 'O2mchypcands', folder_name='DF')
 
-    lifetime_dist = ROOT.TH1D('syst_lifetime', ';#tau ps ;Counts', 40, 120, 380)
-    lifetime_prob = ROOT.TH1D('prob_lifetime', ';prob. ;Counts', 100, 0, 1)
-
-    # declare output file
-    output_file = ROOT.TFile.Open(f'{output_dir_name}/{output_file_name}.root', 'recreate')
-
-    # Add columns to the handlers
-    utils.correct_and_convert_df(data_hdl, calibrate_he3_pt=True)
-    utils.correct_and_convert_df(mc_hdl, calibrate_he3_pt=True, isMC=True)
-
-    # apply preselections
+    # matter selections, applied while reading the trees
     matter_sel = ''
     mc_matter_sel = ''
     if is_matter == 'matter':
@@ -91,15 +102,34 @@ if __name__ == '__main__':
         matter_sel = 'fIsMatter == False'
         mc_matter_sel = 'fGenPt < 0'
 
-    if matter_sel != '':
-        data_hdl.apply_preselections(matter_sel)
-        mc_hdl.apply_preselections(mc_matter_sel)
+    data_columns = None
+    mc_columns = None
+    if column_projection:
+        used_expressions = [selections_std, matter_sel, mc_matter_sel, ['fIsReco', 'fMassH3L']]
+        if do_syst:
+            used_expressions.append(list(config['cut_dict_syst'].keys()))
+        data_columns = utils.get_needed_columns(input_file_name_data, tree_name, used_expressions, folder_name='DF', calibrate_he3_pt=True)
+        mc_columns = utils.get_needed_columns(input_file_name_mc, 'O2mchypcands', used_expressions, folder_name='DF', calibrate_he3_pt=True, isMC=True)
+
+    # read the trees, add columns to the handlers and apply preselections
+    data_hdl = utils.get_tree_handler(input_file_name_data, tree_name, folder_name='DF', streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                      cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact,
+                                      preselections=matter_sel, calibrate_he3_pt=True, columns=data_columns)
+    mc_hdl = utils.get_tree_handler(input_file_name_mc, 'O2mchypcands', folder_name='DF', streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                    cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact,
+                                    preselections=mc_matter_sel, calibrate_he3_pt=True, isMC=True, columns=mc_columns)
+
+    lifetime_dist = ROOT.TH1D('syst_lifetime', ';#tau ps ;Counts', 40, 120, 380)
+    lifetime_prob = ROOT.TH1D('prob_lifetime', ';prob. ;Counts', 100, 0, 1)
+
+    # declare output file
+    output_file = ROOT.TFile.Open(f'{output_dir_name}/{output_file_name}.root', 'recreate')
 
     # reweight MC pT spectrum
     spectra_file = ROOT.TFile.Open('utils/heliumSpectraMB.root')
     he3_spectrum = spectra_file.Get('fCombineHeliumSpecLevyFit_0-100')
     spectra_file.Close()
-    utils.reweight_pt_spectrum(mc_hdl, 'fAbsGenPt', he3_spectrum)
+    utils.reweight_pt_spectrum(mc_hdl, 'fAbsGenPt', he3_spectrum, weight_col=mc_weight_col)
 
     mc_hdl.apply_preselections('rej==True')
     mc_reco_hdl = mc_hdl.apply_preselections('fIsReco == 1', inplace=False)
@@ -130,6 +160,17 @@ if __name__ == '__main__':
     spectra_maker.n_bins_mass_data = n_bins_mass_data
     spectra_maker.n_bins_mass_mc = n_bins_mass_mc
     spectra_maker.sigma_range_mc_to_data = sigma_range_mc_to_data
+    spectra_maker.binned_fit = binned_fit
+    spectra_maker.binned_fit_threshold = binned_fit_threshold
+    spectra_maker.n_bins_binned_fit = n_bins_binned_fit
+    spectra_maker.mc_fit_cache_dir = mc_fit_cache_dir
+    spectra_maker.mc_weight_col = mc_weight_col
+    spectra_maker.simultaneous_fit = simultaneous_fit
+    spectra_maker.shared_signal_pars = shared_signal_pars
+    spectra_maker.n_cpu_simultaneous_fit = n_cpu_simultaneous_fit
+    spectra_maker.fit_backend = fit_backend
+    if fit_store_path is not None:
+        spectra_maker.fit_store = FitResultStore(fit_store_path, fit_store_frames)
 
     spectra_maker.output_dir = output_dir_std
 
@@ -185,64 +226,61 @@ if __name__ == '__main__':
             for cut in cut_arr:
                 cut_string_dict[var].append(var + cut_greater_string + str(cut))
 
+        # the reconstructed MC passing the varied thresholds is counted from a cumulative histogram
+        spectra_maker.threshold_grid = get_threshold_grid(cut_dict_syst)
+
         cut_string_dict['signal_fit_func'] = signal_fit_func_syst
         cut_string_dict['bkg_fit_func'] = bkg_fit_func_syst
-        combos = list(product(*list(cut_string_dict.values())))
+        option_lists = list(cut_string_dict.values())
 
-        if n_trials < len(combos):
-            combo_random_indices = np.random.randint(len(combos), size=(n_trials, len(ct_bins) - 1))
-        else:
-            print(f"** Warning: n_trials > n_combinations ({n_trials}, {len(combos)}), taking all the possible combinations **")
-            indices = np.arange(len(combos))
-            ## create a (len(combos), len(ct_bins) - 1) array with the indices repeated for each ct bin
-            combo_random_indices = np.repeat(indices[:, np.newaxis], len(ct_bins) - 1, axis=1)
-            ## now shuffle each column of the array
-            for i in range(combo_random_indices.shape[1]):
-                np.random.shuffle(combo_random_indices[:, i])
+        ## in each bin the combinations are drawn without replacement, so all the planned trials are distinct
+        combo_random_indices = utils.plan_trials(option_lists, len(ct_bins) - 1, n_trials, syst_seed)
+        n_combos = int(np.prod([len(options) for options in option_lists]))
+        if n_trials > n_combos:
+            print(f"** Warning: n_trials > n_combinations ({n_trials}, {n_combos}), taking all the possible combinations **")
+        print(f'** {len(combo_random_indices)} trials planned **')
 
-        combo_check_map = {}
+        ## the trials are planned here and run, possibly in parallel, afterwards
+        trials = []
+        trial_headers = []
 
         for i_combo, combo_indices in enumerate(combo_random_indices):
-            trial_strings.append("----------------------------------")
+            trial_header = ["----------------------------------"]
             trial_num_string = f'Trial: {i_combo} / {len(combo_random_indices)}'
-            trial_strings.append(trial_num_string)
-            print(trial_num_string)
+            trial_header.append(trial_num_string)
+            trial_headers.append(trial_header)
 
             cut_selection_list = []
             bkg_fit_func_list = []
             signal_fit_func_list = []
 
             for ict in range(len(ct_bins) - 1):
-                combo = combos[combo_indices[ict]]
-                ct_bin = [ct_bins[ict], ct_bins[ict + 1]]
-                full_combo_string = f'ct {ct_bin[0]}_{ct_bin[1]} | '
-                full_combo_string += " & ".join(combo)
+                combo = utils.get_combo(option_lists, combo_indices[ict])
 
                 ### extract a signal and a background fit function
                 sel_string = " & ".join(combo[: -2])
                 signal_fit_func = combo[-2]
                 bkg_fit_func = combo[-1]
 
-                if full_combo_string in combo_check_map:
-                    break
-
-                combo_check_map[full_combo_string] = True
-
                 cut_selection_list.append(sel_string)
                 bkg_fit_func_list.append(bkg_fit_func)
                 signal_fit_func_list.append(signal_fit_func)
 
-            if len(cut_selection_list) != len(ct_bins) - 1:
-                continue
+            trial_header.append(str(cut_selection_list))
+            trial_header.append(str(bkg_fit_func_list))
+            trial_header.append(str(signal_fit_func_list))
+            trials.append([i_combo, cut_selection_list, bkg_fit_func_list, signal_fit_func_list])
 
-            trial_strings.append(str(cut_selection_list))
-            trial_strings.append(str(bkg_fit_func_list))
-            trial_strings.append(str(signal_fit_func_list))
+        def run_trial(trial, trial_dir):
+            i_combo, cut_selection_list, bkg_fit_func_list, signal_fit_func_list = trial
+            print(f'Trial: {i_combo} / {len(combo_random_indices)}')
 
             ### make_spectra
             spectra_maker.selection_string = cut_selection_list
             spectra_maker.inv_mass_signal_func = signal_fit_func_list
             spectra_maker.inv_mass_bkg_func = bkg_fit_func_list
+            spectra_maker.output_dir = trial_dir
+            spectra_maker.headless_fits = headless_trials
 
             spectra_maker.make_spectra()
             spectra_maker.make_histos()
@@ -253,17 +291,27 @@ if __name__ == '__main__':
             expo.FixParameter(0, spectra_maker.h_corrected_counts.Integral(start_bin, end_bin, "width"))
             spectra_maker.fit()
 
-            res_string = "Lifetime: " + str(spectra_maker.fit_func.GetParameter(1)) + " +- " + str(spectra_maker.fit_func.GetParError(1)) + " Prob: " + str(spectra_maker.fit_func.GetProb())
-            trial_strings.append(res_string)
-
-            if spectra_maker.fit_func.GetProb() > 0.15:
-                trial_dir = output_dir_syst.mkdir(f'trial_{i_combo}')
-                spectra_maker.output_dir = trial_dir
+            trial_result = {'i_combo': i_combo,
+                            'res_string': "Lifetime: " + str(spectra_maker.fit_func.GetParameter(1)) + " +- " + str(spectra_maker.fit_func.GetParError(1)) + " Prob: " + str(spectra_maker.fit_func.GetProb()),
+                            'selected': spectra_maker.fit_func.GetProb() > 0.15,
+                            'lifetime': spectra_maker.fit_func.GetParameter(1),
+                            'prob': spectra_maker.fit_func.GetProb()}
+            if trial_result['selected']:
                 spectra_maker.dump_to_output_dir()
-                lifetime_dist.Fill(spectra_maker.fit_func.GetParameter(1))
-                lifetime_prob.Fill(spectra_maker.fit_func.GetProb())
 
             spectra_maker.del_dyn_members()
+            return trial_result
+
+        ## each trial is written to output_dir_syst as soon as it is done (only the selected ones are kept), the results are merged in the trial order
+        for trial_result in utils.run_trials(run_trial, trials, output_dir_syst, [f'trial_{trial[0]}' for trial in trials], n_workers_syst,
+                                             keep=lambda trial_result: trial_result['selected']):
+            trial_headers[trial_result['i_combo']].append(trial_result['res_string'])
+            if trial_result['selected']:
+                lifetime_dist.Fill(trial_result['lifetime'])
+                lifetime_prob.Fill(trial_result['prob'])
+
+        for trial_header in trial_headers:
+            trial_strings += trial_header
 
     # fitting lifetime distributions
     fit_func = ROOT.TF1('fit_func', 'gaus', 120, 380)
@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+import re
+
+
+## split a selection string (query syntax) into its elementary cuts, e.g. 'fCosPA > 0.998 & fNTPCclusHe > 110 and abs(fDcaHe) > 0.1'
+## selections with a top-level 'or' / '|' are not split
+def split_selection(selection):
+    cuts = []
+    depth = 0
+    start = 0
+    i_char = 0
+    has_or = False
+    while i_char < len(selection):
+        char = selection[i_char]
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0:
+            if char == '|' or selection.startswith(' or ', i_char):
+                has_or = True
+            elif char == '&':
+                cuts.append(selection[start:i_char])
+                start = i_char + 1
+            elif selection.startswith(' and ', i_char):
+                cuts.append(selection[start:i_char])
+                i_char += len(' and ')
+                start = i_char
+                continue
+        i_char += 1
+    cuts.append(selection[start:])
+
+    if has_or:
+        return [normalise_cut(selection)]
+    return [normalise_cut(cut) for cut in cuts if cut.strip() != '']
+
+
+def normalise_cut(cut):
+    ## remove spaces and the parentheses around the whole cut, so that the same cut written differently is evaluated once
+    cut = ' '.join(cut.split())
+    while cut.startswith('(') and cut.endswith(')'):
+        depth = 0
+        for i_char, char in enumerate(cut):
+            depth += 1 if char == '(' else -1 if char == ')' else 0
+            if depth == 0 and i_char < len(cut) - 1:
+                return cut
+        cut = cut[1:-1].strip()
+    return cut
+
+
+## one-sided threshold cut, e.g. 'fCosPA > 0.998', returns (variable, '>' or '<', threshold) or None
+THRESHOLD_CUT_REGEX = re.compile(r'^(\w+)\s*([<>])\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)$')
+
+
+def parse_threshold_cut(cut):
+    match = THRESHOLD_CUT_REGEX.match(cut)
+    if match is None:
+        return None
+    return match.group(1), match.group(2), float(match.group(3))
+
+
+def get_threshold_grid(cut_dict_syst):
+    ## thresholds of the systematic variations, as generated from cut_dict_syst in the analysis scripts
+    threshold_grid = {}
+    for var, var_dict in cut_dict_syst.items():
+        op = '>' if var_dict['cut_greater'] else '<'
+        cut_list = var_dict['cut_list']
+        threshold_grid[(var, op)] = np.unique(np.linspace(cut_list[0], cut_list[1], cut_list[2]))
+    return threshold_grid
+
+
+## number of candidates passing any combination of thresholds on the scanned variables:
+## the candidates are histogrammed in the ranks of their values among the thresholds (see CutMaskCache.get_ranks),
+## the histogram is integrated along each axis once and each count is then a single lookup
+## weights: optional per-candidate weights (for all the rows of the dataframe), the counts are then sums of weights
+class ThresholdCounter:
+
+    def __init__(self, mask_cache, positions, weights=None):
+        self.threshold_grid = mask_cache.threshold_grid
+        self.dims = list(self.threshold_grid.keys())
+        self.weighted = weights is not None
+        shape = [len(self.threshold_grid[dim]) + 1 for dim in self.dims]
+        flat_ranks = np.ravel_multi_index([mask_cache.get_ranks(dim)[positions] for dim in self.dims], shape)
+        counts = np.bincount(flat_ranks, weights=weights[positions] if self.weighted else None,
+                             minlength=int(np.prod(shape))).reshape(shape)
+        for axis, dim in enumerate(self.dims):
+            if dim[1] == '>':
+                counts = np.flip(np.cumsum(np.flip(counts, axis), axis=axis), axis)
+            else:
+                counts = np.cumsum(counts, axis=axis)
+        self.cumulative_counts = counts
+
+    def count(self, grid_indices):
+        index = []
+        for dim in self.dims:
+            n_thresholds = len(self.threshold_grid[dim])
+            if dim not in grid_indices:
+                index.append(0 if dim[1] == '>' else n_thresholds)
+            else:
+                index.append(grid_indices[dim] + 1 if dim[1] == '>' else grid_indices[dim])
+        count = self.cumulative_counts[tuple(index)]
+        return float(count) if self.weighted else int(count)
+
+
+## cache of the elementary cuts of a dataframe: each cut is evaluated once and stored as a packed bitset,
+## the mask of a selection is the AND of the masks of its cuts
+## threshold_grid: optional {(variable, '>' or '<'): thresholds} of a threshold scan (see get_threshold_grid),
+## the cuts on the grid are computed from the ranks of the values and can be counted without building the masks
+class CutMaskCache:
+
+    def __init__(self, df, threshold_grid=None, max_counter_cells=10_000_000):
+        self.df = df
+        self.n_rows = len(df)
+        self.packed_masks = {}
+        self.threshold_grid = threshold_grid if threshold_grid is not None else {}
+        self.max_counter_cells = max_counter_cells
+        self.ranks = {}
+        self.counters = {}
+        self.weights = {}
+
+    def get_grid_index(self, cut):
+        ## (dimension, threshold index) if the cut is on the threshold grid, None otherwise
+        parsed_cut = parse_threshold_cut(cut)
+        if parsed_cut is None or (parsed_cut[0], parsed_cut[1]) not in self.threshold_grid:
+            return None
+        dim = (parsed_cut[0], parsed_cut[1])
+        thresholds = self.threshold_grid[dim]
+        index = np.searchsorted(thresholds, parsed_cut[2])
+        if index == len(thresholds) or thresholds[index] != parsed_cut[2]:
+            return None
+        return dim, int(index)
+
+    def get_ranks(self, dim):
+        ## rank of each candidate among the sorted thresholds: the candidate passes the threshold j if rank > j for '>',
+        ## if rank <= j for '<', NaN values never pass
+        if dim not in self.ranks:
+            var, op = dim
+            values = (self.df[var] if var in self.df.columns else self.df.eval(var)).to_numpy(dtype=np.float64)
+            thresholds = self.threshold_grid[dim]
+            if op == '>':
+                ranks = np.searchsorted(thresholds, values, side='left')
+                ranks[np.isnan(values)] = 0
+            else:
+                ranks = np.searchsorted(thresholds, values, side='right')
+                ranks[np.isnan(values)] = len(thresholds)
+            self.ranks[dim] = ranks.astype(np.int32)
+        return self.ranks[dim]
+
+    def get_weights(self, weight_col):
+        if weight_col not in self.weights:
+            self.weights[weight_col] = self.df[weight_col].to_numpy(dtype=np.float64)
+        return self.weights[weight_col]
+
+    def get_packed_mask(self, cut):
+        if cut not in self.packed_masks:
+            grid_index = self.get_grid_index(cut)
+            if grid_index is not None:
+                dim, index = grid_index
+                mask = self.get_ranks(dim) > index if dim[1] == '>' else self.get_ranks(dim) <= index
+            else:
+                mask = np.asarray(self.df.eval(cut), dtype=bool)
+            self.packed_masks[cut] = np.packbits(mask)
+        return self.packed_masks[cut]
+
+    def count(self, selection, positions=None, positions_key=None, weight_col=None):
+        ## number of candidates (among positions, if given) passing the selection, sum of their weight_col if given
+        ## the cuts on the threshold grid are counted with a ThresholdCounter, built once for each positions_key and set of other cuts
+        grid_indices = {}
+        other_cuts = []
+        use_counter = positions_key is not None or positions is None
+        for cut in split_selection(selection):
+            grid_index = self.get_grid_index(cut)
+            if grid_index is None:
+                other_cuts.append(cut)
+            elif grid_index[0] in grid_indices:
+                use_counter = False
+            else:
+                grid_indices[grid_index[0]] = grid_index[1]
+        n_cells = np.prod([len(thresholds) + 1 for thresholds in self.threshold_grid.values()])
+        if not use_counter or len(grid_indices) == 0 or n_cells > self.max_counter_cells:
+            mask = self.get_mask(selection)
+            if positions is not None:
+                mask = mask[positions]
+            if weight_col is None:
+                return int(np.count_nonzero(mask))
+            weights = self.get_weights(weight_col)
+            return float(np.sum((weights if positions is None else weights[positions])[mask]))
+
+        counter_key = (positions_key, weight_col, tuple(sorted(other_cuts)))
+        if counter_key not in self.counters:
+            counter_positions = np.arange(self.n_rows) if positions is None else positions
+            if len(other_cuts) > 0:
+                counter_positions = counter_positions[self.get_mask(' & '.join(other_cuts))[counter_positions]]
+            self.counters[counter_key] = ThresholdCounter(self, counter_positions, self.get_weights(weight_col) if weight_col is not None else None)
+        return self.counters[counter_key].count(grid_indices)
+
+    def get_mask(self, selection):
+        cuts = split_selection(selection)
+        if len(cuts) == 0:
+            return np.ones(self.n_rows, dtype=bool)
+        packed_mask = self.get_packed_mask(cuts[0]).copy()
+        for cut in cuts[1:]:
+            np.bitwise_and(packed_mask, self.get_packed_mask(cut), out=packed_mask)
+        return np.unpackbits(packed_mask, count=self.n_rows).astype(bool)
+
+    def select(self, selection):
+        return self.df[self.get_mask(selection)]
+
+
+## one cache per dataframe, the caches can be shared by several SpectraMaker
+def get_cut_mask_cache(caches, df, threshold_grid=None):
+    if not type(df) == pd.DataFrame:
+        df = df.get_data_frame()
+    cache = caches[id(df)] if id(df) in caches else None
+    if cache is None or cache.df is not df or cache.n_rows != len(df) or (threshold_grid is not None and cache.threshold_grid is not threshold_grid):
+        caches[id(df)] = CutMaskCache(df, threshold_grid)
+    return caches[id(df)]
@@ -1,4 +1,3 @@
-from hipe4ml.tree_handler import TreeHandler
 import yaml
 import argparse
 import uproot
@@ -40,6 +39,15 @@ selections = config['selection']
 is_matter = config['is_matter']
 calibrate_he_momentum = config['calibrate_he_momentum']
 
+streaming = config.get('streaming', False)
+step_size = config.get('step_size', '100 MB')
+n_workers = config.get('n_workers', 1)
+cache_dir = config.get('cache_dir')
+cache_max_size_gb = config.get('cache_max_size_gb', 50)
+column_projection = config.get('column_projection', False)
+compact = config.get('compact', False)
+fit_backend = config.get('fit_backend')
+
 selections_string = utils.convert_sel_to_string(selections)
 
 if is_matter == 'matter':
@@ -56,14 +64,25 @@ for tree in tree_names:
             tree_name = tree
             break
 
-data_hdl = TreeHandler(input_file_name_data, tree_name, folder_name='DF*')
-mc_hdl_h3l_full = TreeHandler(input_file_name_mc_h3l, 'O2mchypcands', folder_name='DF*')
-mc_hdl_h4l_full = TreeHandler(input_file_name_mc_h4l, 'O2mchypcands', folder_name='DF*')
-
-# Add columns to the handlers
-utils.correct_and_convert_df(data_hdl, calibrate_he3_pt=calibrate_he_momentum, isMC=False)
-utils.correct_and_convert_df(mc_hdl_h3l_full, calibrate_he3_pt=calibrate_he_momentum, isMC=True)
-utils.correct_and_convert_df(mc_hdl_h4l_full, calibrate_he3_pt=calibrate_he_momentum, isMC=True)
+data_columns = None
+mc_h3l_columns = None
+mc_h4l_columns = None
+if column_projection:
+    used_expressions = [selections_string, ['fIsReco', 'fMassH3L', 'fMassH4L', 'fNSigmaHe3', 'fNSigmaHe4']]
+    data_columns = utils.get_needed_columns(input_file_name_data, tree_name, used_expressions, calibrate_he3_pt=calibrate_he_momentum)
+    mc_h3l_columns = utils.get_needed_columns(input_file_name_mc_h3l, 'O2mchypcands', used_expressions, calibrate_he3_pt=calibrate_he_momentum, isMC=True)
+    mc_h4l_columns = utils.get_needed_columns(input_file_name_mc_h4l, 'O2mchypcands', used_expressions, calibrate_he3_pt=calibrate_he_momentum, isMC=True)
+
+# read the trees and add columns to the handlers, the data selections are applied while reading
+data_hdl = utils.get_tree_handler(input_file_name_data, tree_name, streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                  cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact, preselections=selections_string,
+                                  calibrate_he3_pt=calibrate_he_momentum, isMC=False, columns=data_columns)
+mc_hdl_h3l_full = utils.get_tree_handler(input_file_name_mc_h3l, 'O2mchypcands', streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                         cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact,
+                                         calibrate_he3_pt=calibrate_he_momentum, isMC=True, columns=mc_h3l_columns)
+mc_hdl_h4l_full = utils.get_tree_handler(input_file_name_mc_h4l, 'O2mchypcands', streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                         cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact,
+                                         calibrate_he3_pt=calibrate_he_momentum, isMC=True, columns=mc_h4l_columns)
 
 ## reweight the pt spectrum of the MCs  
 if colliding_system == 'pp':
@@ -97,7 +116,6 @@ th2_n_sigma_he4_pt_mc = ROOT.TH2D('n_sigma_he4_pt_mc', 'n_sigma_he4_pt_mc', 100,
 
 
 ## apply the selections
-data_hdl.apply_preselections(selections_string)
 mc_hdl_h3l.apply_preselections(selections_string)
 mc_hdl_h4l.apply_preselections(selections_string)
 
@@ -132,7 +150,8 @@ n1_h3l = ROOT.RooRealVar('n1_h3l', 'n1_h3l', 0., 5.)
 n2_h3l = ROOT.RooRealVar('n2_h3l', 'n2_h3l', 0., 5.)
 pars_h3l = [mu3HL, sigma_h3l, a1_h3l, a2_h3l, n1_h3l, n2_h3l]
 signal_h3l = ROOT.RooCrystalBall('cb_h3l', 'cb_h3l_cl', mass3HL, mu3HL, sigma_h3l, a1_h3l, n1_h3l, a2_h3l, n2_h3l)
-signal_h3l.fitTo(mass_roo_mc_h3l, ROOT.RooFit.Extended(True))
+_, fit_time = utils.fit_to(signal_h3l, mass_roo_mc_h3l, [ROOT.RooFit.Extended(True)], fit_backend)
+print(f'H3L MC fit time: {fit_time:.3f} s')
 frame_h3l = mass3HL.frame()
 frame_h3l.SetName('frame_h3l_mc')
 mass_roo_mc_h3l.plotOn(frame_h3l)
@@ -146,7 +165,8 @@ n1_h4l = ROOT.RooRealVar('n1_h4l', 'n1_h4l', 0., 5.)
 n2_h4l = ROOT.RooRealVar('n2_h4l', 'n2_h4l', 0., 5.)
 pars_h4l = [mu4HL, sigma_h4l, a1_h4l, a2_h4l, n1_h4l, n2_h4l]
 signal_h4l = ROOT.RooCrystalBall('cb_h4l', 'cb_h4l_cl', mass4HL, mu4HL, sigma_h4l, a1_h4l, n1_h4l, a2_h4l, n2_h4l)
-signal_h4l.fitTo(mass_roo_mc_h4l, ROOT.RooFit.Extended(True))
+_, fit_time = utils.fit_to(signal_h4l, mass_roo_mc_h4l, [ROOT.RooFit.Extended(True)], fit_backend)
+print(f'H4L MC fit time: {fit_time:.3f} s')
 frame_h4l = mass4HL.frame()
 frame_h4l.SetName('frame_h4l_mc')
 mass_roo_mc_h4l.plotOn(frame_h4l)
@@ -221,7 +241,8 @@ roosim = ROOT.RooSimultaneous('roosim', 'roosim', categories)
 roosim.addPdf(model_h3l, 'h3l')
 roosim.addPdf(model_h4l, 'h4l')
 
-fit_results = roosim.fitTo(data, ROOT.RooFit.Extended(True), ROOT.RooFit.Save(True))
+fit_results, fit_time = utils.fit_to(roosim, data, [ROOT.RooFit.Extended(True), ROOT.RooFit.Save(True)], fit_backend)
+print(f'Simultaneous H3L + H4L fit time: {fit_time:.3f} s ({data.numEntries()} candidates)')
 
 ## print the values of all the parameters
 br_h3l = 0.25
@@ -0,0 +1,52 @@
+import json
+import os
+import pickle
+import sqlite3
+import time
+
+
+## persistent store of the invariant-mass fit results, shared by the analysis scripts and by the processes running the trials
+## the fits are keyed on SignalExtraction.get_fit_key (fit settings, fit code and content of the data and MC samples),
+## the fit_stats are stored as json and, with store_frames, the frames as pickled ROOT objects
+class FitResultStore:
+
+    def __init__(self, path, store_frames=False, timeout=60.):
+        self.path = path
+        self.store_frames = store_frames
+        self.timeout = timeout
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, label TEXT, fit_stats TEXT, frames BLOB, created REAL)')
+
+    def _execute(self, query, args=()):
+        ## a new connection for each access, so that the store can be used from forked processes
+        connection = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with connection:
+                return connection.execute(query, args).fetchall()
+        finally:
+            connection.close()
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM fits')[0][0]
+
+    def __contains__(self, key):
+        return len(self._execute('SELECT 1 FROM fits WHERE key = ?', (key,))) > 0
+
+    def get(self, key):
+        ## (fit_stats, frames) of a stored fit (frames is None if they were not stored), None if the fit is not in the store
+        rows = self._execute('SELECT fit_stats, frames FROM fits WHERE key = ?', (key,))
+        if len(rows) == 0:
+            return None
+        fit_stats, frames = rows[0]
+        return json.loads(fit_stats), pickle.loads(frames) if frames is not None else None
+
+    def put(self, key, fit_stats, frames=None, label=''):
+        frames_blob = None
+        if self.store_frames and frames is not None:
+            frames_blob = pickle.dumps([frame for frame in frames if frame is not None])
+        self._execute('INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?)', (key, label, json.dumps(fit_stats), frames_blob, time.time()))
+
+    def get_labels(self):
+        ## {key: label} of the stored fits, e.g. to inspect the store
+        return dict(self._execute('SELECT key, label FROM fits'))
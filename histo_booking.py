@@ -0,0 +1,131 @@
+import ROOT
+import numpy as np
+import pandas as pd
+
+import sys
+sys.path.append('utils')
+import utils as utils
+
+## book and fill many histograms in a single pass over the candidates
+## each spec is a dict (python or yaml) with the following keys:
+##   name: histogram name, the same name can appear in several specs to fill the same histogram more than once
+##   title: histogram title (axis labels included)
+##   bins: [n, low, high] for the x axis
+##   y_bins: [n, low, high] for the y axis, books a TH2F
+##   x, y: column names or df.eval expressions, a spec without x only books the histogram
+##   sel: optional sub-selection (query syntax) applied before filling
+##   weight: optional column name or expression used as weight, default_weight (e.g. the MC weights) is used if not set
+##   requires: optional list of columns, the spec is not filled if any of them is missing (the histogram is still written)
+##   dir: optional output sub-directory
+class HistoBooker:
+
+    def __init__(self, specs=None, chunk_size=1_000_000, default_weight=None):
+
+        self.histos = {}
+        self.out_dirs = {}
+        self.fill_rules = []
+        self.chunk_size = chunk_size
+        self.default_weight = default_weight
+        ## names of the histograms with at least one fill rule whose requirements are met
+        self.active_histos = set()
+
+        if specs is not None:
+            for spec in specs:
+                self.book(spec)
+
+    def __getitem__(self, name):
+        return self.histos[name]
+
+    def book(self, spec):
+        name = spec['name']
+        if name not in self.histos:
+            title = spec.get('title', '')
+            x_bins = spec['bins']
+            if 'y_bins' in spec:
+                y_bins = spec['y_bins']
+                hist = ROOT.TH2F(name, title, int(x_bins[0]), x_bins[1], x_bins[2], int(y_bins[0]), y_bins[1], y_bins[2])
+            else:
+                hist = ROOT.TH1F(name, title, int(x_bins[0]), x_bins[1], x_bins[2])
+            hist.SetDirectory(0)
+            self.histos[name] = hist
+            self.out_dirs[name] = spec.get('dir', '')
+
+        if 'x' in spec:
+            self.fill_rules.append({'name': name,
+                                    'x': spec['x'],
+                                    'y': spec.get('y', None),
+                                    'sel': spec.get('sel', ''),
+                                    'weight': spec.get('weight', None),
+                                    'requires': spec.get('requires', [])})
+        return self.histos[name]
+
+    def fill(self, df):
+        if not type(df) == pd.DataFrame:
+            df = df._full_data_frame
+        active_rules = []
+        for rule in self.fill_rules:
+            if any(col not in df.columns for col in rule['requires']):
+                continue
+            self.active_histos.add(rule['name'])
+            active_rules.append(rule)
+
+        for start in range(0, len(df), self.chunk_size):
+            self._fill_chunk(df.iloc[start:start + self.chunk_size], active_rules)
+
+    def _fill_chunk(self, df, fill_rules):
+        ## expressions and selections shared by several histograms are evaluated once per chunk
+        expr_cache = {}
+        sel_cache = {}
+
+        def evaluate(expr):
+            if expr not in expr_cache:
+                if expr in df.columns:
+                    expr_cache[expr] = df[expr].to_numpy()
+                else:
+                    expr_cache[expr] = np.asarray(df.eval(expr))
+            return expr_cache[expr]
+
+        def select(sel):
+            if sel not in sel_cache:
+                sel_cache[sel] = np.asarray(df.eval(sel), dtype=bool)
+            return sel_cache[sel]
+
+        for rule in fill_rules:
+            x = evaluate(rule['x'])
+            y = evaluate(rule['y']) if rule['y'] is not None else None
+            weight = rule['weight'] if rule['weight'] is not None else self.default_weight
+            w = evaluate(weight) if weight is not None else None
+            if rule['sel'] != '':
+                mask = select(rule['sel'])
+                x = x[mask]
+                y = y[mask] if y is not None else None
+                w = w[mask] if w is not None else None
+            utils.fill_hist_arrays(self.histos[rule['name']], x, y, w)
+
+    def get_expressions(self):
+        ## everything evaluated on the candidates, used to work out the branches to be read
+        expressions = []
+        for rule in self.fill_rules:
+            expressions += [rule['x'], rule['sel']] + rule['requires']
+            expressions += [expr for expr in (rule['y'], rule['weight']) if expr is not None]
+        return expressions
+
+    def is_active(self, name):
+        has_rules = any(rule['name'] == name for rule in self.fill_rules)
+        return not has_rules or name in self.active_histos
+
+    def write(self, out_dir, skip=()):
+        ## all the booked histograms are written, empty or not, except the ones in skip
+        for name, hist in self.histos.items():
+            if name in skip:
+                continue
+            sub_dir_name = self.out_dirs[name]
+            if sub_dir_name == '':
+                out_dir.cd()
+            else:
+                sub_dir = out_dir.GetDirectory(sub_dir_name)
+                if not sub_dir:
+                    sub_dir = out_dir.mkdir(sub_dir_name)
+                sub_dir.cd()
+            hist.Write()
+        out_dir.cd()
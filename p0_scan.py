@@ -0,0 +1,136 @@
+import ROOT
+import numpy as np
+import multiprocessing
+
+import sys
+sys.path.append('utils')
+import utils as utils
+
+## scan being run by the pool, the forked processes inherit it (with its NLL and minimizer) instead of receiving a pickled copy
+_active_scan = None
+
+
+def _scan_chunk(masses):
+    return _active_scan.scan_points(masses)
+
+
+## scan of the local p-value of the background-only hypothesis as a function of the mass hypothesis, with the asymptotic
+## formula of the one-sided discovery test (as RooStats.AsymptoticCalculator with SetOneSidedDiscovery(True)):
+## q0 = 2 (NLL(poi = 0) - NLL(best fit)), q0 = 0 if the best-fit poi is negative, p0 = 1 - Phi(sqrt(q0))
+## the background-only likelihood does not depend on the mass hypothesis, it is minimised once; one NLL and one minimizer are
+## reused for all the mass points, which can be distributed over a pool of forked processes
+## with n_refine_iterations > 0 the scan is repeated with n_refine_points around the minimum p0 of the previous scan
+class LocalP0Scan:
+
+    def __init__(self, pdf, data, poi, mass_par):
+        self.pdf = pdf
+        self.data = data
+        self.poi = poi  # e.g. n_signal
+        self.mass_par = mass_par  # e.g. mu, its range is scanned
+
+        self.n_points = 100
+        self.n_refine_iterations = 0
+        self.n_refine_points = 20
+        self.refine_window = 2  # half-width of the refined range, in steps of the previous scan
+        self.n_workers = 1
+        self.fit_backend = None  # see utils.get_fit_options, applied to the NLL and to the minimizer
+
+        self._nll = None
+        self._minimizer = None
+        self._minimizer_type = None
+        self._minimizer_algo = None
+        self._nll_null = None
+        self._initial_values = None
+
+        ## output, sorted in mass
+        self.masses = np.array([])
+        self.p0_values = np.array([])
+
+    def _setup(self):
+        fit_backend = self.fit_backend if self.fit_backend is not None else {}
+        ## evaluation backend and parallelisation of the likelihood, the minimizer options are set on the RooMinimizer
+        nll_options = ROOT.RooLinkedList()
+        for option in utils.get_fit_options({key: val for key, val in fit_backend.items() if key in ['eval_backend', 'num_cpu', 'num_cpu_strategy']}):
+            nll_options.Add(option)
+        self._nll = self.pdf.createNLL(self.data, nll_options)
+        self._minimizer = ROOT.RooMinimizer(self._nll)
+        self._minimizer.setPrintLevel(-1)
+        if 'strategy' in fit_backend:
+            self._minimizer.setStrategy(fit_backend['strategy'])
+        if 'tolerance' in fit_backend:
+            self._minimizer.setEps(fit_backend['tolerance'])
+        self._minimizer_type = fit_backend.get('minimizer', ROOT.Math.MinimizerOptions.DefaultMinimizerType())
+        self._minimizer_algo = fit_backend.get('minimizer_algorithm', 'migrad' if 'minimizer' in fit_backend else ROOT.Math.MinimizerOptions.DefaultMinimizerAlgo())
+        pars = self.pdf.getParameters(self.data)
+        self._initial_values = {par.GetName(): par.getVal() for par in pars}
+
+        ## background-only fit, the same for all the mass hypotheses
+        self.mass_par.setConstant(True)
+        self.poi.setVal(0.)
+        self.poi.setConstant(True)
+        self._nll_null = self._minimise(ROOT.RooAbsArg.ConfigChange)
+        self.poi.setConstant(False)
+        self._nll.constOptimizeTestStatistic(ROOT.RooAbsArg.ConfigChange, True)
+
+    def _minimise(self, const_change):
+        ## the constant terms of the likelihood are recomputed: ConfigChange if the constant parameters changed, ValueChange if only their values
+        self._nll.constOptimizeTestStatistic(const_change, True)
+        self._minimizer.minimize(self._minimizer_type, self._minimizer_algo)
+        return self._nll.getVal()
+
+    def _reset(self):
+        ## each point starts from the same parameters, the result does not depend on the order of the points or on n_workers
+        for par in self.pdf.getParameters(self.data):
+            if not par.isConstant() and par.GetName() in self._initial_values:
+                par.setVal(self._initial_values[par.GetName()])
+
+    def scan_points(self, masses):
+        p0_values = []
+        for mass in masses:
+            self._reset()
+            self.mass_par.setVal(mass)
+            nll_best = self._minimise(ROOT.RooAbsArg.ValueChange)
+            q0 = 2 * (self._nll_null - nll_best) if self.poi.getVal() > 0 else 0.
+            p0_values.append(ROOT.Math.normal_cdf_c(np.sqrt(max(q0, 0.))))
+            print(f"Mass: {mass} GeV/c^2, p0: {p0_values[-1]:.10f}")
+        return p0_values
+
+    def _run(self, masses):
+        global _active_scan
+        if self.n_workers > 1 and len(masses) > 1:
+            ## contiguous chunks, one per process
+            _active_scan = self
+            chunks = [chunk for chunk in np.array_split(masses, min(self.n_workers, len(masses))) if len(chunk) > 0]
+            with multiprocessing.get_context('fork').Pool(len(chunks)) as pool:
+                return [p0 for chunk_p0 in pool.map(_scan_chunk, chunks) for p0 in chunk_p0]
+        return self.scan_points(masses)
+
+    def run(self):
+        initial_mass = self.mass_par.getVal()
+        initial_constant = self.mass_par.isConstant()
+        if self._nll is None:
+            self._setup()
+
+        masses = np.linspace(self.mass_par.getMin(), self.mass_par.getMax(), self.n_points)
+        p0_values = self._run(masses)
+        step = masses[1] - masses[0] if len(masses) > 1 else 0.
+        for _ in range(self.n_refine_iterations):
+            if step == 0.:
+                break
+            mass_min = masses[np.argmin(p0_values)]
+            low = max(mass_min - self.refine_window * step, self.mass_par.getMin())
+            high = min(mass_min + self.refine_window * step, self.mass_par.getMax())
+            refine_masses = np.linspace(low, high, self.n_refine_points)
+            ## the points already scanned are skipped
+            refine_masses = refine_masses[np.min(np.abs(refine_masses[:, None] - masses[None, :]), axis=1) > 1e-6 * step]
+            step = (high - low) / (self.n_refine_points - 1)
+            masses = np.concatenate([masses, refine_masses])
+            p0_values = np.concatenate([p0_values, self._run(refine_masses)])
+
+        order = np.argsort(masses)
+        self.masses = np.asarray(masses)[order]
+        self.p0_values = np.asarray(p0_values)[order]
+
+        self.mass_par.setVal(initial_mass)
+        self.mass_par.setConstant(initial_constant)
+        return self.masses, self.p0_values
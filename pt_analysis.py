@@ -1,6 +1,6 @@
 from spectra import SpectraMaker
-from hipe4ml.tree_handler import TreeHandler
-from itertools import product
+from cut_masks import get_threshold_grid
+from fit_store import FitResultStore
 import copy
 import yaml
 import argparse
@@ -56,6 +56,29 @@ do_syst = config['do_syst']
 n_trials = config['n_trials']
 absorption_syst_array = config['absorption_syst']
 
+streaming = config.get('streaming', False)
+step_size = config.get('step_size', '100 MB')
+n_workers = config.get('n_workers', 1)
+cache_dir = config.get('cache_dir')
+cache_max_size_gb = config.get('cache_max_size_gb', 50)
+column_projection = config.get('column_projection', False)
+compact = config.get('compact', False)
+binned_fit = config.get('binned_fit', 'auto')
+binned_fit_threshold = config.get('binned_fit_threshold', 20000)
+n_bins_binned_fit = config.get('n_bins_binned_fit', 480)
+mc_fit_cache_dir = config.get('mc_fit_cache_dir')
+fit_store_path = config.get('fit_store')
+fit_store_frames = config.get('fit_store_frames', False)
+n_workers_syst = config.get('n_workers_syst', 1)
+syst_seed = config.get('syst_seed', 42)
+mc_weights = config.get('mc_weights', False)
+mc_weight_col = utils.PT_WEIGHT_COLUMN if mc_weights else None
+simultaneous_fit = config.get('simultaneous_fit', False)
+shared_signal_pars = config.get('shared_signal_pars', [])
+n_cpu_simultaneous_fit = config.get('n_cpu_simultaneous_fit', 1)
+headless_trials = config.get('headless_trials', False)
+fit_backend = config.get('fit_backend')
+
 
 matter_options = ['matter', 'antimatter', 'both']
 if is_matter not in matter_options:
@@ -75,19 +98,38 @@ for tree in tree_names:
             tree_name = tree
             break
 print(f"Data tree found: {tree_name}")
-data_hdl = TreeHandler(input_file_name_data, tree_name, folder_name='DF*')
-mc_hdl = TreeHandler(input_file_name_mc, 'O2mchypcands', folder_name='DF*')
+
+# matter selections, applied while reading the trees
+matter_sel = ''
+mc_matter_sel = ''
+if is_matter == 'matter':
+    matter_sel = 'fIsMatter == True'
+    mc_matter_sel = 'fGenPt > 0'
+elif is_matter == 'antimatter':
+    matter_sel = 'fIsMatter == False'
+    mc_matter_sel = 'fGenPt < 0'
+
+data_columns = None
+mc_columns = None
+if column_projection:
+    used_expressions = [selections_std, matter_sel, mc_matter_sel, ['fIsReco', 'fIsSurvEvSel', 'fMassH3L']]
+    if do_syst:
+        used_expressions.append(list(config['cut_dict_syst'].keys()))
+    data_columns = utils.get_needed_columns(input_file_name_data, tree_name, used_expressions, calibrate_he3_pt=calibrate_he_momentum)
+    mc_columns = utils.get_needed_columns(input_file_name_mc, 'O2mchypcands', used_expressions, calibrate_he3_pt=calibrate_he_momentum, isMC=True)
+
+# read the trees, add columns to the handlers and apply preselections
+data_hdl = utils.get_tree_handler(input_file_name_data, tree_name, streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                  cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact, preselections=matter_sel,
+                                  calibrate_he3_pt=calibrate_he_momentum, isMC=False, columns=data_columns)
+mc_hdl = utils.get_tree_handler(input_file_name_mc, 'O2mchypcands', streaming=streaming, step_size=step_size, n_workers=n_workers,
+                                cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb, compact=compact, preselections=mc_matter_sel,
+                                calibrate_he3_pt=calibrate_he_momentum, isMC=True, columns=mc_columns)
 
 # declare output file
 output_file = ROOT.TFile.Open(f'{output_dir_name}/{output_file_name}.root', 'recreate')
 
-# Add columns to the handlers
-utils.correct_and_convert_df(data_hdl, calibrate_he3_pt=calibrate_he_momentum, isMC=False)
-utils.correct_and_convert_df(mc_hdl, calibrate_he3_pt=calibrate_he_momentum, isMC=True)
-
-# apply preselections + get absorption histo
-matter_sel = ''
-mc_matter_sel = ''
+# get absorption histo
 absorption_histo = None
 
 if absorption_histo_file != '':
@@ -98,20 +140,14 @@ if absorption_histo_file != '':
     absorption_histo_anti.SetDirectory(0)
 
 if is_matter == 'matter':
-    matter_sel = 'fIsMatter == True'
-    mc_matter_sel = 'fGenPt > 0'
     if absorption_histo_file != '':
         absorption_histo = absorption_histo_mat
 
 elif is_matter == 'antimatter':
-    matter_sel = 'fIsMatter == False'
-    mc_matter_sel = 'fGenPt < 0'
     if absorption_histo_file != '':
         absorption_histo = absorption_histo_anti
 
 if matter_sel != '':
-    data_hdl.apply_preselections(matter_sel)
-    mc_hdl.apply_preselections(mc_matter_sel)
     if absorption_histo_file != '':      ## get average between matter and antimatter absorption
         absorption_histo = absorption_histo_mat.Clone('h_abso_frac_pt')
         absorption_histo.Add(absorption_histo_anti)
@@ -122,7 +158,7 @@ if matter_sel != '':
 spectra_file = ROOT.TFile.Open('utils/heliumSpectraMB.root')
 he3_spectrum = spectra_file.Get('fCombineHeliumSpecLevyFit_0-100')
 spectra_file.Close()
-utils.reweight_pt_spectrum(mc_hdl, 'fAbsGenPt', he3_spectrum)
+utils.reweight_pt_spectrum(mc_hdl, 'fAbsGenPt', he3_spectrum, weight_col=mc_weight_col)
 mc_hdl.apply_preselections('rej==True')
 # mc_hdl.apply_preselections('fGenCt < 28.5 or fGenCt > 28.6')
 mc_reco_hdl = mc_hdl.apply_preselections('fIsReco == 1', inplace=False)
@@ -157,6 +193,17 @@ spectra_maker.is_matter = is_matter
 spectra_maker.inv_mass_signal_func = signal_fit_func
 spectra_maker.inv_mass_bkg_func = bkg_fit_func
 spectra_maker.sigma_range_mc_to_data = sigma_range_mc_to_data
+spectra_maker.binned_fit = binned_fit
+spectra_maker.binned_fit_threshold = binned_fit_threshold
+spectra_maker.n_bins_binned_fit = n_bins_binned_fit
+spectra_maker.mc_fit_cache_dir = mc_fit_cache_dir
+spectra_maker.mc_weight_col = mc_weight_col
+spectra_maker.simultaneous_fit = simultaneous_fit
+spectra_maker.shared_signal_pars = shared_signal_pars
+spectra_maker.n_cpu_simultaneous_fit = n_cpu_simultaneous_fit
+spectra_maker.fit_backend = fit_backend
+if fit_store_path is not None:
+    spectra_maker.fit_store = FitResultStore(fit_store_path, fit_store_frames)
 
 spectra_maker.output_dir = output_dir_std
 
@@ -252,39 +299,36 @@ if do_syst:
             cut_string_dict[var].append(
                 var + cut_greater_string + str(cut))
 
+    # the reconstructed MC passing the varied thresholds is counted from a cumulative histogram
+    spectra_maker.threshold_grid = get_threshold_grid(cut_dict_syst)
+
     cut_string_dict['signal_fit_func'] = signal_fit_func_syst
     cut_string_dict['bkg_fit_func'] = bkg_fit_func_syst
-    combos = list(product(*list(cut_string_dict.values())))
+    option_lists = list(cut_string_dict.values())
 
-    if n_trials < len(combos):
-        combo_random_indices = np.random.randint(len(combos), size=(n_trials, len(pt_bins) - 1))
-    else:
-        print(f"** Warning: n_trials > n_combinations ({n_trials}, {len(combos)}), taking all the possible combinations **")
-        indices = np.arange(len(combos))
-        # create a (len(combos), len(ct_bins) - 1) array with the indices repeated for each ct bin
-        combo_random_indices = np.repeat(indices[:, np.newaxis], len(pt_bins) - 1, axis=1)
-        # now shuffle each column of the array
-        for i in range(combo_random_indices.shape[1]):
-            np.random.shuffle(combo_random_indices[:, i])
+    ## in each bin the combinations are drawn without replacement, so all the planned trials are distinct
+    combo_random_indices = utils.plan_trials(option_lists, len(pt_bins) - 1, n_trials, syst_seed)
+    n_combos = int(np.prod([len(options) for options in option_lists]))
+    if n_trials > n_combos:
+        print(f"** Warning: n_trials > n_combinations ({n_trials}, {n_combos}), taking all the possible combinations **")
+    print(f'** {len(combo_random_indices)} trials planned **')
 
-    combo_check_map = {}
+    ## the trials are planned here and run, possibly in parallel, afterwards
+    trials = []
+    trial_headers = []
 
     for i_combo, combo_indices in enumerate(combo_random_indices):
-        trial_strings.append("----------------------------------")
+        trial_header = ["----------------------------------"]
         trial_num_string = f'Trial: {i_combo} / {len(combo_random_indices)}'
-        trial_strings.append(trial_num_string)
-        print(trial_num_string)
-        print("----------------------------------")
+        trial_header.append(trial_num_string)
+        trial_headers.append(trial_header)
 
         cut_selection_list = []
         bkg_fit_func_list = []
         signal_fit_func_list = []
 
         for ipt in range(len(pt_bins) - 1):
-            combo = combos[combo_indices[ipt]]
-            pt_bin = [pt_bins[ipt], pt_bins[ipt + 1]]
-            full_combo_string = f'pt {pt_bin[0]}_{pt_bin[1]} | '
-            full_combo_string += " & ".join(combo)
+            combo = utils.get_combo(option_lists, combo_indices[ipt])
 
             # extract a signal and a background fit function
             sel_string = " & ".join(combo[: -2])
@@ -297,21 +341,18 @@ if do_syst:
             signal_fit_func = combo[-2]
             bkg_fit_func = combo[-1]
 
-            if full_combo_string in combo_check_map:
-                break
-
-            combo_check_map[full_combo_string] = True
-
             cut_selection_list.append(sel_string)
             bkg_fit_func_list.append(bkg_fit_func)
             signal_fit_func_list.append(signal_fit_func)
 
-        if len(cut_selection_list) != len(pt_bins) - 1:
-            continue
+        trial_header.append(str(cut_selection_list))
+        trial_header.append(str(bkg_fit_func_list))
+        trial_header.append(str(signal_fit_func_list))
+        trials.append([i_combo, cut_selection_list, bkg_fit_func_list, signal_fit_func_list])
 
-        trial_strings.append(str(cut_selection_list))
-        trial_strings.append(str(bkg_fit_func_list))
-        trial_strings.append(str(signal_fit_func_list))
+    def run_trial(trial, trial_dir):
+        i_combo, cut_selection_list, bkg_fit_func_list, signal_fit_func_list = trial
+        print(f'Trial: {i_combo} / {len(combo_random_indices)}')
 
         # make_spectra
         spectra_maker.selection_string = cut_selection_list
@@ -320,24 +361,37 @@ if do_syst:
         spectra_maker.n_bins_mass_data = n_bins_mass_data
         spectra_maker.n_bins_mass_mc = n_bins_mass_mc
         spectra_maker.sigma_range_mc_to_data = sigma_range_mc_to_data
-        trial_dir = output_dir_syst.mkdir(f'trial_{i_combo}')
         spectra_maker.output_dir = trial_dir
+        spectra_maker.headless_fits = headless_trials
         spectra_maker.make_spectra()
         spectra_maker.make_histos()
         spectra_maker.fit()
 
-        res_string = "Integral: " + str(spectra_maker.fit_func.Integral(0, 10)) + " Prob: " + str(spectra_maker.fit_func.GetProb())
-        trial_strings.append(res_string)
+        trial_result = {'i_combo': i_combo,
+                        'res_string': "Integral: " + str(spectra_maker.fit_func.Integral(0, 10)) + " Prob: " + str(spectra_maker.fit_func.GetProb()),
+                        'corrected_counts': list(spectra_maker.corrected_counts),
+                        'selected': spectra_maker.fit_func.GetProb() > 0.05 and spectra_maker.chi2_selection(),
+                        'yield': spectra_maker.fit_func.Integral(0, 10),
+                        'prob': spectra_maker.fit_func.GetProb()}
+        if trial_result['selected']:
+            spectra_maker.dump_to_output_dir()
+
+        spectra_maker.del_dyn_members()
+        return trial_result
+
+    ## each trial is written to output_dir_syst as soon as it is done, the results are merged in the trial order
+    for trial_result in utils.run_trials(run_trial, trials, output_dir_syst, [f'trial_{trial[0]}' for trial in trials], n_workers_syst):
+        trial_headers[trial_result['i_combo']].append(trial_result['res_string'])
 
         for i_bin in range(0, len(spectra_maker.bins) - 1):
-            h_pt_syst[i_bin].Fill(spectra_maker.corrected_counts[i_bin])
+            h_pt_syst[i_bin].Fill(trial_result['corrected_counts'][i_bin])
 
-        if spectra_maker.fit_func.GetProb() > 0.05 and spectra_maker.chi2_selection():
-            spectra_maker.dump_to_output_dir()
-            yield_dist.Fill(spectra_maker.fit_func.Integral(0, 10))
-            yield_prob.Fill(spectra_maker.fit_func.GetProb())
+        if trial_result['selected']:
+            yield_dist.Fill(trial_result['yield'])
+            yield_prob.Fill(trial_result['prob'])
 
-        spectra_maker.del_dyn_members()
+    for trial_header in trial_headers:
+        trial_strings += trial_header
 
 output_dir_std.cd()
 
@@ -1,9 +1,15 @@
 import ROOT
 import uproot
 from hipe4ml.tree_handler import TreeHandler
+from p0_scan import LocalP0Scan
+from toy_study import ToyStudy
 import numpy as np
 
 import argparse
+import hashlib
+import inspect
+import json
+import os
 import yaml
 
 import sys
@@ -14,8 +20,91 @@ utils.set_style()
 kOrangeC  = ROOT.TColor.GetColor('#ff7f00')
 ROOT.gROOT.SetBatch()
 
+## parameters of the signal shape fitted to the MC: the tails are then fixed and the width constrained in the data fit
+SIGNAL_SHAPE_PARS = ['mu', 'sigma', 'a1', 'a2', 'n1', 'n2']
+
+
+def build_mass_var(is_3lh, title=''):
+    if is_3lh:
+        return ROOT.RooRealVar('m', title, 2.96, 3.04, 'GeV/c^{2}')
+    return ROOT.RooRealVar('m', title, 3.89, 3.97, 'GeV/c^{2}')
+
+
+## signal (dscb or gaus) + background (pol1, pol2 or expo) model of the invariant mass, returned as a dict with the pdfs and the parameters
+## suffix is appended to the names of all the objects, so that several models can be part of the same RooFit graph
+## shared_pars: optional {name: RooRealVar}, used instead of the parameters of the model with the same name
+def build_mass_model(mass, is_3lh, signal_fit_func, bkg_fit_func, extended_likelihood=True, suffix='', shared_pars=None):
+    shared_pars = shared_pars if shared_pars is not None else {}
+
+    def get_par(name, *args):
+        if name in shared_pars:
+            return shared_pars[name]
+        return ROOT.RooRealVar(f'{name}{suffix}', *args)
+
+    pars = {}
+    if is_3lh:
+        pars['mu'] = get_par('mu', 'hypernucl mass', 2.985, 2.992, 'GeV/c^{2}')
+    else:
+        pars['mu'] = get_par('mu', 'hypernucl mass', 3.9, 3.95, 'GeV/c^{2}')
+    pars['sigma'] = get_par('sigma', 'hypernucl width', 0.001, 0.0024, 'GeV/c^{2}')
+    pars['a1'] = get_par('a1', 'a1', 0.7, 5.)
+    pars['a2'] = get_par('a2', 'a2', 0.7, 5.)
+    pars['n1'] = get_par('n1', 'n1', 0., 5.)
+    pars['n2'] = get_par('n2', 'n2', 0., 5.)
+    pars['c0'] = get_par('c0', 'constant c0', -1., 1)
+    pars['c1'] = get_par('c1', 'constant c1', -1., 1)
+
+    if signal_fit_func == 'dscb':
+        signal = ROOT.RooCrystalBall(f'cb{suffix}', 'cb', mass, pars['mu'], pars['sigma'], pars['a1'], pars['n1'], pars['a2'], pars['n2'])
+    elif signal_fit_func == 'gaus':
+        signal = ROOT.RooGaussian(f'gaus{suffix}', 'gaus', mass, pars['mu'], pars['sigma'])
+    else:
+        raise ValueError(f'Invalid signal fit function. Expected one of: dscb, gaus')
+
+    # define background pdf
+    if bkg_fit_func == 'pol1':
+        background = ROOT.RooChebychev(f'bkg{suffix}', 'pol1 bkg', mass, ROOT.RooArgList(pars['c0']))
+    elif bkg_fit_func == 'pol2':
+        background = ROOT.RooChebychev(f'bkg{suffix}', 'pol2 bkg', mass, ROOT.RooArgList(pars['c0'], pars['c1']))
+    elif bkg_fit_func == 'expo':
+        background = ROOT.RooExponential(f'bkg{suffix}', 'expo bkg', mass, pars['c0'])
+    else:
+        raise ValueError(f'Invalid background fit function. Expected one of: pol1, pol2, expo')
+
+    if extended_likelihood:
+        pars['n_signal'] = get_par('n_signal', 'n_signal', 0., 1e4)
+        pars['n_background'] = get_par('n_background', 'n_background', 0., 1e6)
+        pdf = ROOT.RooAddPdf(f'total_pdf{suffix}', 'signal + background', ROOT.RooArgList(signal, background), ROOT.RooArgList(pars['n_signal'], pars['n_background']))
+    else:
+        pars['f'] = get_par('f', 'fraction of signal', 0., 0.4)
+        pdf = ROOT.RooAddPdf(f'total_pdf{suffix}', 'signal + background', ROOT.RooArgList(signal, background), ROOT.RooArgList(pars['f']))
+
+    return {'pars': pars, 'signal': signal, 'background': background, 'pdf': pdf}
+
+
+## values, errors, ranges and constant flags of parameters, used to reset the parameters of a model before a new fit
+## and to restore the result of a fit of a shared model
+def get_par_values(pars):
+    return {par.GetName(): (par.getVal(), par.getError(), par.getMin(), par.getMax(), par.isConstant()) for par in pars}
+
+
+def set_par_values(pars, par_values):
+    for par in pars:
+        val, err, val_min, val_max, constant = par_values[par.GetName()]
+        par.setRange(val_min, val_max)
+        par.setVal(val)
+        par.setError(err)
+        par.setConstant(constant)
+
+
 ## create signal extraction class
 class SignalExtraction:
+
+    ## MC signal-shape fits shared by all the instances, see get_mc_fit_key
+    mc_fit_cache = {}
+    ## mass models shared by all the instances, see get_model
+    model_cache = {}
+
     def __init__(self, input_data_hdl, input_mc_hdl=None): ## could be either a pandas or a tree handler
 
         self.data_hdl = input_data_hdl
@@ -30,12 +119,28 @@ class SignalExtraction:
 
         ## fit-related variables
         self.pdf = None
+        self.model = None ## see build_mass_model, set by process_fit
+        self.fitted_values = None ## parameters of the model after the fit of this instance, the model is shared (see get_model)
         self.roo_dataset = None
         self.n_bins_data = 40
         self.n_bins_mc = 80
         self.signal_fit_func = 'dscb'
         self.sigma_range_mc_to_data = [1, 1.5]
         self.bkg_fit_func = 'pol1'
+        ## binned likelihood fit: True, False or 'auto' (binned above binned_fit_threshold candidates in the mass window)
+        self.binned_fit = 'auto'
+        self.binned_fit_threshold = 20000
+        self.n_bins_binned_fit = 480 ## fine binning, multiple of the usual plotting bins
+        self.mc_fit_range = [2.97, 3.01]
+        ## the MC fits are reused if the MC sample and the fit settings are unchanged, also across jobs if mc_fit_cache_dir is set
+        self.mc_fit_cache_label = '' ## e.g. the MC bin selection
+        self.mc_fit_cache_dir = None
+        ## headless: only the fit and the chi2, without the MC frame, the paves and the output (e.g. for the systematic trials)
+        self.headless = False
+        ## weight column of the MC (e.g. pT spectrum weights), the MC fit then uses a weighted dataset
+        self.mc_weight_col = None
+        ## RooFit evaluation backend, parallelisation and minimizer settings of the fits (see utils.get_fit_options)
+        self.fit_backend = None
 
         ### frames to be saved to file
         self.out_file = None ## could also be a TDirectory
@@ -47,7 +152,110 @@ class SignalExtraction:
         self.data_frame_fit = None
         self.local_pvalue_graph = None
 
-
+        ## local p0 scan (see LocalP0Scan): points of the first scan, dense scans around the minimum p0, processes
+        self.p0_scan_points = 100
+        self.p0_scan_refine_iterations = 0
+        self.p0_scan_refine_points = 20
+        self.n_workers_p0_scan = 1
+
+
+
+    def use_binned_fit(self, mass_array, mass):
+        if self.binned_fit != 'auto':
+            return self.binned_fit
+        n_candidates = np.count_nonzero(np.logical_and(mass_array >= mass.getMin(), mass_array <= mass.getMax()))
+        return n_candidates > self.binned_fit_threshold
+
+    def get_mc_weights(self):
+        if self.mc_weight_col is None:
+            return None
+        return np.array(self.mc_hdl[self.mc_weight_col].values, dtype=np.float64)
+
+    def get_mc_fit_key(self, mc_mass_array, binned_fit_mc, mc_weights=None):
+        key_info = [self.mc_fit_cache_label, self.signal_fit_func, self.is_3lh, list(self.mc_fit_range), bool(binned_fit_mc),
+                    self.n_bins_binned_fit if binned_fit_mc else 0, len(mc_mass_array), hashlib.sha256(mc_mass_array.tobytes()).hexdigest()]
+        if mc_weights is not None:
+            key_info.append(hashlib.sha256(mc_weights.tobytes()).hexdigest())
+        if self.fit_backend is not None:
+            key_info.append(self.fit_backend)
+        return hashlib.sha256(json.dumps(key_info).encode()).hexdigest()
+
+    def get_fit_key(self, extended_likelihood=True):
+        ## everything the result of process_fit depends on: fit settings, fit code and content of the data and MC samples
+        tree_var_name = 'fMassH3L' if self.is_3lh else 'fMassH4L'
+        key_info = [self.signal_fit_func, self.bkg_fit_func, self.is_3lh, self.is_matter, extended_likelihood, self.n_bins_data, self.n_bins_mc,
+                    list(self.sigma_range_mc_to_data), str(self.binned_fit), self.binned_fit_threshold, self.n_bins_binned_fit, list(self.mc_fit_range),
+                    self.n_evts, self.performance, self.additional_pave_text, self.data_frame_fit_name, self.mc_frame_fit_name,
+                    inspect.getsource(build_mass_model), inspect.getsource(SignalExtraction.fit_mc_shape), inspect.getsource(SignalExtraction.process_fit)]
+        if self.fit_backend is not None:
+            key_info.append(self.fit_backend)
+        mass_arrays = [np.array(self.data_hdl[tree_var_name].values, dtype=np.float64)]
+        if self.mc_hdl != None:
+            mass_arrays.append(np.array(self.mc_hdl['fMassH3L'].values, dtype=np.float64))
+            if self.mc_weight_col is not None:
+                mass_arrays.append(self.get_mc_weights())
+        for mass_array in mass_arrays:
+            key_info += [len(mass_array), hashlib.sha256(mass_array.tobytes()).hexdigest()]
+        return hashlib.sha256(json.dumps(key_info).encode()).hexdigest()
+
+    def load_mc_fit(self, key):
+        if key in SignalExtraction.mc_fit_cache:
+            return SignalExtraction.mc_fit_cache[key]
+        if self.mc_fit_cache_dir is not None:
+            cache_file = os.path.join(self.mc_fit_cache_dir, f'{key}.json')
+            if os.path.exists(cache_file):
+                with open(cache_file) as f:
+                    SignalExtraction.mc_fit_cache[key] = json.load(f)
+                return SignalExtraction.mc_fit_cache[key]
+        return None
+
+    def store_mc_fit(self, key, mc_fit):
+        SignalExtraction.mc_fit_cache[key] = mc_fit
+        if self.mc_fit_cache_dir is not None:
+            os.makedirs(self.mc_fit_cache_dir, exist_ok=True)
+            cache_file = os.path.join(self.mc_fit_cache_dir, f'{key}.json')
+            tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump(mc_fit, f)
+            os.replace(tmp_file, cache_file)
+
+    def get_model(self, extended_likelihood=True):
+        ## the model of each (is_3lh, signal function, background function) is built once and shared by all the instances,
+        ## its parameters are reset to their initial values at each call
+        key = (self.is_3lh, self.signal_fit_func, self.bkg_fit_func, extended_likelihood)
+        if key not in SignalExtraction.model_cache:
+            mass = build_mass_var(self.is_3lh)
+            model = build_mass_model(mass, self.is_3lh, self.signal_fit_func, self.bkg_fit_func, extended_likelihood)
+            model['mass'] = mass
+            model['initial_values'] = get_par_values(model['pars'].values())
+            SignalExtraction.model_cache[key] = model
+        model = SignalExtraction.model_cache[key]
+        set_par_values(model['pars'].values(), model['initial_values'])
+        return model
+
+    def fit_mc_shape(self, mass, model):
+        ## fit of the signal shape of model to the MC (or the cached one), the parameters of the model are set to the fitted values
+        mc_mass_array = np.array(self.mc_hdl['fMassH3L'].values, dtype=np.float64)
+        binned_fit_mc = self.use_binned_fit(mc_mass_array, mass)
+        mc_weights = self.get_mc_weights()
+        mass_roo_mc = utils.ndarray2roo(mc_mass_array, mass, 'histo_mc', binned=binned_fit_mc, weights=mc_weights)
+        mc_fit_pars = {name: model['pars'][name] for name in SIGNAL_SHAPE_PARS}
+        mc_fit_key = self.get_mc_fit_key(mc_mass_array, binned_fit_mc, mc_weights)
+        mc_fit = self.load_mc_fit(mc_fit_key)
+        if mc_fit is None:
+            ## the parameter errors of a weighted fit are corrected with the sum of the squared weights
+            fit_results_mc, fit_time_mc = utils.fit_to(model['signal'], mass_roo_mc, [ROOT.RooFit.Range(self.mc_fit_range[0], self.mc_fit_range[1]),
+                                                       ROOT.RooFit.SumW2Error(mc_weights is not None), ROOT.RooFit.Save(True), ROOT.RooFit.PrintLevel(-1)], self.fit_backend)
+            print(f'MC fit time: {fit_time_mc:.3f} s ({len(mc_mass_array)} candidates, {"binned" if binned_fit_mc else "unbinned"})')
+            mc_fit = {'pars': {name: [par.getVal(), par.getError()] for name, par in mc_fit_pars.items()},
+                      'n_float_pars': fit_results_mc.floatParsFinal().getSize()}
+            self.store_mc_fit(mc_fit_key, mc_fit)
+        else:
+            print('Using cached MC signal-shape fit')
+            for name, par in mc_fit_pars.items():
+                par.setVal(mc_fit['pars'][name][0])
+                par.setError(mc_fit['pars'][name][1])
+        return mass_roo_mc, mc_fit, binned_fit_mc
 
     def process_fit(self, extended_likelihood=True, rooworkspace_path=None):
 
@@ -60,49 +268,24 @@ class SignalExtraction:
             decay_string = '{}^{4}_{#Lambda}H #rightarrow ^{4}He+#pi^{-}' if self.is_matter else '{}^{4}_{#bar{#Lambda}}#bar{H} #rightarrow ^{4}#bar{He}+#pi^{+}'
             tree_var_name = 'fMassH4L'
 
-        # define signal and bkg variables
-        if self.is_3lh:
-            mass = ROOT.RooRealVar('m', self.inv_mass_string, 2.96, 3.04, 'GeV/c^{2}')
-            mu = ROOT.RooRealVar('mu', 'hypernucl mass', 2.985, 2.992, 'GeV/c^{2}')
-        else:
-            mass = ROOT.RooRealVar('m', self.inv_mass_string, 3.89, 3.97, 'GeV/c^{2}')
-            mu = ROOT.RooRealVar('mu', 'hypernucl mass', 3.9, 3.95, 'GeV/c^{2}')
-
-        sigma = ROOT.RooRealVar('sigma', 'hypernucl width', 0.001, 0.0024, 'GeV/c^{2}')
-        a1 = ROOT.RooRealVar('a1', 'a1', 0.7, 5.)
-        a2 = ROOT.RooRealVar('a2', 'a2', 0.7, 5.)
-        n1 = ROOT.RooRealVar('n1', 'n1', 0., 5.)
-        n2 = ROOT.RooRealVar('n2', 'n2', 0., 5.)
-        c0 = ROOT.RooRealVar('c0', 'constant c0', -1., 1)
-        c1 = ROOT.RooRealVar('c1', 'constant c1', -1., 1)
-
-        if self.signal_fit_func == 'dscb':
-            signal = ROOT.RooCrystalBall('cb', 'cb', mass, mu, sigma, a1, n1, a2, n2)
-        elif self.signal_fit_func == 'gaus':
-            signal = ROOT.RooGaussian('gaus', 'gaus', mass, mu, sigma)
-        else:
-            raise ValueError(f'Invalid signal fit function. Expected one of: dscb, gaus')
-
-        # define background pdf
-        if self.bkg_fit_func == 'pol1':
-            background = ROOT.RooChebychev('bkg', 'pol1 bkg', mass, ROOT.RooArgList(c0))
-        elif self.bkg_fit_func == 'pol2':
-            background = ROOT.RooChebychev('bkg', 'pol2 bkg', mass, ROOT.RooArgList(c0, c1))
-        elif self.bkg_fit_func == 'expo':
-            background = ROOT.RooExponential('bkg', 'expo bkg', mass, c0)
-        else:
-            raise ValueError(f'Invalid background fit function. Expected one of: pol1, pol2, expo')
-
+        # signal and bkg model, reused by the following fits
+        model = self.get_model(extended_likelihood)
+        mass = model['mass']
+        mass.SetTitle(self.inv_mass_string)
+        ## only used by the binned datasets
+        mass.setBins(self.n_bins_binned_fit)
+        mu, sigma, a1, a2, n1, n2 = [model['pars'][name] for name in SIGNAL_SHAPE_PARS]
+        signal = model['signal']
+        background = model['background']
         if extended_likelihood:
-            n_signal = ROOT.RooRealVar('n_signal', 'n_signal', 0., 1e4)
-            n_background = ROOT.RooRealVar('n_background', 'n_background', 0., 1e6)
+            n_signal = model['pars']['n_signal']
+            n_background = model['pars']['n_background']
         else:
-            f = ROOT.RooRealVar('f', 'fraction of signal', 0., 0.4)
+            f = model['pars']['f']
 
         # fix DSCB parameters to MC
         if self.mc_hdl != None:
-            mass_roo_mc = utils.ndarray2roo(np.array(self.mc_hdl['fMassH3L'].values, dtype=np.float64), mass, 'histo_mc')
-            fit_results_mc = signal.fitTo(mass_roo_mc, ROOT.RooFit.Range(2.97, 3.01), ROOT.RooFit.Save(True), ROOT.RooFit.PrintLevel(-1))
+            mass_roo_mc, mc_fit, binned_fit_mc = self.fit_mc_shape(mass, model)
             a1.setConstant()
             a2.setConstant()
             n1.setConstant()
@@ -110,6 +293,8 @@ class SignalExtraction:
             sigma.setRange(self.sigma_range_mc_to_data[0]*sigma.getVal(), self.sigma_range_mc_to_data[1]*sigma.getVal())
             print("sigma range set to: ", self.sigma_range_mc_to_data[0]*sigma.getVal(), self.sigma_range_mc_to_data[1]*sigma.getVal())
             print("sigma: ", sigma.getVal())
+
+        if self.mc_hdl != None and not self.headless:
             self.mc_frame_fit = mass.frame(self.n_bins_mc)
             self.mc_frame_fit.SetName(self.mc_frame_fit_name)
             mass_roo_mc.plotOn(self.mc_frame_fit, ROOT.RooFit.Name('mc'), ROOT.RooFit.DrawOption('p'))
@@ -126,18 +311,20 @@ class SignalExtraction:
             fit_param.AddText(r'n_{R} = ' + f'{n2.getVal():.2f} #pm {n2.getError():.2f}')
             self.mc_frame_fit.addObject(fit_param)
             chi2_mc = self.mc_frame_fit.chiSquare('signal', 'mc')
-            ndf_mc = self.n_bins_mc - fit_results_mc.floatParsFinal().getSize()
+            ndf_mc = self.n_bins_mc - mc_fit['n_float_pars']
             fit_param.AddText('#chi^{2} / NDF = ' + f'{chi2_mc:.3f} (NDF: {ndf_mc})')
 
-        # define the fit function and perform the actual fit
-        if extended_likelihood:
-            self.pdf = ROOT.RooAddPdf('total_pdf', 'signal + background', ROOT.RooArgList(signal, background), ROOT.RooArgList(n_signal, n_background))
-        else:
-            self.pdf = ROOT.RooAddPdf('total_pdf', 'signal + background', ROOT.RooArgList(signal, background), ROOT.RooArgList(f))
+        # perform the actual fit
+        self.pdf = model['pdf']
+        self.model = model
 
         mass_array = np.array(self.data_hdl[tree_var_name].values, dtype=np.float64)
-        self.roo_dataset = utils.ndarray2roo(mass_array, mass)
-        fit_results_data = self.pdf.fitTo(self.roo_dataset, ROOT.RooFit.Extended(extended_likelihood), ROOT.RooFit.Save(True), ROOT.RooFit.PrintLevel(-1))
+        binned_fit_data = self.use_binned_fit(mass_array, mass)
+        self.roo_dataset = utils.ndarray2roo(mass_array, mass, binned=binned_fit_data)
+        fit_results_data, fit_time = utils.fit_to(self.pdf, self.roo_dataset, [ROOT.RooFit.Extended(extended_likelihood), ROOT.RooFit.Save(True), ROOT.RooFit.PrintLevel(-1)],
+                                                  self.fit_backend)
+        print(f'Data fit time: {fit_time:.3f} s ({len(mass_array)} candidates, {"binned" if binned_fit_data else "unbinned"})')
+        self.fitted_values = get_par_values(self.model['pars'].values())
 
         ## get fit parameters
         fit_pars = self.pdf.getParameters(self.roo_dataset)
@@ -162,17 +349,17 @@ class SignalExtraction:
         self.data_frame_fit = mass.frame(self.n_bins_data)
         self.data_frame_fit.SetName(self.data_frame_fit_name)
 
+        ## the data and the total pdf are always plotted, they are needed for the chi2
         self.roo_dataset.plotOn(self.data_frame_fit, ROOT.RooFit.Name('data'), ROOT.RooFit.DrawOption('p'))
-        self.pdf.plotOn(self.data_frame_fit, ROOT.RooFit.Components('bkg'), ROOT.RooFit.LineStyle(ROOT.kDashed), ROOT.RooFit.LineColor(kOrangeC))
+        if not self.headless:
+            self.pdf.plotOn(self.data_frame_fit, ROOT.RooFit.Components('bkg'), ROOT.RooFit.LineStyle(ROOT.kDashed), ROOT.RooFit.LineColor(kOrangeC))
         self.pdf.plotOn(self.data_frame_fit, ROOT.RooFit.LineColor(ROOT.kAzure + 2 ), ROOT.RooFit.Name('fit_func'))
 
         chi2_data = self.data_frame_fit.chiSquare('fit_func', 'data')
-        ndf_data = self.n_bins_data - fit_results_data.floatParsFinal().getSize()
+        float_pars = fit_results_data.floatParsFinal()
+        ndf_data = self.n_bins_data - float_pars.getSize()
+        covariance = fit_results_data.covarianceMatrix()
 
-        self.data_frame_fit.GetYaxis().SetTitleSize(0.06)
-        self.data_frame_fit.GetYaxis().SetTitleOffset(0.9)
-        self.data_frame_fit.GetYaxis().SetMaxDigits(2)
-        self.data_frame_fit.GetXaxis().SetTitleOffset(1.1)
 
         # signal within 3 sigma
         mass.setRange('signal', mu_val-3*sigma_val, mu_val+3*sigma_val)
@@ -188,6 +375,44 @@ class SignalExtraction:
         significance_err = utils.significance_error(signal_int_val_3s, bkg_int_val_3s, signal_int_val_3s_error, bkg_int_val_3s_error)
         s_b_ratio_err = np.sqrt((signal_int_val_3s_error/signal_int_val_3s)**2 + (bkg_int_val_3s_error/bkg_int_val_3s)**2)*signal_int_val_3s/bkg_int_val_3s
 
+        if not self.headless:
+            self.decorate_data_frame(decay_string, signal_counts, signal_counts_error, signal_int_val_3s/bkg_int_val_3s, s_b_ratio_err,
+                                     significance, significance_err, mu, sigma, chi2_data, ndf_data)
+
+        fit_stats = {'signal': [signal_counts, signal_counts_error],
+                     'significance': [significance, significance_err], 's_b_ratio': [signal_int_val_3s/bkg_int_val_3s, s_b_ratio_err], 'chi2': chi2_data/ndf_data,
+                     'fit_mode': 'binned' if binned_fit_data else 'unbinned', 'fit_time': fit_time,
+                     'parameters': {par.GetName(): [par.getVal(), par.getError()] for par in float_pars},
+                     'covariance': [[covariance(i_par, j_par) for j_par in range(float_pars.getSize())] for i_par in range(float_pars.getSize())]}
+        if self.mc_hdl != None:
+            fit_stats['fit_mode_mc'] = 'binned' if binned_fit_mc else 'unbinned'
+
+        if rooworkspace_path != None:
+            self.restore_fit()
+            w = ROOT.RooWorkspace('w')
+            sb_model = ROOT.RooStats.ModelConfig('sb_model', w)
+            sb_model.SetPdf(self.pdf)
+            sb_model.SetParametersOfInterest(ROOT.RooArgSet(n_signal))
+            sb_model.SetObservables(ROOT.RooArgSet(mass))
+            getattr(w, 'import')(sb_model)
+            getattr(w, 'import')(self.roo_dataset)
+            w.writeToFile(rooworkspace_path + '/rooworkspace.root', True)
+        
+        if self.out_file != None and not self.headless:
+            self.out_file.cd()
+            self.data_frame_fit.Write()
+            if self.mc_frame_fit != None:
+                self.mc_frame_fit.Write()
+
+        return fit_stats
+
+    def decorate_data_frame(self, decay_string, signal_counts, signal_counts_error, s_b_ratio, s_b_ratio_err, significance, significance_err,
+                            mu, sigma, chi2_data, ndf_data):
+        self.data_frame_fit.GetYaxis().SetTitleSize(0.06)
+        self.data_frame_fit.GetYaxis().SetTitleOffset(0.9)
+        self.data_frame_fit.GetYaxis().SetMaxDigits(2)
+        self.data_frame_fit.GetXaxis().SetTitleOffset(1.1)
+
         # add pave for stats
         pinfo_vals = ROOT.TPaveText(0.632, 0.5, 0.932, 0.85, 'NDC')
         pinfo_vals.SetBorderSize(0)
@@ -195,10 +420,10 @@ class SignalExtraction:
         pinfo_vals.SetTextAlign(11)
         pinfo_vals.SetTextFont(42)
         pinfo_vals.AddText(f'Signal (S): {signal_counts:.0f} #pm {signal_counts_error:.0f}')
-        pinfo_vals.AddText(f'S/B (3 #sigma): {signal_int_val_3s/bkg_int_val_3s:.1f} #pm {s_b_ratio_err:.1f}')
+        pinfo_vals.AddText(f'S/B (3 #sigma): {s_b_ratio:.1f} #pm {s_b_ratio_err:.1f}')
         pinfo_vals.AddText('S/#sqrt{S+B} (3 #sigma): ' + f'{significance:.1f} #pm {significance_err:.1f}')
-        pinfo_vals.AddText('#mu = ' + f'{mu_val*1e3:.2f} #pm {mu.getError()*1e3:.2f}' + ' MeV/#it{c}^{2}')
-        pinfo_vals.AddText('#sigma = ' + f'{sigma_val*1e3:.2f} #pm {sigma.getError()*1e3:.2f}' + ' MeV/#it{c}^{2}')
+        pinfo_vals.AddText('#mu = ' + f'{mu.getVal()*1e3:.2f} #pm {mu.getError()*1e3:.2f}' + ' MeV/#it{c}^{2}')
+        pinfo_vals.AddText('#sigma = ' + f'{sigma.getVal()*1e3:.2f} #pm {sigma.getError()*1e3:.2f}' + ' MeV/#it{c}^{2}')
         pinfo_vals.AddText('#chi^{2} / NDF = ' + f'{chi2_data:.3f} (NDF: {ndf_data})')
 
         ## add pave for ALICE performance
@@ -230,28 +455,20 @@ class SignalExtraction:
             self.data_frame_fit.addObject(pinfo_vals)
         self.data_frame_fit.addObject(pinfo_alice)
 
-        fit_stats = {'signal': [signal_counts, signal_counts_error],
-                     'significance': [significance, significance_err], 's_b_ratio': [signal_int_val_3s/bkg_int_val_3s, s_b_ratio_err], 'chi2': chi2_data/ndf_data}
-
-        if rooworkspace_path != None:
-            w = ROOT.RooWorkspace('w')
-            sb_model = ROOT.RooStats.ModelConfig('sb_model', w)
-            sb_model.SetPdf(self.pdf)
-            sb_model.SetParametersOfInterest(ROOT.RooArgSet(n_signal))
-            sb_model.SetObservables(ROOT.RooArgSet(mass))
-            getattr(w, 'import')(sb_model)
-            getattr(w, 'import')(self.roo_dataset)
-            w.writeToFile(rooworkspace_path + '/rooworkspace.root', True)
-        
-        if self.out_file != None:
-            self.out_file.cd()
-            self.data_frame_fit.Write()
-            if self.mc_frame_fit != None:
-                self.mc_frame_fit.Write()
-
-        return fit_stats
 
+    def restore_fit(self):
+        ## the model may have been refitted by another instance since process_fit, its parameters are set back to the fit of this instance
+        set_par_values(self.model['pars'].values(), self.fitted_values)
+        self.model['mass'].setBins(self.n_bins_binned_fit)
 
+    def get_toy_study(self):
+        ## toys generated from the model fitted by process_fit, with the signal yield as poi (extended likelihood only)
+        if self.model is None or 'n_signal' not in self.model['pars']:
+            raise RuntimeError('The toys need an extended-likelihood fit, run process_fit(extended_likelihood=True) first.')
+        self.restore_fit()
+        toy_study = ToyStudy(self.pdf, self.roo_dataset, self.model['mass'], self.model['pars']['n_signal'])
+        toy_study.fit_backend = self.fit_backend
+        return toy_study
 
     def compute_significance_asymptotic_calc(self, rooworkspace_path, do_local_p0plot=False):
         print("-----------------------------------------------")
@@ -283,23 +500,15 @@ class SignalExtraction:
 
 
         if do_local_p0plot:
-            ### perform a scan in mass and compute the significance
-            masses = []
-            p0_values = []
-            p0_values_expected = []
-            mass_array = np.linspace(w.var('mu').getMin(), w.var('mu').getMax(), 100)
-            for mass in mass_array:
-
-                w.var('mu').setVal(mass)
-                w.var('mu').setConstant(True)
-                asymp_calc_scan = ROOT.RooStats.AsymptoticCalculator(roo_abs_data, sb_model, b_model)
-                asymp_calc_scan.SetOneSidedDiscovery(True)
-                asym_calc_result_scan = asymp_calc_scan.GetHypoTest()
-                null_p_value_scan = asym_calc_result_scan.NullPValue()
-                masses.append(mass)
-                p0_values.append(null_p_value_scan)
-
-                print(f"Mass: {mass} MeV/c^2, p0: {null_p_value_scan:.10f}")
+            ### perform a scan in mass and compute the local p0, starting from the s+b snapshot
+            poi.setVal(sb_model.GetSnapshot().getRealValue(poi.GetName()))
+            p0_scan = LocalP0Scan(sb_model.GetPdf(), roo_abs_data, poi, w.var('mu'))
+            p0_scan.n_points = self.p0_scan_points
+            p0_scan.n_refine_iterations = self.p0_scan_refine_iterations
+            p0_scan.n_refine_points = self.p0_scan_refine_points
+            p0_scan.n_workers = self.n_workers_p0_scan
+            p0_scan.fit_backend = self.fit_backend
+            masses, p0_values = p0_scan.run()
 
             ## create a graph with the p0 values
             self.local_pvalue_graph = ROOT.TGraph(len(masses), np.array(masses), np.array(p0_values))
@@ -350,6 +559,15 @@ if __name__ == '__main__':
     output_file = config['output_file']
     matter_type = config['matter_type']
     compute_significance = config['compute_significance']
+    fit_backend = config.get('fit_backend')
+    n_workers_p0_scan = config.get('n_workers_p0_scan', 1)
+    p0_scan_points = config.get('p0_scan_points', 100)
+    p0_scan_refine_iterations = config.get('p0_scan_refine_iterations', 0)
+    p0_scan_refine_points = config.get('p0_scan_refine_points', 20)
+    n_toys = config.get('n_toys', 0)
+    n_workers_toys = config.get('n_workers_toys', 1)
+    toy_seed = config.get('toy_seed', 42)
+    toy_checkpoint = config.get('toy_checkpoint')
 
     performance = args.performance
     data_hdl = TreeHandler(input_parquet_data)
@@ -368,6 +586,11 @@ if __name__ == '__main__':
     signal_extraction.is_3lh = not config['is_4lh']
     signal_extraction.bkg_fit_func = 'pol2'
     signal_extraction.sigma_range_mc_to_data = [1, 1.3]
+    signal_extraction.fit_backend = fit_backend
+    signal_extraction.n_workers_p0_scan = n_workers_p0_scan
+    signal_extraction.p0_scan_points = p0_scan_points
+    signal_extraction.p0_scan_refine_iterations = p0_scan_refine_iterations
+    signal_extraction.p0_scan_refine_points = p0_scan_refine_points
 
     signal_extraction.colliding_system = config['colliding_system']
     signal_extraction.energy = config['energy']
@@ -380,6 +603,14 @@ if __name__ == '__main__':
     if compute_significance:
         signal_extraction.compute_significance_asymptotic_calc(rooworkspace_path="../results", do_local_p0plot=True)
 
+    if n_toys > 0:
+        toy_study = signal_extraction.get_toy_study()
+        toy_study.seed = toy_seed
+        toy_study.n_workers = n_workers_toys
+        toy_study.checkpoint = toy_checkpoint
+        toy_study.run(n_toys)
+        toy_study.make_histos(n_toys, out_file.mkdir('toys'))
+
     if config['is_4lh']:
         state_label = '4lh'
     else:
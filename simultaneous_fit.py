@@ -0,0 +1,192 @@
+from signal_extraction import SignalExtraction, build_mass_var, build_mass_model, get_par_values, set_par_values, kOrangeC
+import ROOT
+import numpy as np
+
+import sys
+sys.path.append('utils')
+import utils as utils
+
+## signal parameters which can be shared by all the bins (the tails are fixed to the MC of each bin)
+SHAREABLE_PARS = ['mu', 'sigma']
+
+
+## simultaneous fit of the invariant-mass spectra of all the bins: a RooSimultaneous with one state of the 'bin' category per bin,
+## all the yields and background parameters converge together in a single minimisation
+## the model of each (bin, signal function, background function) is built once and kept: the following fits (e.g. the
+## systematic trials) reset its parameters and only swap the datasets
+class SimultaneousSignalExtraction:
+
+    def __init__(self, n_bins, is_3lh=True, shared_pars=None):
+
+        self.n_bins = n_bins
+        self.is_3lh = is_3lh
+        self.shared_pars = shared_pars if shared_pars is not None else []  # e.g. ['mu']: one parameter for all the bins
+        for name in self.shared_pars:
+            if name not in SHAREABLE_PARS:
+                raise ValueError(f'Invalid shared parameter: {name}. Expected one of: {SHAREABLE_PARS}')
+
+        ## fit-related variables, as in SignalExtraction
+        self.n_bins_data = 30
+        self.n_bins_mc = 80
+        self.binned_fit = 'auto'  # True, False or 'auto' (binned if any bin is above binned_fit_threshold)
+        self.binned_fit_threshold = 20000
+        self.n_bins_binned_fit = 480
+        self.mc_fit_cache_dir = None
+        self.mc_weight_col = None
+        self.num_cpu = 1  # processes used by the minimisation
+        self.fit_backend = None  # see utils.get_fit_options, its num_cpu overrides the one above
+        self.headless = False  # only the data and the total pdf are plotted (for the chi2), nothing is written
+
+        self.mass = build_mass_var(is_3lh, '#it{M}_{^{3}He+#pi}' if is_3lh else '#it{M}_{^{4}He+#pi}')
+        self.category = ROOT.RooCategory('bin', 'bin')
+        for ibin in range(n_bins):
+            self.category.defineType(f'bin_{ibin}', ibin)
+
+        ## the shared parameters are taken from a model which is not fitted
+        self._shared_model = build_mass_model(self.mass, is_3lh, 'gaus', 'pol1', suffix='_shared')
+        self._shared_par_vars = {name: self._shared_model['pars'][name] for name in self.shared_pars}
+        self._models = {}  # (ibin, signal_fit_func, bkg_fit_func) -> model
+        self._sim_pdfs = {}  # functions of all the bins -> RooSimultaneous
+        self._initial_values = {}  # parameter name -> (value, error, min, max, constant)
+
+        ## output objects
+        self.sim_pdf = None
+        self.roo_dataset = None
+        self.data_frames_fit = []
+
+    def _save_initial_values(self, pars):
+        for name, values in get_par_values(pars).items():
+            if name not in self._initial_values:
+                self._initial_values[name] = values
+
+    def _reset(self, pars):
+        set_par_values(pars, self._initial_values)
+
+    def get_model(self, ibin, signal_fit_func, bkg_fit_func):
+        key = (ibin, signal_fit_func, bkg_fit_func)
+        if key not in self._models:
+            self._models[key] = build_mass_model(self.mass, self.is_3lh, signal_fit_func, bkg_fit_func, True,
+                                                 f'_{ibin}_{signal_fit_func}_{bkg_fit_func}', self._shared_par_vars)
+            self._save_initial_values(self._models[key]['pars'].values())
+        return self._models[key]
+
+    def get_sim_pdf(self, signal_fit_funcs, bkg_fit_funcs):
+        key = tuple(zip(signal_fit_funcs, bkg_fit_funcs))
+        if key not in self._sim_pdfs:
+            sim_pdf = ROOT.RooSimultaneous(f'sim_pdf_{len(self._sim_pdfs)}', 'simultaneous pdf', self.category)
+            for ibin, (signal_fit_func, bkg_fit_func) in enumerate(key):
+                sim_pdf.addPdf(self.get_model(ibin, signal_fit_func, bkg_fit_func)['pdf'], f'bin_{ibin}')
+            self._sim_pdfs[key] = sim_pdf
+        return self._sim_pdfs[key]
+
+    def _combine_datasets(self, datasets, binned):
+        if binned:
+            data_map = ROOT.std.map['std::string', 'RooDataHist*']()
+        else:
+            data_map = ROOT.std.map['std::string', 'RooDataSet*']()
+        for ibin, dataset in enumerate(datasets):
+            data_map[f'bin_{ibin}'] = dataset
+        if binned:
+            return ROOT.RooDataHist('data_sim', 'binned datasets of all the bins', ROOT.RooArgList(self.mass), self.category, data_map)
+        return ROOT.RooDataSet('data_sim', 'datasets of all the bins', ROOT.RooArgSet(self.mass), ROOT.RooFit.Index(self.category), ROOT.RooFit.Import(data_map))
+
+    ## data_hdls, mc_hdls, signal_fit_funcs, bkg_fit_funcs, sigma_ranges_mc_to_data, mc_fit_labels, bin_labels: one entry per bin
+    ## returns the fit_stats of each bin, as SignalExtraction.process_fit
+    def process_fit(self, data_hdls, mc_hdls, signal_fit_funcs, bkg_fit_funcs, sigma_ranges_mc_to_data, mc_fit_labels=None,
+                    bin_labels=None, out_file=None):
+
+        tree_var_name = 'fMassH3L' if self.is_3lh else 'fMassH4L'
+        ## only used by the binned datasets
+        self.mass.setBins(self.n_bins_binned_fit)
+        self.sim_pdf = self.get_sim_pdf(signal_fit_funcs, bkg_fit_funcs)
+        models = [self.get_model(ibin, signal_fit_funcs[ibin], bkg_fit_funcs[ibin]) for ibin in range(self.n_bins)]
+        for model in models:
+            self._reset([par for name, par in model['pars'].items() if name not in self.shared_pars])
+        self._reset(self._shared_par_vars.values())
+
+        # fix the tails to the MC of each bin, the shared parameters start from the average of the bins
+        mc_vals = {name: [] for name in self.shared_pars}
+        sigma_limits = []
+        for ibin, model in enumerate(models):
+            if mc_hdls[ibin] is None:
+                continue
+            signal_extraction = SignalExtraction(data_hdls[ibin], mc_hdls[ibin])
+            signal_extraction.is_3lh = self.is_3lh
+            signal_extraction.signal_fit_func = signal_fit_funcs[ibin]
+            signal_extraction.binned_fit = self.binned_fit
+            signal_extraction.binned_fit_threshold = self.binned_fit_threshold
+            signal_extraction.n_bins_binned_fit = self.n_bins_binned_fit
+            signal_extraction.mc_fit_cache_label = mc_fit_labels[ibin] if mc_fit_labels is not None else ''
+            signal_extraction.mc_fit_cache_dir = self.mc_fit_cache_dir
+            signal_extraction.mc_weight_col = self.mc_weight_col
+            signal_extraction.fit_backend = self.fit_backend
+            signal_extraction.fit_mc_shape(self.mass, model)
+            for name in ['a1', 'a2', 'n1', 'n2']:
+                model['pars'][name].setConstant()
+            for name in self.shared_pars:
+                mc_vals[name].append(model['pars'][name].getVal())
+            sigma = model['pars']['sigma']
+            sigma_limits.append([sigma_ranges_mc_to_data[ibin][0] * sigma.getVal(), sigma_ranges_mc_to_data[ibin][1] * sigma.getVal()])
+            if 'sigma' not in self.shared_pars:
+                sigma.setRange(sigma_limits[-1][0], sigma_limits[-1][1])
+        for name, vals in mc_vals.items():
+            if len(vals) > 0:
+                self._shared_par_vars[name].setVal(np.mean(vals))
+        if 'sigma' in self.shared_pars and len(sigma_limits) > 0:
+            sigma_limits = np.array(sigma_limits)
+            self._shared_par_vars['sigma'].setRange(sigma_limits[:, 0].min(), sigma_limits[:, 1].max())
+
+        # build the datasets, the same binning choice is used for all the bins
+        mass_arrays = [np.array(data_hdl[tree_var_name].values, dtype=np.float64) for data_hdl in data_hdls]
+        binned_fit_data = self.binned_fit
+        if self.binned_fit == 'auto':
+            in_range = [np.count_nonzero(np.logical_and(mass_array >= self.mass.getMin(), mass_array <= self.mass.getMax())) for mass_array in mass_arrays]
+            binned_fit_data = max(in_range) > self.binned_fit_threshold
+        datasets = [utils.ndarray2roo(mass_array, self.mass, f'data_{ibin}', binned=binned_fit_data) for ibin, mass_array in enumerate(mass_arrays)]
+        self.roo_dataset = self._combine_datasets(datasets, binned_fit_data)
+
+        fit_backend = dict(self.fit_backend) if self.fit_backend is not None else {}
+        if 'num_cpu' not in fit_backend:
+            fit_backend['num_cpu'] = self.num_cpu
+        _, fit_time = utils.fit_to(self.sim_pdf, self.roo_dataset, [ROOT.RooFit.Extended(True), ROOT.RooFit.Save(True), ROOT.RooFit.PrintLevel(-1)], fit_backend)
+        print(f'Simultaneous fit time: {fit_time:.3f} s ({sum(len(mass_array) for mass_array in mass_arrays)} candidates, {"binned" if binned_fit_data else "unbinned"})')
+
+        ## results and frames of each bin
+        fit_stats_bins = []
+        self.data_frames_fit = []
+        for ibin, model in enumerate(models):
+            float_pars = [par for par in model['pdf'].getParameters(ROOT.RooArgSet(self.mass)) if not par.isConstant()]
+            frame = self.mass.frame(self.n_bins_data)
+            frame.SetName(f'data_fit_{ibin}')
+            datasets[ibin].plotOn(frame, ROOT.RooFit.Name('data'), ROOT.RooFit.DrawOption('p'))
+            if not self.headless:
+                model['pdf'].plotOn(frame, ROOT.RooFit.Components(model['background'].GetName()), ROOT.RooFit.LineStyle(ROOT.kDashed), ROOT.RooFit.LineColor(kOrangeC))
+            model['pdf'].plotOn(frame, ROOT.RooFit.LineColor(ROOT.kAzure + 2), ROOT.RooFit.Name('fit_func'))
+            chi2_data = frame.chiSquare('fit_func', 'data')
+            ndf_data = self.n_bins_data - len(float_pars)
+            n_signal = model['pars']['n_signal']
+            fit_stats_bins.append({'signal': [n_signal.getVal(), n_signal.getError()], 'chi2': chi2_data/ndf_data,
+                                   'fit_mode': 'binned' if binned_fit_data else 'unbinned', 'fit_time': fit_time,
+                                   'parameters': {par.GetName(): [par.getVal(), par.getError()] for par in float_pars}})
+            if self.headless:
+                continue
+
+            pinfo_vals = ROOT.TPaveText(0.632, 0.5, 0.932, 0.85, 'NDC')
+            pinfo_vals.SetBorderSize(0)
+            pinfo_vals.SetFillStyle(0)
+            pinfo_vals.SetTextAlign(11)
+            pinfo_vals.SetTextFont(42)
+            if bin_labels is not None:
+                pinfo_vals.AddText(bin_labels[ibin])
+            pinfo_vals.AddText(f'Signal (S): {n_signal.getVal():.0f} #pm {n_signal.getError():.0f}')
+            pinfo_vals.AddText('#chi^{2} / NDF = ' + f'{chi2_data:.3f} (NDF: {ndf_data})')
+            pinfo_vals.AddText('simultaneous fit')
+            frame.addObject(pinfo_vals)
+            self.data_frames_fit.append(frame)
+
+        if out_file != None:
+            out_file.cd()
+            for frame in self.data_frames_fit:
+                frame.Write()
+
+        return fit_stats_bins
@@ -1,6 +1,9 @@
 from signal_extraction import SignalExtraction
+from simultaneous_fit import SimultaneousSignalExtraction
+from cut_masks import get_cut_mask_cache
 import ROOT
 import numpy as np
+import pandas as pd
 
 import sys
 sys.path.append('utils')
@@ -35,6 +38,8 @@ class SpectraMaker:
         self.raw_counts = []
         self.raw_counts_err = []
         self.chi2 = []
+        self.fit_modes = []  # binned or unbinned, per bin
+        self.fit_times = []  # wall time of the data fit (s), per bin, as measured when the fit was done
         self.efficiency = []
 
         self.corrected_counts = []
@@ -46,6 +51,32 @@ class SpectraMaker:
         self.fit_options = None
         self.fit_range = []
         self.sigma_range_mc_to_data = [1., 1.5]
+        self.binned_fit = 'auto'  # True, False or 'auto', see SignalExtraction
+        self.binned_fit_threshold = 20000
+        self.n_bins_binned_fit = 480
+        self.mc_fit_cache_dir = None  # on-disk cache of the MC signal-shape fits, see SignalExtraction
+        # row positions of the candidates in each bin, computed once per handler
+        self._bin_positions = {}
+        # masks of the elementary cuts of each handler, can be shared by several SpectraMaker with the same handlers
+        self.cut_mask_caches = {}
+        # thresholds of the systematic variations (see cut_masks.get_threshold_grid), used to count the reconstructed MC
+        self.threshold_grid = None
+        # results of the invariant-mass fits of each bin, keyed on everything the fit depends on (see SignalExtraction.get_fit_key),
+        # reused when the same bin, selection and fit functions come back (e.g. in the systematic trials)
+        self.bin_fit_store = {}
+        # persistent store of the fit results (see fit_store.FitResultStore), shared by the scripts and the following runs
+        self.fit_store = None
+        # weight column of the MC (e.g. the pT spectrum weights of utils.reweight_pt_spectrum), None for unweighted MC
+        self.mc_weight_col = None
+        # fit all the bins at once with a RooSimultaneous (see SimultaneousSignalExtraction) instead of one fit per bin
+        self.simultaneous_fit = False
+        self.shared_signal_pars = []  # signal parameters shared by all the bins in the simultaneous fit, e.g. ['mu']
+        self.n_cpu_simultaneous_fit = 1
+        self._simultaneous_extraction = None
+        # fits without frames and paves (see SignalExtraction.headless), e.g. for the systematic trials
+        self.headless_fits = False
+        # RooFit evaluation backend, parallelisation and minimizer settings of the fits (see utils.get_fit_options)
+        self.fit_backend = None
 
         self.output_dir = None
 
@@ -76,10 +107,78 @@ class SpectraMaker:
         if not self.mc_reco_hdl:
             raise ValueError(f'mc_reco_hdl not correctly set')
 
+    def _get_bin_positions(self, hdl, var, ibin, absolute=False):
+        ## row positions of the candidates in the bin ibin of var (bin edges excluded, as in 'var > low & var < high'),
+        ## the bin of each candidate is computed in a single pass the first time a handler is used
+        df = hdl if isinstance(hdl, pd.DataFrame) else hdl.get_data_frame()
+        key = (id(df), var, absolute, tuple(self.bins))
+        if key not in self._bin_positions or self._bin_positions[key][0] is not df:
+            bins = np.array(self.bins, dtype=np.float64)
+            values = df[var].to_numpy(dtype=np.float64)
+            if absolute:
+                values = np.abs(values)
+            bin_index = np.digitize(values, bins) - 1
+            bin_index[np.isin(values, bins)] = -1
+            bin_index[bin_index >= len(bins) - 1] = -1
+            ## stable sort, the candidates keep their order within each bin
+            order = np.argsort(bin_index, kind='stable')
+            bin_starts = np.searchsorted(bin_index[order], np.arange(len(bins)))
+            positions = [order[bin_starts[i]:bin_starts[i + 1]] for i in range(len(bins) - 1)]
+            self._bin_positions[key] = (df, positions)
+        return df, (key, ibin), self._bin_positions[key][1][ibin]
+
+    def _get_bin_df(self, hdl, var, ibin, absolute=False, selection=''):
+        ## candidates of the bin passing the selection
+        df, _, positions = self._get_bin_positions(hdl, var, ibin, absolute)
+        if selection != '':
+            mask = get_cut_mask_cache(self.cut_mask_caches, df, self.threshold_grid).get_mask(selection)
+            positions = positions[mask[positions]]
+        return df.iloc[positions]
+
+    def _count_bin(self, hdl, var, ibin, absolute=False, selection='', weight_col=None):
+        ## number of candidates of the bin passing the selection (sum of their weight_col if given),
+        ## the thresholds of threshold_grid are counted without masks
+        df, positions_key, positions = self._get_bin_positions(hdl, var, ibin, absolute)
+        if selection == '' and weight_col is None:
+            return len(positions)
+        mask_cache = get_cut_mask_cache(self.cut_mask_caches, df, self.threshold_grid)
+        if selection == '':
+            return float(np.sum(mask_cache.get_weights(weight_col)[positions]))
+        return mask_cache.count(selection, positions, positions_key, weight_col)
+
+    def _load_bin_fit(self, fit_key):
+        ## fit_stats of a fit already done in this job or stored by a previous one, None if not found
+        if fit_key in self.bin_fit_store:
+            return self.bin_fit_store[fit_key]
+        if self.fit_store is not None:
+            stored_fit = self.fit_store.get(fit_key)
+            if stored_fit is not None:
+                fit_stats, frames = stored_fit
+                if frames is not None and self.output_dir is not None:
+                    self.output_dir.cd()
+                    for frame in frames:
+                        frame.Write()
+                self.bin_fit_store[fit_key] = fit_stats
+                return fit_stats
+        return None
+
+    def _store_bin_fit(self, fit_key, fit_stats, frames, label):
+        self.bin_fit_store[fit_key] = fit_stats
+        if self.fit_store is not None:
+            self.fit_store.put(fit_key, fit_stats, frames, label)
+
     def make_spectra(self):
 
         self._check_members()
 
+        if self.var == 'fCt':
+            mc_var, mc_var_abs = 'fGenCt', False
+        else:
+            mc_var, mc_var_abs = 'fGenPt', True
+
+        ## configured signal extractions of the bins, fitted together at the end in the simultaneous mode
+        bin_signal_extractions = []
+
         for ibin in range(0, len(self.bins) - 1):
             bin = [self.bins[ibin], self.bins[ibin + 1]]
             bin_sel = f'{self.var} > {bin[0]} & {self.var} < {bin[1]}'
@@ -90,25 +189,27 @@ class SpectraMaker:
                 mc_bin_sel = f'abs(fGenPt) > {bin[0]} & abs(fGenPt) < {bin[1]}'
 
             # count generated per ct bin
-            bin_mc_hdl = self.mc_hdl.apply_preselections(mc_bin_sel, inplace=False)
+            n_mc_gen = self._count_bin(self.mc_hdl, mc_var, ibin, mc_var_abs, weight_col=self.mc_weight_col)
             if self.mc_hdl_sign_extr:
-                bin_mc_hdl_sign_extr = self.mc_hdl_sign_extr.apply_preselections(mc_bin_sel, inplace=False)
+                bin_mc_hdl_sign_extr = self._get_bin_df(self.mc_hdl_sign_extr, mc_var, ibin, mc_var_abs)
             else:
-                bin_mc_hdl_sign_extr = bin_mc_hdl
+                bin_mc_hdl_sign_extr = self._get_bin_df(self.mc_hdl, mc_var, ibin, mc_var_abs)
+            ## the MC sample used for the signal shape does not depend on the selections
+            mc_sign_extr_sel = mc_bin_sel
 
             if isinstance(self.selection_string, list):
-                bin_sel = f'{bin_sel} and {self.selection_string[ibin]}'
-                mc_bin_sel = f'{mc_bin_sel} and {self.selection_string[ibin]}'
+                selection = self.selection_string[ibin]
             else:
-                bin_sel = f'{bin_sel} and {self.selection_string}'
-                mc_bin_sel = f'{mc_bin_sel} and {self.selection_string}'
+                selection = self.selection_string
+            bin_sel = f'{bin_sel} and {selection}'
+            mc_bin_sel = f'{mc_bin_sel} and {selection}'
 
-            # select reconstructed in data and mc
-            bin_data_hdl = self.data_hdl.apply_preselections(bin_sel, inplace=False)
-            bin_mc_reco_hdl = self.mc_reco_hdl.apply_preselections(mc_bin_sel, inplace=False)
+            # select reconstructed in data and mc, each elementary cut is evaluated only once per handler
+            bin_data_hdl = self._get_bin_df(self.data_hdl, self.var, ibin, selection=selection)
+            n_mc_reco = self._count_bin(self.mc_reco_hdl, mc_var, ibin, mc_var_abs, selection=selection, weight_col=self.mc_weight_col)
 
             # compute efficiency
-            eff = len(bin_mc_reco_hdl) / len(bin_mc_hdl)
+            eff = n_mc_reco / n_mc_gen
             print(mc_bin_sel)
             print("bin low", bin[0], "bin high", bin[1], "efficiency", eff)
             self.efficiency.append(eff)
@@ -131,6 +232,14 @@ class SpectraMaker:
             signal_extraction.signal_fit_func = sgn_mass_fit_func
             signal_extraction.n_bins_data = self.n_bins_mass_data
             signal_extraction.n_bins_mc = self.n_bins_mass_mc
+            signal_extraction.binned_fit = self.binned_fit
+            signal_extraction.binned_fit_threshold = self.binned_fit_threshold
+            signal_extraction.n_bins_binned_fit = self.n_bins_binned_fit
+            signal_extraction.mc_fit_cache_label = mc_sign_extr_sel
+            signal_extraction.mc_fit_cache_dir = self.mc_fit_cache_dir
+            signal_extraction.mc_weight_col = self.mc_weight_col
+            signal_extraction.headless = self.headless_fits
+            signal_extraction.fit_backend = self.fit_backend
             signal_extraction.n_evts = self.n_ev
             signal_extraction.matter_type = self.is_matter
             signal_extraction.performance = False
@@ -152,11 +261,60 @@ class SpectraMaker:
             else:
                 signal_extraction.sigma_range_mc_to_data = self.sigma_range_mc_to_data
 
-            fit_stats = signal_extraction.process_fit()
-            
+            if self.simultaneous_fit:
+                bin_signal_extractions.append(signal_extraction)
+                continue
+
+            fit_key = signal_extraction.get_fit_key()
+            fit_stats = self._load_bin_fit(fit_key)
+            if fit_stats is not None:
+                ## the frames are only written by the first fit of the job, or if they are in the persistent store
+                print(f'Reusing the fit of bin {ibin} ({sgn_mass_fit_func} + {bkg_mass_fit_func})')
+            else:
+                fit_stats = signal_extraction.process_fit()
+                frames = None if self.headless_fits else [signal_extraction.data_frame_fit, signal_extraction.mc_frame_fit]
+                self._store_bin_fit(fit_key, fit_stats, frames, f'{bin_sel} | {sgn_mass_fit_func} + {bkg_mass_fit_func}')
+
+            self.raw_counts.append(fit_stats['signal'][0])
+            self.raw_counts_err.append(fit_stats['signal'][1])
+            self.chi2.append(fit_stats['chi2'])
+            self.fit_modes.append(fit_stats['fit_mode'])
+            self.fit_times.append(fit_stats['fit_time'])
+
+        if self.simultaneous_fit:
+            self._fit_simultaneous(bin_signal_extractions)
+
+    def _fit_simultaneous(self, signal_extractions):
+        ## the simultaneous model is kept by the SpectraMaker, the following calls (e.g. the systematic trials) only swap the datasets
+        sim_extraction = self._simultaneous_extraction
+        if sim_extraction is None or sim_extraction.n_bins != len(signal_extractions) or sim_extraction.shared_pars != list(self.shared_signal_pars):
+            sim_extraction = SimultaneousSignalExtraction(len(signal_extractions), shared_pars=list(self.shared_signal_pars))
+            self._simultaneous_extraction = sim_extraction
+        sim_extraction.n_bins_data = self.n_bins_mass_data
+        sim_extraction.n_bins_mc = self.n_bins_mass_mc
+        sim_extraction.binned_fit = self.binned_fit
+        sim_extraction.binned_fit_threshold = self.binned_fit_threshold
+        sim_extraction.n_bins_binned_fit = self.n_bins_binned_fit
+        sim_extraction.mc_fit_cache_dir = self.mc_fit_cache_dir
+        sim_extraction.mc_weight_col = self.mc_weight_col
+        sim_extraction.num_cpu = self.n_cpu_simultaneous_fit
+        sim_extraction.headless = self.headless_fits
+        sim_extraction.fit_backend = self.fit_backend
+
+        fit_stats_bins = sim_extraction.process_fit([sign_extr.data_hdl for sign_extr in signal_extractions],
+                                                    [sign_extr.mc_hdl for sign_extr in signal_extractions],
+                                                    [sign_extr.signal_fit_func for sign_extr in signal_extractions],
+                                                    [sign_extr.bkg_fit_func for sign_extr in signal_extractions],
+                                                    [sign_extr.sigma_range_mc_to_data for sign_extr in signal_extractions],
+                                                    [sign_extr.mc_fit_cache_label for sign_extr in signal_extractions],
+                                                    [sign_extr.additional_pave_text for sign_extr in signal_extractions],
+                                                    self.output_dir)
+        for fit_stats in fit_stats_bins:
             self.raw_counts.append(fit_stats['signal'][0])
             self.raw_counts_err.append(fit_stats['signal'][1])
             self.chi2.append(fit_stats['chi2'])
+            self.fit_modes.append(fit_stats['fit_mode'])
+            self.fit_times.append(fit_stats['fit_time'])
 
     def make_histos(self):
 
@@ -235,6 +393,9 @@ class SpectraMaker:
     def del_dyn_members(self):
         self.raw_counts = []
         self.raw_counts_err = []
+        self.chi2 = []
+        self.fit_modes = []
+        self.fit_times = []
         self.efficiency = []
         self.corrected_counts = []
         self.corrected_counts_err = []
@@ -1,5 +1,6 @@
 from spectra import SpectraMaker
-from hipe4ml.tree_handler import TreeHandler
+from cut_masks import get_threshold_grid
+from fit_store import FitResultStore
 import yaml
 import argparse
 import uproot
@@ -54,6 +55,14 @@ if __name__ == '__main__':
     n_bins_mass_data = config['n_bins_mass_data']
     n_bins_mass_mc = config['n_bins_mass_mc']
 
+    cache_dir = config.get('cache_dir')
+    cache_max_size_gb = config.get('cache_max_size_gb', 50)
+    fit_store_path = config.get('fit_store')
+    fit_store_frames = config.get('fit_store_frames', False)
+    mc_weights = config.get('mc_weights', False)
+    mc_weight_col = utils.PT_WEIGHT_COLUMN if mc_weights else None
+    fit_backend = config.get('fit_backend')
+
     matter_options = ['matter', 'antimatter', 'both']
     if is_matter not in matter_options:
         raise ValueError(
@@ -68,18 +77,7 @@ if __name__ == '__main__':
     print("----------------------------------")
     print("** Loading data and apply preselections **")
 
-    data_hdl = TreeHandler(input_file_name_data, 'O2hypcands', folder_name='DF*')
-    mc_hdl = TreeHandler(input_file_name_mc, 'O2mchypcands', folder_name='DF*')
-
-    # declare output file
-    output_file = ROOT.TFile.Open(f'{output_dir_name}/{output_file_name}', 'recreate')
-
-    # Add columns to the handlers
-    print("Data summary:", data_hdl.print_summary())
-    utils.correct_and_convert_df(data_hdl, calibrate_he3_pt=True)
-    utils.correct_and_convert_df(mc_hdl, calibrate_he3_pt=True, isMC=True)
-
-    # apply preselections
+    # matter selections, applied while reading the trees
     matter_sel = ''
     mc_matter_sel = ''
     if is_matter == 'matter':
@@ -90,9 +88,15 @@ if __name__ == '__main__':
         matter_sel = 'fIsMatter == False'
         mc_matter_sel = 'fGenPt < 0'
 
-    if matter_sel != '':
-        data_hdl.apply_preselections(matter_sel)
-        mc_hdl.apply_preselections(mc_matter_sel)
+    # read the trees, add columns to the handlers and apply preselections
+    data_hdl = utils.get_tree_handler(input_file_name_data, 'O2hypcands', cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb,
+                                      preselections=matter_sel, calibrate_he3_pt=True)
+    mc_hdl = utils.get_tree_handler(input_file_name_mc, 'O2mchypcands', cache_dir=cache_dir, cache_max_size_gb=cache_max_size_gb,
+                                    preselections=mc_matter_sel, calibrate_he3_pt=True, isMC=True)
+    print("Data summary:", data_hdl.print_summary())
+
+    # declare output file
+    output_file = ROOT.TFile.Open(f'{output_dir_name}/{output_file_name}', 'recreate')
 
     # get Standard Spectrum
     standard_file = ROOT.TFile(
@@ -110,7 +114,7 @@ if __name__ == '__main__':
     spectra_file = ROOT.TFile.Open('utils/heliumSpectraMB.root')
     he3_spectrum = spectra_file.Get('fCombineHeliumSpecLevyFit_0-100')
     spectra_file.Close()
-    utils.reweight_pt_spectrum(mc_hdl, 'fAbsGenPt', he3_spectrum)
+    utils.reweight_pt_spectrum(mc_hdl, 'fAbsGenPt', he3_spectrum, weight_col=mc_weight_col)
 
     mc_hdl.apply_preselections('rej==True')
     # Needed to remove the peak at 28.5 cm in the anchored MC
@@ -150,6 +154,12 @@ if __name__ == '__main__':
 
     print("  ** separated cuts **")
 
+    # masks of the elementary cuts, thresholds and fit results, shared by all the variations
+    cut_mask_caches = {}
+    bin_fit_store = {}
+    fit_store = FitResultStore(fit_store_path, fit_store_frames) if fit_store_path is not None else None
+    threshold_grid = get_threshold_grid(cut_dict_syst)
+
     spectra_dict = {}
     canvas_dict = {}
     legend_dict = {}
@@ -179,6 +189,12 @@ if __name__ == '__main__':
             spectra_maker.data_hdl = data_hdl
             spectra_maker.mc_hdl = mc_hdl
             spectra_maker.mc_reco_hdl = mc_reco_hdl
+            spectra_maker.cut_mask_caches = cut_mask_caches
+            spectra_maker.threshold_grid = threshold_grid
+            spectra_maker.bin_fit_store = bin_fit_store
+            spectra_maker.fit_store = fit_store
+            spectra_maker.mc_weight_col = mc_weight_col
+            spectra_maker.fit_backend = fit_backend
 
             spectra_maker.n_ev = n_ev
             spectra_maker.branching_ratio = 0.25
@@ -0,0 +1,220 @@
+import ROOT
+import numpy as np
+import hashlib
+import json
+import multiprocessing
+import os
+
+import sys
+sys.path.append('utils')
+import utils as utils
+
+## generation hypotheses: 'sb' with the parameters fitted to the data (pulls and bias of the signal), 'b' with poi = 0 (toy p-value)
+HYPOTHESES = ['sb', 'b']
+
+## study being run by the pool, the forked processes inherit it (with its model) instead of receiving a pickled copy
+_active_study = None
+
+
+def _run_toy_chunk(chunk):
+    hypothesis, toy_indices = chunk
+    return [_active_study.run_toy(hypothesis, i_toy) for i_toy in toy_indices]
+
+
+## pseudo-experiments generated from the model fitted to the data (e.g. SignalExtraction.pdf after process_fit):
+## each toy is generated with pdf.generate (extended, with a seed derived from seed, hypothesis and toy index, so that each toy is
+## reproducible whichever process runs it) and fitted twice, with the poi floating and fixed to 0, for the discovery test statistic
+## q0 = 2 (NLL(poi = 0) - NLL(best fit)) (q0 = 0 if the best-fit poi is negative)
+## the toys are distributed over a pool of forked processes in chunks of checkpoint_every toys, the result of each toy is appended
+## to the checkpoint file (json lines) as soon as its chunk is done, and the toys already in the file are not repeated
+class ToyStudy:
+
+    def __init__(self, pdf, data, mass, poi):
+        self.pdf = pdf
+        self.data = data
+        self.mass = mass
+        self.poi = poi  # e.g. n_signal
+
+        self.seed = 42
+        self.n_workers = 1
+        self.checkpoint = None  # path of the checkpoint file, in memory only if not set
+        self.checkpoint_every = 50
+        self.binned = isinstance(data, ROOT.RooDataHist)  # toys fitted as RooDataHist with the binning of mass
+        self.fit_backend = None  # see utils.get_fit_options
+
+        ## the toys are generated and fitted starting from the current (fitted) values of the parameters
+        self._pars = [par for par in pdf.getParameters(data) if not par.isConstant()]
+        self._fitted_values = {par.GetName(): par.getVal() for par in self._pars}
+        self._generation_values = {'sb': dict(self._fitted_values), 'b': dict(self._fitted_values, **{poi.GetName(): 0.})}
+        self.key = None
+
+        self.results = {hypothesis: {} for hypothesis in HYPOTHESES}  # i_toy -> result
+        self.q0_obs = None
+
+    def get_data_hash(self):
+        ## hash of the mass values (bin centres for a RooDataHist) and weights of the data
+        if hasattr(self.data, 'to_numpy'):
+            arrays = self.data.to_numpy()
+            arrays = [np.asarray(arrays[name], dtype=np.float64) for name in sorted(arrays)]
+        else:
+            values = np.empty(self.data.numEntries())
+            weights = np.empty(self.data.numEntries())
+            for i_entry in range(self.data.numEntries()):
+                values[i_entry] = self.data.get(i_entry).getRealValue(self.mass.GetName())
+                weights[i_entry] = self.data.weight()
+            arrays = [values, weights]
+        data_hash = hashlib.sha256()
+        for array in arrays:
+            data_hash.update(np.ascontiguousarray(array).tobytes())
+        return data_hash.hexdigest()
+
+    def get_key(self):
+        ## toys of the same study: same seed, generation values, binning, model (components and fixed parameters) and data
+        ## (the floating parameters are in the generation values)
+        components = sorted([component.GetName(), component.ClassName()] for component in self.pdf.getComponents())
+        fixed_values = sorted([par.GetName(), par.getVal()] for par in self.pdf.getParameters(self.data) if par.isConstant())
+        key_info = [self.seed, self._generation_values, bool(self.binned), self.mass.getBins() if self.binned else 0, self.pdf.GetName(),
+                    components, fixed_values, self.get_data_hash()]
+        return hashlib.sha256(json.dumps(key_info).encode()).hexdigest()
+
+    def _set_values(self, values):
+        for par in self._pars:
+            par.setVal(values[par.GetName()])
+            par.setError(0.)
+
+    def _fit(self, dataset, fix_poi):
+        self._set_values(self._fitted_values)
+        if fix_poi:
+            self.poi.setVal(0.)
+            self.poi.setConstant(True)
+        ## no offset, the minimum NLL of the two fits are compared
+        try:
+            fit_result, _ = utils.fit_to(self.pdf, dataset, [ROOT.RooFit.Extended(True), ROOT.RooFit.Offset(False), ROOT.RooFit.Save(True),
+                                                             ROOT.RooFit.PrintLevel(-1)], self.fit_backend)
+        finally:
+            self.poi.setConstant(False)
+        return fit_result
+
+    def get_q0(self, dataset):
+        ## (q0, poi, poi error, fit status) of a dataset
+        fit_result_null = self._fit(dataset, True)
+        fit_result = self._fit(dataset, False)
+        poi_val = self.poi.getVal()
+        q0 = max(2 * (fit_result_null.minNll() - fit_result.minNll()), 0.) if poi_val > 0 else 0.
+        return q0, poi_val, self.poi.getError(), max(fit_result.status(), fit_result_null.status())
+
+    def get_toy_seed(self, hypothesis, i_toy):
+        ## TRandom3 is seeded with 0 from the time: the seeds start from 1
+        return int(np.random.SeedSequence([self.seed, HYPOTHESES.index(hypothesis), i_toy]).generate_state(1)[0]) + 1
+
+    def run_toy(self, hypothesis, i_toy):
+        self._set_values(self._generation_values[hypothesis])
+        ROOT.RooRandom.randomGenerator().SetSeed(self.get_toy_seed(hypothesis, i_toy))
+        toy_data = self.pdf.generate(ROOT.RooArgSet(self.mass), ROOT.RooFit.Extended(True))
+        if self.binned:
+            toy_data = ROOT.RooDataHist(f'toy_{hypothesis}_{i_toy}', 'toy', ROOT.RooArgSet(self.mass), toy_data)
+        q0, poi_val, poi_err, status = self.get_q0(toy_data)
+        poi_true = self._generation_values[hypothesis][self.poi.GetName()]
+        return {'key': self.key, 'hypothesis': hypothesis, 'i_toy': i_toy, 'n_entries': toy_data.sumEntries(), 'status': status,
+                'poi': poi_val, 'poi_err': poi_err, 'poi_true': poi_true, 'q0': q0,
+                'pull': (poi_val - poi_true) / poi_err if poi_err > 0 else np.nan}
+
+    def load_checkpoint(self):
+        ## results of the toys of this study (same key) already in the checkpoint file
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            for line in f:
+                ## the last line may be incomplete if the job was killed while writing it
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if result['key'] == self.key:
+                    self.results[result['hypothesis']][result['i_toy']] = result
+
+    def save_results(self, results):
+        for result in results:
+            self.results[result['hypothesis']][result['i_toy']] = result
+        if self.checkpoint is not None:
+            if os.path.dirname(self.checkpoint) != '':
+                os.makedirs(os.path.dirname(self.checkpoint), exist_ok=True)
+            with open(self.checkpoint, 'a') as f:
+                for result in results:
+                    f.write(json.dumps(result) + '\n')
+
+    def run(self, n_toys, hypotheses=HYPOTHESES):
+        global _active_study
+        key = self.get_key()
+        if key != self.key:
+            self.key = key
+            self.results = {hypothesis: {} for hypothesis in HYPOTHESES}
+            self.q0_obs = None
+        self.load_checkpoint()
+        if self.q0_obs is None:
+            self.q0_obs = self.get_q0(self.data)[0]
+            self._set_values(self._fitted_values)
+
+        chunks = []
+        for hypothesis in hypotheses:
+            missing = [i_toy for i_toy in range(n_toys) if i_toy not in self.results[hypothesis]]
+            print(f'Toys ({hypothesis}): {n_toys - len(missing)} / {n_toys} already done')
+            chunks += [(hypothesis, missing[i_start:i_start + self.checkpoint_every]) for i_start in range(0, len(missing), self.checkpoint_every)]
+
+        if self.n_workers > 1 and len(chunks) > 0:
+            _active_study = self
+            with multiprocessing.get_context('fork').Pool(self.n_workers) as pool:
+                for results in pool.imap_unordered(_run_toy_chunk, chunks):
+                    self.save_results(results)
+        else:
+            for hypothesis, toy_indices in chunks:
+                self.save_results([self.run_toy(hypothesis, i_toy) for i_toy in toy_indices])
+        self._set_values(self._fitted_values)
+
+    def get_results(self, hypothesis, n_toys=None, converged_only=True):
+        ## results of the toys of a hypothesis, in the order of the toys
+        results = [self.results[hypothesis][i_toy] for i_toy in sorted(self.results[hypothesis]) if n_toys is None or i_toy < n_toys]
+        if converged_only:
+            results = [result for result in results if result['status'] == 0]
+        return results
+
+    def get_toy_p_value(self, n_toys=None):
+        ## fraction of the background-only toys with q0 >= q0 of the data, with its binomial error, and the corresponding significance
+        q0_values = np.array([result['q0'] for result in self.get_results('b', n_toys)])
+        if len(q0_values) == 0:
+            return np.nan, np.nan, np.nan
+        p_value = np.count_nonzero(q0_values >= self.q0_obs) / len(q0_values)
+        p_value_err = np.sqrt(p_value * (1 - p_value) / len(q0_values))
+        return p_value, p_value_err, ROOT.RooStats.PValueToSignificance(p_value) if p_value > 0 else np.inf
+
+    def make_histos(self, n_toys=None, out_file=None):
+        results_sb = self.get_results('sb', n_toys)
+        results_b = self.get_results('b', n_toys)
+        poi_name = self.poi.GetName()
+        h_pull = ROOT.TH1D('hPull', f';({poi_name} - {poi_name}_{{true}}) / #sigma;Toys', 100, -5, 5)
+        h_bias = ROOT.TH1D('hBias', f';({poi_name} - {poi_name}_{{true}}) / {poi_name}_{{true}};Toys', 100, -1, 1)
+        h_q0_sb = ROOT.TH1D('hQ0SB', ';q_{0};Toys', 100, 0, max([result['q0'] for result in results_sb + results_b] + [self.q0_obs, 1.]) * 1.05)
+        h_q0_b = h_q0_sb.Clone('hQ0B')
+        for result in results_sb:
+            h_pull.Fill(result['pull'])
+            if result['poi_true'] != 0:
+                h_bias.Fill((result['poi'] - result['poi_true']) / result['poi_true'])
+            h_q0_sb.Fill(result['q0'])
+        for result in results_b:
+            h_q0_b.Fill(result['q0'])
+        h_q0_sb.SetLineColor(ROOT.kAzure + 2)
+        h_q0_b.SetLineColor(ROOT.kOrange + 7)
+
+        if h_pull.GetEntries() > 1:
+            h_pull.Fit('gaus', 'Q')
+        p_value, p_value_err, significance = self.get_toy_p_value(n_toys)
+        print("****************************************************")
+        print(f'Toys (s+b): {len(results_sb)}, pull mean: {h_pull.GetMean():.3f} +/- {h_pull.GetMeanError():.3f}, pull width: {h_pull.GetStdDev():.3f} +/- {h_pull.GetStdDevError():.3f}')
+        print(f'Toys (b): {len(results_b)}, q0 data: {self.q0_obs:.3f}, toy p0: {p_value:.3E} +/- {p_value_err:.3E}, significance: {significance:.3f}')
+        print("****************************************************")
+
+        if out_file != None:
+            out_file.cd()
+            for histo in [h_pull, h_bias, h_q0_sb, h_q0_b]:
+                histo.Write()
+        return h_pull, h_bias, h_q0_sb, h_q0_b
@@ -1,6 +1,16 @@
 import ROOT
 import numpy as np
 import pandas as pd
+import uproot
+import fnmatch
+import hashlib
+import inspect
+import json
+import os
+import multiprocessing
+import re
+import time
+from hipe4ml.tree_handler import TreeHandler
 
 kBlueC = ROOT.TColor.GetColor('#1f78b4')
 kOrangeC = ROOT.TColor.GetColor('#ff7f00')
@@ -36,55 +46,71 @@ def setHistStyle(hist, colour, marker=20, fillstyle=0, linewidth=1):
     hist.SetFillStyle(fillstyle)
     hist.SetLineWidth(linewidth)
 
-def fill_th1_hist(h, df, var):
+## maximum number of entries passed to a single FillN call (Int_t in ROOT)
+FILL_CHUNK_SIZE = 100_000_000
+
+
+def _get_df(df):
     if not type(df) == pd.DataFrame:
         df = df._full_data_frame
-    for var_val in df[var]:
-        h.Fill(var_val)
+    return df
+
+
+def fill_hist_arrays(h, x, y=None, weights=None):
+    ## bulk filling with TH1::FillN / TH2::FillN: same binning, under/overflow, entries and sumw2
+    ## bookkeeping as calling h.Fill() once per value, without the python loop
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    if y is not None:
+        y = np.ascontiguousarray(y, dtype=np.float64)
+    if weights is not None:
+        weights = np.ascontiguousarray(np.broadcast_to(weights, x.shape), dtype=np.float64)
+
+    for start in range(0, len(x), FILL_CHUNK_SIZE):
+        stop = min(start + FILL_CHUNK_SIZE, len(x))
+        w = ROOT.nullptr if weights is None else weights[start:stop]
+        if y is None:
+            h.FillN(stop - start, x[start:stop], w, 1)
+        else:
+            h.FillN(stop - start, x[start:stop], y[start:stop], w, 1)
+
+
+def fill_th1_hist(h, df, var):
+    df = _get_df(df)
+    fill_hist_arrays(h, df[var].to_numpy())
 
 
 def fill_th1_hist_abs(h, df, var):
-    if not type(df) == pd.DataFrame:
-        df = df._full_data_frame
-    for var_val in df[var]:
-        h.Fill(abs(var_val))
+    df = _get_df(df)
+    fill_hist_arrays(h, np.abs(df[var].to_numpy()))
 
 
 def fill_th2_hist(h, df, var1, var2):
-    if not type(df) == pd.DataFrame:
-        df = df._full_data_frame
-    for var1_val, var2_val in zip(df[var1], df[var2]):
-        h.Fill(var1_val, var2_val)
+    df = _get_df(df)
+    fill_hist_arrays(h, df[var1].to_numpy(), df[var2].to_numpy())
 
 
 def fill_th2_hist_abs(h, df, var1, var2):
-    if not type(df) == pd.DataFrame:
-        df = df._full_data_frame
-    for var1_val, var2_val in zip(df[var1], df[var2]):
-        h.Fill(abs(var1_val), var2_val)
+    df = _get_df(df)
+    fill_hist_arrays(h, np.abs(df[var1].to_numpy()), df[var2].to_numpy())
 
 
 def fill_res_hist(h, df, var1, var2):
-    if not type(df) == pd.DataFrame:
-        df = df._full_data_frame
-    for var_val1, var_val2 in zip(df[var1], df[var2]):
-        h.Fill((var_val1 - var_val2)/var_val1)
+    df = _get_df(df)
+    var_val1 = df[var1].to_numpy(dtype=np.float64)
+    var_val2 = df[var2].to_numpy(dtype=np.float64)
+    fill_hist_arrays(h, (var_val1 - var_val2)/var_val1)
 
 
 def fill_th2_res_hist(h, df, var1, var2):
-    if not type(df) == pd.DataFrame:
-        df = df._full_data_frame
-    for var_val1, var_val2 in zip(df[var1], df[var2]):
-        h.Fill(var_val1, (var_val2 - var_val1)/var_val1)
+    df = _get_df(df)
+    var_val1 = df[var1].to_numpy(dtype=np.float64)
+    var_val2 = df[var2].to_numpy(dtype=np.float64)
+    fill_hist_arrays(h, var_val1, (var_val2 - var_val1)/var_val1)
 
 def fill_mass_weighted_hist(h, df, var, weight=[1, 1]):
-    if not type(df) == pd.DataFrame:
-        df = df._full_data_frame
-    for var_val, w in zip(df[var], df['isSignal']):
-        if w == 1:
-            h.Fill(var_val, weight[0])
-        else:
-            h.Fill(var_val, weight[1])
+    df = _get_df(df)
+    weights = np.where(df['isSignal'].to_numpy() == 1, weight[0], weight[1])
+    fill_hist_arrays(h, df[var].to_numpy(), weights=weights)
 
 
 def significance_error(signal, background, signal_error, background_error):
@@ -138,40 +164,154 @@ def set_style():
     ROOT.gStyle.SetMarkerSize(1)
 
 
-def ndarray2roo(ndarray, var, name='data'):
+## C++ helper filling a RooDataSet from a contiguous array, used if RooDataSet.from_numpy is not available (ROOT < 6.28)
+_FILL_DATASET_CODE = """
+#include "RooArgSet.h"
+#include "RooDataSet.h"
+#include "RooRealVar.h"
+void fill_roo_dataset(RooDataSet &data, RooRealVar &var, const double *values, std::size_t n)
+{
+    const double current_val = var.getVal();
+    RooArgSet vars(var);
+    for (std::size_t i = 0; i < n; ++i) {
+        var.setVal(values[i]);
+        data.add(vars);
+    }
+    var.setVal(current_val);
+}
+void fill_roo_dataset_weighted(RooDataSet &data, RooRealVar &var, const double *values, const double *weights, std::size_t n)
+{
+    const double current_val = var.getVal();
+    RooArgSet vars(var);
+    for (std::size_t i = 0; i < n; ++i) {
+        var.setVal(values[i]);
+        data.add(vars, weights[i]);
+    }
+    var.setVal(current_val);
+}
+"""
+
+
+def ndarray2roo(ndarray, var, name='data', binned=False, weights=None):
+    ## binned: return a RooDataHist with the binning of var instead of a RooDataSet
+    ## weights: optional per-entry weights, the dataset (or histogram) is then weighted
     if isinstance(ndarray, ROOT.RooDataSet):
         print('Already a RooDataSet')
         return ndarray
 
     assert isinstance(ndarray, np.ndarray), 'Did not receive NumPy array'
     assert len(ndarray.shape) == 1, 'Can only handle 1d array'
-    x = np.zeros(1, dtype=np.float64)
+    ## values outside the range of var are not stored, as for the datasets built from trees
+    ndarray = np.ascontiguousarray(ndarray, dtype=np.float64)
+    in_range = np.logical_and(ndarray >= var.getMin(), ndarray <= var.getMax())
+    ndarray = ndarray[in_range]
+    if weights is not None:
+        weights = np.ascontiguousarray(weights, dtype=np.float64)[in_range]
+
+    if binned:
+        hist = ROOT.TH1D(f'{name}_hist', '', var.getBins(), var.getMin(), var.getMax())
+        hist.SetDirectory(0)
+        fill_hist_arrays(hist, ndarray, weights=weights)
+        return ROOT.RooDataHist(name, 'binned dataset from array', ROOT.RooArgList(var), hist)
+
+    if hasattr(ROOT.RooDataSet, 'from_numpy'):
+        if weights is None:
+            return ROOT.RooDataSet.from_numpy({var.GetName(): ndarray}, ROOT.RooArgSet(var), name=name, title='dataset from array')
+        return ROOT.RooDataSet.from_numpy({var.GetName(): ndarray, 'weight': weights}, ROOT.RooArgSet(var), name=name,
+                                          title='dataset from array', weight_name='weight')
+
+    if not hasattr(ROOT, 'fill_roo_dataset'):
+        ROOT.gInterpreter.Declare(_FILL_DATASET_CODE)
+    if weights is None:
+        array_roo = ROOT.RooDataSet(name, 'dataset from array', ROOT.RooArgSet(var))
+        ROOT.fill_roo_dataset(array_roo, var, ndarray, len(ndarray))
+        return array_roo
+    weight_var = ROOT.RooRealVar('weight', 'weight', 1.)
+    array_roo = ROOT.RooDataSet(name, 'dataset from array', ROOT.RooArgSet(var, weight_var), ROOT.RooFit.WeightVar(weight_var))
+    ROOT.fill_roo_dataset_weighted(array_roo, var, ndarray, weights, len(ndarray))
+    return array_roo
 
-    tree = ROOT.TTree('tree', 'tree')
-    tree.Branch(f'{var.GetName()}', x, f'{var.GetName()}/D')
 
-    for i in ndarray:
-        x[0] = i
-        tree.Fill()
-    array_roo = ROOT.RooDataSet(name, 'dataset from tree', tree, ROOT.RooArgSet(var))
-    return array_roo
+## options of the likelihood fits, from the 'fit_backend' block of the configs (the ROOT defaults are used for the missing keys):
+##   eval_backend: 'legacy', 'cpu' (vectorised), 'cuda' or 'codegen', BatchMode(True) for 'cpu' on ROOT < 6.30
+##   num_cpu, num_cpu_strategy: processes computing the likelihood and how the events are split (0: bulk, 1: interleave,
+##                              2: per simultaneous component, 3: hybrid), not supported with the vectorised backends by all ROOT versions
+##   minimizer, minimizer_algorithm: e.g. 'Minuit2', 'migrad'
+##   strategy, tolerance: strategy (0, 1, 2) and tolerance of the minimisation
+FIT_BACKEND_KEYS = ['eval_backend', 'num_cpu', 'num_cpu_strategy', 'minimizer', 'minimizer_algorithm', 'strategy', 'tolerance']
+
+
+def get_fit_options(fit_backend=None):
+    ## RooCmdArg of the fit_backend options
+    fit_backend = fit_backend if fit_backend is not None else {}
+    for key in fit_backend:
+        if key not in FIT_BACKEND_KEYS:
+            raise ValueError(f'Invalid fit_backend option: {key}. Expected one of: {FIT_BACKEND_KEYS}')
+    options = []
+    if 'eval_backend' in fit_backend:
+        if hasattr(ROOT.RooFit, 'EvalBackend'):
+            options.append(ROOT.RooFit.EvalBackend(fit_backend['eval_backend']))
+        else:
+            options.append(ROOT.RooFit.BatchMode(fit_backend['eval_backend'] == 'cpu'))
+    if 'num_cpu' in fit_backend:
+        options.append(ROOT.RooFit.NumCPU(fit_backend['num_cpu'], fit_backend['num_cpu_strategy'] if 'num_cpu_strategy' in fit_backend else 0))
+    if 'minimizer' in fit_backend:
+        options.append(ROOT.RooFit.Minimizer(fit_backend['minimizer'], fit_backend['minimizer_algorithm'] if 'minimizer_algorithm' in fit_backend else 'migrad'))
+    if 'strategy' in fit_backend:
+        options.append(ROOT.RooFit.Strategy(fit_backend['strategy']))
+    return options
+
+
+def fit_to(pdf, dataset, cmd_args, fit_backend=None):
+    ## pdf.fitTo with cmd_args and the fit_backend options, returns the fit result and the wall time of the fit in seconds
+    ## the options are passed as a RooLinkedList, fitTo only takes up to 8 RooCmdArg
+    cmd_args = list(cmd_args) + get_fit_options(fit_backend)
+    cmd_list = ROOT.RooLinkedList()
+    for cmd_arg in cmd_args:
+        cmd_list.Add(cmd_arg)
+    ## the tolerance is not a fitTo option, it is taken from the default options of the minimizer
+    default_tolerance = ROOT.Math.MinimizerOptions.DefaultTolerance()
+    if fit_backend is not None and 'tolerance' in fit_backend:
+        ROOT.Math.MinimizerOptions.SetDefaultTolerance(fit_backend['tolerance'])
+    start = time.perf_counter()
+    try:
+        fit_result = pdf.fitTo(dataset, cmd_list)
+    finally:
+        ROOT.Math.MinimizerOptions.SetDefaultTolerance(default_tolerance)
+    return fit_result, time.perf_counter() - start
+
+
+def eval_tf1_array(distribution, values, n_grid=10000):
+    ## TF1 evaluated on an array: the function is evaluated on n_grid + 1 points between the minimum and maximum of the values
+    ## and linearly interpolated, instead of one Eval call per value
+    values = np.asarray(values, dtype=np.float64)
+    finite_values = values[np.isfinite(values)]
+    if len(finite_values) == 0:
+        return np.full(len(values), np.nan)
+    grid = np.linspace(finite_values.min(), finite_values.max(), n_grid + 1)
+    grid_vals = np.array([distribution.Eval(x) for x in grid])
+    func_vals = np.interp(values, grid, grid_vals)
+    func_vals[~np.isfinite(values)] = np.nan
+    return func_vals
+
+
+## column of the pT spectrum weights, when the MC is weighted instead of rejection-sampled
+PT_WEIGHT_COLUMN = 'fPtWeight'
 
 
 ### reweight a distribution with rejection sampling
-def reweight_pt_spectrum(df, var, distribution):
-    rej_flag = np.ones(len(df))
-    random_arr = np.random.rand(len(df))
-    max_bw = distribution.GetMaximum()
-
-    for ind, (val, rand) in enumerate(zip(df[var],random_arr)):
-        frac = distribution.Eval(val)/max_bw
-        if rand > frac:
-            rej_flag[ind] = -1
-    ## check if it is a pandas dataframe
-    if isinstance(df, pd.DataFrame):
-        df['rej'] = rej_flag
+## weight_col: if set, the candidates are not rejected and the spectrum/maximum ratio is stored in the weight_col column
+## seed: seed of the generator used for the rejection, the global numpy generator is used if not set
+def reweight_pt_spectrum(df, var, distribution, seed=None, weight_col=None, n_grid=10000):
+    data_frame = df if isinstance(df, pd.DataFrame) else df._full_data_frame
+    frac = eval_tf1_array(distribution, data_frame[var].to_numpy(), n_grid) / distribution.GetMaximum()
+    if weight_col is not None:
+        data_frame[weight_col] = frac
+        data_frame['rej'] = np.ones(len(data_frame))
         return
-    df._full_data_frame['rej'] = rej_flag
+    rng = np.random.default_rng(seed) if seed is not None else np.random
+    random_arr = rng.random(len(data_frame))
+    data_frame['rej'] = np.where(random_arr > frac, -1., 1.)
 
 # create histogram for momentum correction
 
@@ -241,7 +381,146 @@ def getNEvents(an_files, is_trigger=False):
 
 
 
-def correct_and_convert_df(df, calibrate_he3_pt = False, isMC=False, isH4L=False):
+def decode_its_cluster_sizes(cluster_sizes, n_layers=7):
+    ## unpack the 4-bit per-layer ITS cluster sizes into a (n_candidates, n_layers) uint8 matrix
+    ## each byte of the little-endian uint32 holds two layers: low nibble -> even layer, high nibble -> odd layer
+    packed = np.ascontiguousarray(cluster_sizes).astype('<u4')
+    packed_bytes = packed.view(np.uint8).reshape(-1, 4)
+    layers = np.empty((len(packed), 8), dtype=np.uint8)
+    layers[:, 0::2] = packed_bytes & 0b1111
+    layers[:, 1::2] = packed_bytes >> 4
+    return layers[:, :n_layers]
+
+
+def get_its_cluster_size_info(cluster_sizes):
+    ## per-layer cluster sizes, number of hit layers and average cluster size over the hit layers
+    layers = decode_its_cluster_sizes(cluster_sizes)
+    n_hits = np.count_nonzero(layers, axis=1)
+    cl_size_avg = layers.sum(axis=1, dtype=np.float64) / (n_hits + 1e-10)
+    return layers, n_hits, cl_size_avg
+
+
+def add_its_layer_columns(df, daughter='He'):
+    ## store the decoded cluster size of each ITS layer as a column (e.g. fITSclSizeHeL0), for new PID variables
+    if not type(df) == pd.DataFrame:
+        df = df._full_data_frame
+    layers = decode_its_cluster_sizes(df[f'fITSclusterSizes{daughter}'].to_numpy())
+    for i_layer in range(layers.shape[1]):
+        df[f'fITSclSize{daughter}L{i_layer}'] = layers[:, i_layer]
+
+
+## masses (GeV/c^2) used to compute the candidate kinematics
+kHe3Mass = 2.8083916
+kHe4Mass = 3.7273794
+kPiMass = 0.139570
+kH3LMass = 2.99131
+kH4LMass = 3.922
+
+## columns added by compute_kinematics (fPhi and fV2 only if fPsiFT0C is available)
+KINEMATICS_COLUMNS = ['fPHe3', 'fEnHe4', 'fEn4', 'fPt', 'fEta', 'fCosLambda', 'fCosLambdaHe', 'fDecLen', 'fCt', 'fDecRad', 'fCosPA',
+                      'fMassH3L', 'fMassH4L', 'fTPCSignMomHe3', 'fGloSignMomHe3', 'fPhi', 'fV2']
+
+
+def compute_kinematics(df, isH4L=False, columns=None, dtype=np.float64):
+    ## fused computation of the hypernucleus kinematics from the daughter tracks and the decay vertex
+    ## the intermediate four-momenta are plain arrays and only the requested columns are returned
+    if columns is None:
+        columns = KINEMATICS_COLUMNS
+
+    def get_col(name):
+        return df[name].to_numpy(dtype=dtype)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 3He momentum
+        pt_he = get_col('fPtHe3')
+        phi_he = get_col('fPhiHe3')
+        eta_he = get_col('fEtaHe3')
+        p_he = pt_he * np.cosh(eta_he)
+        p2_he = p_he * p_he
+        en_he4 = np.sqrt(p2_he + kHe4Mass**2)
+        # pi momentum
+        pt_pi = get_col('fPtPi')
+        phi_pi = get_col('fPhiPi')
+        eta_pi = get_col('fEtaPi')
+        p_pi = pt_pi * np.cosh(eta_pi)
+        en_pi = np.sqrt(p_pi * p_pi + kPiMass**2)
+        # hypernucleus momentum
+        px = pt_he * np.cos(phi_he) + pt_pi * np.cos(phi_pi)
+        py = pt_he * np.sin(phi_he) + pt_pi * np.sin(phi_pi)
+        pz = pt_he * np.sinh(eta_he) + pt_pi * np.sinh(eta_pi)
+        pt2 = px * px + py * py
+        p2 = pt2 + pz * pz
+        p = np.sqrt(p2)
+        pt = np.sqrt(pt2)
+        en = np.sqrt(p2_he + kHe3Mass**2) + en_pi
+        en4 = en_he4 + en_pi
+        # decay vertex
+        x_dec = get_col('fXDecVtx')
+        y_dec = get_col('fYDecVtx')
+        z_dec = get_col('fZDecVtx')
+        dec_rad2 = x_dec * x_dec + y_dec * y_dec
+        dec_len = np.sqrt(dec_rad2 + z_dec * z_dec)
+        matter_sign = 2 * get_col('fIsMatter') - 1
+
+        kinematics = {}
+        kinematics['fPHe3'] = p_he
+        kinematics['fEnHe4'] = en_he4
+        kinematics['fEn4'] = en4
+        kinematics['fPt'] = pt
+        if 'fEta' in columns:
+            kinematics['fEta'] = np.arccosh(p / pt)
+        kinematics['fCosLambda'] = pt / p
+        kinematics['fCosLambdaHe'] = pt_he / p_he
+        kinematics['fDecLen'] = dec_len
+        kinematics['fCt'] = dec_len * (kH4LMass if isH4L else kH3LMass) / p
+        kinematics['fDecRad'] = np.sqrt(dec_rad2)
+        kinematics['fCosPA'] = (px * x_dec + py * y_dec + pz * z_dec) / (p * dec_len)
+        kinematics['fMassH3L'] = np.sqrt(en * en - p2)
+        kinematics['fMassH4L'] = np.sqrt(en4 * en4 - p2)
+        ## signed TPC mom
+        kinematics['fTPCSignMomHe3'] = get_col('fTPCmomHe') * matter_sign
+        kinematics['fGloSignMomHe3'] = p_he / 2 * matter_sign
+        if 'fPsiFT0C' in df.columns and ('fPhi' in columns or 'fV2' in columns):
+            phi = np.arctan2(py, px)
+            kinematics['fPhi'] = phi
+            kinematics['fV2'] = np.cos(2 * (phi - get_col('fPsiFT0C')))
+
+    return {col_name: kinematics[col_name] for col_name in columns if col_name in kinematics}
+
+
+## dtypes of the compact candidate table, see downcast_candidates
+CANDIDATE_SCHEMA = {
+    # flags
+    'fIsMatter': np.bool_, 'fIsReco': np.bool_, 'fIsSurvEvSel': np.bool_, 'fTracked': np.bool_,
+    # PID hypotheses and packed track information
+    'fFlags': np.uint8, 'fHePIDHypo': np.uint8, 'fPiPIDHypo': np.uint8, 'fNTPCclusHe': np.uint8, 'fNTPCclusPi': np.uint8,
+    'fITSclusterSizesHe': np.uint32, 'fITSclusterSizesPi': np.uint32,
+    # kinematics and derived quantities
+    'fPtHe3': np.float32, 'fPhiHe3': np.float32, 'fEtaHe3': np.float32, 'fPtPi': np.float32, 'fPhiPi': np.float32, 'fEtaPi': np.float32,
+    'fXDecVtx': np.float32, 'fYDecVtx': np.float32, 'fZDecVtx': np.float32, 'fTPCmomHe': np.float32, 'fTPCsignalHe': np.float32,
+    'fTPCsignalPi': np.float32, 'fTPCChi2He': np.float32, 'fNSigmaHe': np.float32, 'fNSigmaHe3': np.float32, 'fNSigmaHe4': np.float32,
+    'fAvgClusterSizeHe': np.float32, 'fAvgClusterSizePi': np.float32, 'nITSHitsHe': np.float32, 'nITSHitsPi': np.float32,
+    'fAvgClSizeCosLambda': np.float32, 'fGenPt': np.float32, 'fGenEta': np.float32, 'fGenXDecVtx': np.float32,
+    'fGenYDecVtx': np.float32, 'fGenZDecVtx': np.float32, 'fGenDecLen': np.float32, 'fGenPz': np.float32, 'fGenP': np.float32,
+    'fAbsGenPt': np.float32, 'fGenCt': np.float32,
+}
+CANDIDATE_SCHEMA.update({col_name: np.float32 for col_name in KINEMATICS_COLUMNS})
+
+
+def downcast_candidates(df, schema=CANDIDATE_SCHEMA):
+    ## cast the candidate columns to the compact dtypes, the other float64 columns are stored as float32
+    if not type(df) == pd.DataFrame:
+        df = df._full_data_frame
+    for col_name in df.columns:
+        dtype = schema[col_name] if col_name in schema else (np.float32 if df[col_name].dtype == np.float64 else None)
+        if dtype is not None and df[col_name].dtype != dtype:
+            df[col_name] = df[col_name].astype(dtype)
+    return df
+
+
+def correct_and_convert_df(df, calibrate_he3_pt = False, isMC=False, isH4L=False, kinematics_columns=None, compact=False):
+    ## kinematics_columns: optional subset of KINEMATICS_COLUMNS to be added to the dataframe
+    ## compact: store the converted candidates with the dtypes of CANDIDATE_SCHEMA (computed in double precision anyway)
 
     kDefaultPID = 15
     kPionPID = 2
@@ -278,94 +557,327 @@ def correct_and_convert_df(df, calibrate_he3_pt = False, isMC=False, isH4L=False
             ## assign the new dataframe to the original one
             df[:] = df_new
     
-    # 3He momentum
-    df.eval('fPxHe3 = fPtHe3 * cos(fPhiHe3)', inplace=True)
-    df.eval('fPyHe3 = fPtHe3 * sin(fPhiHe3)', inplace=True)
-    df.eval('fPzHe3 = fPtHe3 * sinh(fEtaHe3)', inplace=True)
-    df.eval('fPHe3 = fPtHe3 * cosh(fEtaHe3)', inplace=True)
-    df.eval('fEnHe3 = sqrt(fPHe3**2 + 2.8083916**2)', inplace=True)
-    df.eval('fEnHe4 = sqrt(fPHe3**2 + 3.7273794**2)', inplace=True)
-    # pi momentum
-    df.eval('fPxPi = fPtPi * cos(fPhiPi)', inplace=True)
-    df.eval('fPyPi = fPtPi * sin(fPhiPi)', inplace=True)
-    df.eval('fPzPi = fPtPi * sinh(fEtaPi)', inplace=True)
-    df.eval('fPPi = fPtPi * cosh(fEtaPi)', inplace=True)
-    df.eval('fEnPi = sqrt(fPPi**2 + 0.139570**2)', inplace=True)
-    # hypertriton momentum
-    df.eval('fPx = fPxHe3 + fPxPi', inplace=True)
-    df.eval('fPy = fPyHe3 + fPyPi', inplace=True)
-    df.eval('fPz = fPzHe3 + fPzPi', inplace=True)
-    df.eval('fP = sqrt(fPx**2 + fPy**2 + fPz**2)', inplace=True)
-    df.eval('fEn = fEnHe3 + fEnPi', inplace=True)
-    df.eval('fEn4 = fEnHe4 + fEnPi', inplace=True)
-    # Momentum variables to be stored
-    df.eval('fPt = sqrt(fPx**2 + fPy**2)', inplace=True)
-    df.eval('fEta = arccosh(fP/fPt)', inplace=True)
-    df.eval('fCosLambda = fPt/fP', inplace=True)
-    df.eval('fCosLambdaHe = fPtHe3/fPHe3', inplace=True)
+    # candidate kinematics, computed in a single pass
+    if isH4L:
+        print('Using H4L decay length')
+    kinematics = compute_kinematics(df, isH4L, kinematics_columns)
+    for col_name, col_values in kinematics.items():
+        df[col_name] = col_values
     df['fNSigmaHe4'] = computeNSigmaHe4(df, isMC)
     df['fNSigmaHe3'] = computeNSigmaHe3(df, isMC)
 
-    # Variables of interest
-    df.eval('fDecLen = sqrt(fXDecVtx**2 + fYDecVtx**2 + fZDecVtx**2)', inplace=True)
-    if not isH4L:
-        df.eval('fCt = fDecLen * 2.99131 / fP', inplace=True)
-    else:
-        print('Using H4L decay length')
-        df.eval('fCt = fDecLen * 3.922 / fP', inplace=True)
-
-    df.eval('fDecRad = sqrt(fXDecVtx**2 + fYDecVtx**2)', inplace=True)
-    df.eval('fCosPA = (fPx * fXDecVtx + fPy * fYDecVtx + fPz * fZDecVtx) / (fP * fDecLen)', inplace=True)
-    df.eval('fMassH3L = sqrt(fEn**2 - fP**2)', inplace=True)
-    df.eval('fMassH4L = sqrt(fEn4**2 - fP**2)', inplace=True)
-
-    ## signed TPC mom
-    df.eval('fTPCSignMomHe3 = fTPCmomHe * (-1 + 2*fIsMatter)', inplace=True)
-    df.eval('fGloSignMomHe3 = fPHe3 / 2 * (-1 + 2*fIsMatter)', inplace=True)
-
     if "fITSclusterSizesHe" in df.columns:
-    ## loop over the candidates and compute the average cluster size
-        clSizesHe = df['fITSclusterSizesHe'].to_numpy()
-        clSizesPi = df['fITSclusterSizesPi'].to_numpy()
-        clSizeHeAvg = np.zeros(len(clSizesHe))
-        clSizePiAvg = np.zeros(len(clSizesPi))
-        nHitsHe = np.zeros(len(clSizesHe))
-        nHitsPi = np.zeros(len(clSizesPi))
-        for iLayer in range(7):
-            clSizeHeAvg += np.right_shift(clSizesHe, 4*iLayer) & 0b1111
-            clSizePiAvg += np.right_shift(clSizesPi, 4*iLayer) & 0b1111
-            nHitsHe += np.right_shift(clSizesHe, 4*iLayer) & 0b1111 > 0
-            nHitsPi += np.right_shift(clSizesPi, 4*iLayer) & 0b1111 > 0
-
-        nHitsHe += 1e-10
-        nHitsPi += 1e-10
-        clSizeHeAvg /= nHitsHe
-        clSizePiAvg /= nHitsPi
-        df['fAvgClusterSizeHe'] = clSizeHeAvg
-        df['fAvgClusterSizePi'] = clSizePiAvg
-        df['nITSHitsHe'] = nHitsHe
-        df['nITSHitsPi'] = nHitsPi
-        df.eval('fAvgClSizeCosLambda = fAvgClusterSizeHe * fCosLambdaHe', inplace=True)
-
-    if "fPsiFT0C" in df.columns:
-        df.eval('fPhi = arctan2(fPy, fPx)', inplace=True)
-        df.eval('fV2 = cos(2*(fPhi - fPsiFT0C))', inplace=True)
-
+        ## decode the per-layer cluster sizes and compute the average cluster size
+        for daughter in ['He', 'Pi']:
+            _, n_hits, cl_size_avg = get_its_cluster_size_info(df[f'fITSclusterSizes{daughter}'].to_numpy())
+            df[f'fAvgClusterSize{daughter}'] = cl_size_avg
+            df[f'nITSHits{daughter}'] = n_hits + 1e-10
+        if 'fCosLambdaHe' in df.columns:
+            df['fAvgClSizeCosLambda'] = df['fAvgClusterSizeHe'] * df['fCosLambdaHe']
 
     if isMC:
-        df.eval('fGenDecLen = sqrt(fGenXDecVtx**2 + fGenYDecVtx**2 + fGenZDecVtx**2)', inplace=True)
-        df.eval('fGenPz = fGenPt * sinh(fGenEta)', inplace=True)
-        df.eval('fGenP = sqrt(fGenPt**2 + fGenPz**2)', inplace=True)
-        df.eval("fAbsGenPt = abs(fGenPt)", inplace=True)
-
-        if not isH4L:
-            df.eval('fGenCt = fGenDecLen * 2.99131 / fGenP', inplace=True)
-        else:
-            df.eval('fGenCt = fGenDecLen * 3.922 / fGenP', inplace=True)
-
-
-    # remove useless columns
-    df.drop(columns=['fPxHe3', 'fPyHe3', 'fPzHe3', 'fEnHe3', 'fPxPi', 'fPyPi', 'fPzPi', 'fPPi', 'fEnPi', 'fPx', 'fPy', 'fPz', 'fP', 'fEn'])
+        gen_pt = df['fGenPt'].to_numpy(dtype=np.float64)
+        gen_pz = gen_pt * np.sinh(df['fGenEta'].to_numpy(dtype=np.float64))
+        gen_p = np.sqrt(gen_pt**2 + gen_pz**2)
+        gen_dec_len = np.sqrt(df['fGenXDecVtx'].to_numpy(dtype=np.float64)**2 + df['fGenYDecVtx'].to_numpy(dtype=np.float64)**2 +
+                              df['fGenZDecVtx'].to_numpy(dtype=np.float64)**2)
+        df['fGenDecLen'] = gen_dec_len
+        df['fGenPz'] = gen_pz
+        df['fGenP'] = gen_p
+        df['fAbsGenPt'] = np.abs(gen_pt)
+        df['fGenCt'] = gen_dec_len * (kH4LMass if isH4L else kH3LMass) / gen_p
+
+    if compact:
+        downcast_candidates(df)
+
+    return df
+
+
+## branches always read by correct_and_convert_df
+CONVERSION_BRANCHES = ['fPtHe3', 'fPhiHe3', 'fEtaHe3', 'fPtPi', 'fPhiPi', 'fEtaPi', 'fXDecVtx', 'fYDecVtx', 'fZDecVtx',
+                       'fTPCmomHe', 'fTPCsignalHe', 'fIsMatter', 'fTPCChi2He']
+CONVERSION_BRANCHES_MC = ['fGenXDecVtx', 'fGenYDecVtx', 'fGenZDecVtx', 'fGenPt', 'fGenEta']
+## optional branches, read only if one of them or of the columns derived from them is used
+OPTIONAL_CONVERSION_BRANCHES = [
+    (['fFlags'], ['fHePIDHypo', 'fPiPIDHypo']),
+    (['fITSclusterSizesHe', 'fITSclusterSizesPi'], ['fAvgClusterSizeHe', 'fAvgClusterSizePi', 'nITSHitsHe', 'nITSHitsPi', 'fAvgClSizeCosLambda']),
+    (['fPsiFT0C'], ['fPhi', 'fV2']),
+]
+
+
+def get_expression_variables(expressions):
+    ## names used in selection strings / eval expressions, given as strings, lists or (nested) dicts
+    if expressions is None:
+        return set()
+    if isinstance(expressions, str):
+        return set(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', expressions))
+    if isinstance(expressions, dict):
+        expressions = list(expressions.values())
+    if not isinstance(expressions, (list, tuple, set)):
+        return set()
+    variables = set()
+    for expr in expressions:
+        variables |= get_expression_variables(expr)
+    return variables
+
+
+def get_needed_branches(available_branches, expressions, calibrate_he3_pt=False, isMC=False):
+    ## minimal set of branches to be read to convert the candidates and evaluate the expressions
+    variables = get_expression_variables(expressions)
+    needed = set(CONVERSION_BRANCHES)
+    if isMC:
+        needed |= set(CONVERSION_BRANCHES_MC)
+    for branches, derived_columns in OPTIONAL_CONVERSION_BRANCHES:
+        if any(var in variables for var in branches + derived_columns):
+            needed |= set(branches)
+    ## the momentum re-calibration depends on the PID hypothesis
+    if calibrate_he3_pt:
+        needed.add('fFlags')
+    needed |= variables
+    return [branch for branch in available_branches if branch in needed]
+
+
+def get_tree_branches(input_files, tree_name, folder_name='DF*'):
+    tree_paths = get_tree_paths(input_files, tree_name, folder_name)
+    if len(tree_paths) == 0:
+        return []
+    with uproot.open(tree_paths[0]) as tree:
+        return tree.keys()
+
+
+def get_needed_columns(input_files, tree_name, expressions, folder_name='DF*', calibrate_he3_pt=False, isMC=False):
+    available_branches = get_tree_branches(input_files, tree_name, folder_name)
+    needed_branches = get_needed_branches(available_branches, expressions, calibrate_he3_pt, isMC)
+    print(f'Reading {len(needed_branches)} / {len(available_branches)} branches of {tree_name}: {needed_branches}')
+    return needed_branches
+
+
+def get_tree_paths(input_files, tree_name, folder_name='DF*'):
+    ## list of 'file:DF_xxx/tree' paths for all the DF directories matching folder_name
+    if type(input_files) == str:
+        input_files = [input_files]
+    if '*' not in folder_name:
+        folder_name += '*'
+
+    tree_paths = []
+    for input_file in input_files:
+        with uproot.open(input_file) as root_file:
+            for key in root_file.keys(recursive=False, cycle=False):
+                if not fnmatch.fnmatch(key, folder_name):
+                    continue
+                if tree_name in root_file[key].keys(recursive=False, cycle=False):
+                    tree_paths.append(f'{input_file}:{key}/{tree_name}')
+    return tree_paths
+
+
+def stream_tree(input_files, tree_name, folder_name='DF*', step_size='100 MB', columns=None, process_chunk=None, keep_chunks=True):
+    ## read the trees in chunks of bounded size instead of loading everything in memory
+    ## process_chunk is called on each chunk and returns the candidates to be kept (or None)
+    kept_chunks = []
+    tree_paths = get_tree_paths(input_files, tree_name, folder_name)
+    for chunk in uproot.iterate(tree_paths, expressions=columns, step_size=step_size, library='pd'):
+        if process_chunk is not None:
+            chunk = process_chunk(chunk)
+        if keep_chunks and chunk is not None:
+            kept_chunks.append(chunk)
+
+    if not keep_chunks:
+        return None
+    if len(kept_chunks) == 0:
+        return pd.DataFrame()
+    return pd.concat(kept_chunks, ignore_index=True)
+
+
+def stream_and_convert(input_files, tree_name, preselections='', calibrate_he3_pt=False, isMC=False, isH4L=False, compact=False, **kwargs):
+    ## streaming version of TreeHandler + correct_and_convert_df + apply_preselections
+    ## only the candidates passing the preselections are kept in memory
+    def convert_and_select(df):
+        correct_and_convert_df(df, calibrate_he3_pt, isMC, isH4L, compact=compact)
+        if preselections != '':
+            df.query(preselections, inplace=True)
+        return df
+
+    return stream_tree(input_files, tree_name, process_chunk=convert_and_select, **kwargs)
+
+
+def _read_and_convert_tree(tree_path, columns, preselections, calibrate_he3_pt, isMC, isH4L, compact):
+    ## executed in the worker processes: read one DF directory, convert it and apply the preselections
+    with uproot.open(tree_path) as tree:
+        df = tree.arrays(columns, library='pd')
+    correct_and_convert_df(df, calibrate_he3_pt, isMC, isH4L, compact=compact)
+    if preselections != '':
+        df.query(preselections, inplace=True)
+    return df
+
+
+def parallel_read_and_convert(input_files, tree_name, preselections='', calibrate_he3_pt=False, isMC=False, isH4L=False, folder_name='DF*', columns=None, n_workers=4,
+                              compact=False):
+    ## the DF directories of all the input files are distributed over a pool of processes,
+    ## the converted candidates are concatenated in the original order
+    tree_paths = get_tree_paths(input_files, tree_name, folder_name)
+    worker_args = [(tree_path, columns, preselections, calibrate_he3_pt, isMC, isH4L, compact) for tree_path in tree_paths]
+    with multiprocessing.Pool(n_workers) as pool:
+        converted_dfs = pool.starmap(_read_and_convert_tree, worker_args)
+
+    if len(converted_dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(converted_dfs, ignore_index=True)
+
+
+def read_and_convert(input_files, tree_name, folder_name='DF*', streaming=False, step_size='100 MB', preselections='', calibrate_he3_pt=False, isMC=False, isH4L=False, columns=None, n_workers=1,
+                     compact=False):
+    ## returns the converted candidates, reading the input in one go, in chunks or with n_workers processes
+    ## columns: optional list of branches to be read, see get_needed_branches
+    ## compact: downcast the candidates to CANDIDATE_SCHEMA
+    if n_workers > 1:
+        return parallel_read_and_convert(input_files, tree_name, preselections, calibrate_he3_pt, isMC, isH4L,
+                                         folder_name=folder_name, columns=columns, n_workers=n_workers, compact=compact)
+    if streaming:
+        return stream_and_convert(input_files, tree_name, preselections, calibrate_he3_pt, isMC, isH4L, compact,
+                                  folder_name=folder_name, step_size=step_size, columns=columns)
+
+    df = TreeHandler(input_files, tree_name, columns_names=columns, folder_name=folder_name).get_data_frame()
+    correct_and_convert_df(df, calibrate_he3_pt, isMC, isH4L, compact=compact)
+    if preselections != '':
+        df.query(preselections, inplace=True)
+    return df
+
+
+## functions whose source code is part of the conversion cache key
+CONVERSION_FUNCTIONS = [correct_and_convert_df, compute_kinematics, downcast_candidates, heBB, computeNSigmaHe3, computeNSigmaHe4,
+                        decode_its_cluster_sizes, get_its_cluster_size_info]
+
+
+def conversion_cache_key(input_files, tree_name, folder_name, preselections, calibrate_he3_pt, isMC, isH4L, columns, compact=False):
+    ## the key changes if any input file is modified or if the conversion code or settings change
+    if type(input_files) == str:
+        input_files = [input_files]
+    key_info = [tree_name, folder_name, preselections, calibrate_he3_pt, isMC, isH4L, sorted(columns) if columns else None, compact,
+                KINEMATICS_COLUMNS]
+    if compact:
+        key_info.append({col_name: np.dtype(dtype).str for col_name, dtype in CANDIDATE_SCHEMA.items()})
+    key_info += [inspect.getsource(func) for func in CONVERSION_FUNCTIONS]
+    for input_file in input_files:
+        file_stat = os.stat(input_file)
+        key_info.append([os.path.abspath(input_file), file_stat.st_size, file_stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(key_info).encode()).hexdigest()
+
+
+def read_from_cache(cache_dir, cache_key):
+    cache_file = os.path.join(cache_dir, f'{cache_key}.parquet')
+    if not os.path.exists(cache_file):
+        return None
+    print(f'Reading converted candidates from cache: {cache_file}')
+    ## update the modification time, used as last access time by the LRU eviction
+    os.utime(cache_file)
+    return pd.read_parquet(cache_file)
+
+
+def write_to_cache(df, cache_dir, cache_key, max_size_gb=50):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, f'{cache_key}.parquet')
+    ## write to a temporary file first, so that an interrupted job never leaves a truncated entry
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    df.to_parquet(tmp_file)
+    os.replace(tmp_file, cache_file)
+    evict_cache(cache_dir, max_size_gb)
+
+
+def evict_cache(cache_dir, max_size_gb=50):
+    ## remove the least recently used entries until the cache fits in max_size_gb
+    cache_files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.parquet')]
+    cache_files.sort(key=os.path.getmtime)
+    total_size = sum(os.path.getsize(cache_file) for cache_file in cache_files)
+    max_size = max_size_gb * 1024**3
+    ## the most recent entry is always kept
+    for cache_file in cache_files[:-1]:
+        if total_size <= max_size:
+            break
+        total_size -= os.path.getsize(cache_file)
+        os.remove(cache_file)
+
+
+def get_tree_handler(input_files, tree_name, folder_name='DF*', streaming=False, step_size='100 MB', preselections='', calibrate_he3_pt=False, isMC=False, isH4L=False, columns=None, n_workers=1,
+                     cache_dir=None, cache_max_size_gb=50, compact=False):
+    ## returns a TreeHandler with the converted and preselected candidates
+    ## if cache_dir is set, the converted candidates are stored there as parquet and reused by the following runs
+    df = None
+    if cache_dir is not None:
+        cache_key = conversion_cache_key(input_files, tree_name, folder_name, preselections, calibrate_he3_pt, isMC, isH4L, columns, compact)
+        df = read_from_cache(cache_dir, cache_key)
+
+    if df is None:
+        df = read_and_convert(input_files, tree_name, folder_name, streaming, step_size, preselections, calibrate_he3_pt, isMC, isH4L, columns, n_workers, compact)
+        if cache_dir is not None:
+            write_to_cache(df, cache_dir, cache_key, cache_max_size_gb)
+
+    hdl = TreeHandler()
+    hdl._full_data_frame = df
+    return hdl
+
+
+def plan_trials(option_lists, n_bins, n_trials, seed=None):
+    ## indices of the combinations (one option from each list, see get_combo) used by each trial in each bin,
+    ## drawn without replacement in each bin so that no bin is fitted twice with the same combination
+    ## the number of trials is limited to the number of combinations, the sampling is reproducible for a given seed
+    n_combos = int(np.prod([len(options) for options in option_lists]))
+    n_planned = min(n_trials, n_combos)
+    rng = np.random.default_rng(seed)
+    combo_indices = np.empty((n_planned, n_bins), dtype=np.int64)
+    for i_bin in range(n_bins):
+        combo_indices[:, i_bin] = rng.choice(n_combos, size=n_planned, replace=False)
+    return combo_indices
+
+
+def get_combo(option_lists, combo_index):
+    ## combination number combo_index of the options, in the order of itertools.product
+    option_indices = np.unravel_index(combo_index, [len(options) for options in option_lists])
+    return tuple(options[i_option] for options, i_option in zip(option_lists, option_indices))
+
+
+## trial function (and output filter) run by the pool, the forked processes inherit them instead of receiving a pickled copy
+_active_run_trial = None
+_active_keep_trial = None
+
+
+def _run_trial_in_memory(trial):
+    ## the output of each trial is written to a memory file and its objects are returned, so that they can be sent to the parent process
+    mem_file = ROOT.TMemFile(f'trial_{os.getpid()}', 'RECREATE')
+    result = _active_run_trial(trial, mem_file)
+    objects = []
+    if _active_keep_trial is None or _active_keep_trial(result):
+        for key in mem_file.GetListOfKeys():
+            obj = key.ReadObj()
+            if hasattr(obj, 'SetDirectory'):
+                obj.SetDirectory(ROOT.nullptr)
+            ROOT.SetOwnership(obj, True)
+            objects.append(obj)
+    mem_file.Close()
+    return result, objects
+
+
+def run_trials(run_trial, trials, out_dir, dir_names, n_workers=1, keep=None):
+    ## run_trial(trial, trial_dir) is called for each trial, its output is written to the directory dir_names[i_trial] of out_dir;
+    ## with keep(result) False the directory is not kept. The results are yielded in the order of the trials as soon as they are
+    ## available, so the output of each trial is written and released before the following ones are collected.
+    ## With n_workers > 1 the trials are distributed over a pool of forked processes (each with its own copy of the ROOT state)
+    global _active_run_trial, _active_keep_trial
+    if n_workers > 1:
+        _active_run_trial = run_trial
+        _active_keep_trial = keep
+        with multiprocessing.get_context('fork').Pool(n_workers) as pool:
+            for dir_name, (result, objects) in zip(dir_names, pool.imap(_run_trial_in_memory, trials)):
+                if keep is None or keep(result):
+                    out_dir.mkdir(dir_name).cd()
+                    for obj in objects:
+                        obj.Write()
+                yield result
+        return
+    for trial, dir_name in zip(trials, dir_names):
+        result = run_trial(trial, out_dir.mkdir(dir_name))
+        if keep is not None and not keep(result):
+            out_dir.rmdir(dir_name)
+        yield result
 
 
 def compute_pvalue_from_sign(significance):